@@ -0,0 +1,462 @@
+"""Нагрузочный тест бота на локальных заглушках Airtable и Telegram Bot API
+
+Пример запуска:
+    python benchmark.py --operators 50 --pages 5 --cash-flows 3 --airtable-latency 0.15 --rate-429 0.02
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import importlib
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import statistics
+import tempfile
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, unquote
+
+from cash_form import PICK, STEPS_BY_FIELD, callback_data
+from http_server import HTTPServer
+from keyboards import CASH_BUTTON, SCHEDULE_BUTTON, SHIFTS
+
+PAGE_SIZE = 100
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+class FakeAirtable:
+    """Заглушка REST API Airtable: таблицы в памяти, задержка и случайные ответы 429
+
+    Поддерживает вебхуки: при изменении записей отправляет подписанные уведомления
+    и отдает пакеты изменений по курсору, как Airtable.
+    """
+
+    def __init__(self, latency=0.0, rate_429=0.0):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.tables = defaultdict(dict)
+        self.requests = Counter()
+        self.webhooks = {}
+        self.server = HTTPServer('127.0.0.1', 0)
+        for method in ('GET', 'POST', 'PATCH', 'DELETE'):
+            self.server.add_route(method, '/v0/*', self.handle)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.port}"
+
+    def seed(self, table, fields):
+        record_id = 'rec' + uuid.uuid4().hex[:14]
+        self.tables[table][record_id] = self._record(record_id, fields)
+        self._changed(table, 'createdRecordsById', {record_id: {'cellValuesByFieldId': {}}})
+        return record_id
+
+    def update(self, table, record_id, fields):
+        """Изменение записи "в интерфейсе Airtable" (с уведомлением вебхуков)"""
+        self._write(table, record_id, fields)
+
+    def destroy(self, table, record_id):
+        del self.tables[table][record_id]
+        self._changed(table, 'destroyedRecordIds', [record_id])
+
+    @staticmethod
+    def table_id(table):
+        return 'tbl' + hashlib.md5(table.encode('utf-8')).hexdigest()[:14]
+
+    def _changed(self, table, kind, records):
+        """Добавляет пакет изменений всем вебхукам и отправляет уведомления (если цикл событий запущен)"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        for webhook_id, webhook in self.webhooks.items():
+            webhook['payloads'].append({
+                'timestamp': _now().strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                'baseTransactionNumber': len(webhook['payloads']) + 1,
+                'payloadFormat': 'v0',
+                'changedTablesById': {self.table_id(table): {kind: records}},
+            })
+            if loop:
+                loop.create_task(self._notify(webhook_id))
+
+    async def _notify(self, webhook_id):
+        import httpx
+
+        webhook = self.webhooks[webhook_id]
+        body = json.dumps({'base': {'id': webhook['base']}, 'webhook': {'id': webhook_id},
+                           'timestamp': _now().strftime("%Y-%m-%dT%H:%M:%S.000Z")}).encode()
+        mac = hmac.new(base64.b64decode(webhook['secret']), body, hashlib.sha256).hexdigest()
+        try:
+            async with httpx.AsyncClient() as client:
+                await client.post(webhook['url'], content=body, headers={
+                    'Content-Type': 'application/json', 'X-Airtable-Content-MAC': f"hmac-sha256={mac}"
+                })
+        except httpx.HTTPError as e:
+            logging.getLogger(__name__).warning(f"Webhook notification failed: {str(e)}")
+
+    def _webhook(self, method, base_id, parts, options, body):
+        """Эндпоинты bases/{base}/webhooks[/{id}[/payloads|refresh|enableNotifications]]"""
+        if not parts:
+            if method == 'GET':
+                return 200, {'webhooks': [
+                    {'id': webhook_id, 'notificationUrl': webhook['url'], 'areNotificationsEnabled': True,
+                     'cursorForNextPayload': len(webhook['payloads']) + 1}
+                    for webhook_id, webhook in self.webhooks.items()
+                ]}
+            webhook_id = 'ach' + uuid.uuid4().hex[:14]
+            secret = base64.b64encode(os.urandom(32)).decode()
+            self.webhooks[webhook_id] = {'base': base_id, 'url': body['notificationUrl'], 'secret': secret,
+                                         'payloads': []}
+            return 200, {'id': webhook_id, 'macSecretBase64': secret, 'expirationTime': None}
+        webhook = self.webhooks.get(parts[0])
+        if webhook is None:
+            return 404, {'error': 'NOT_FOUND'}
+        if method == 'DELETE':
+            del self.webhooks[parts[0]]
+            return 200, {}
+        if parts[1:] == ['payloads']:
+            cursor = int(options.get('cursor') or 1)
+            page = webhook['payloads'][cursor - 1:cursor - 1 + PAGE_SIZE]
+            return 200, {'payloads': page, 'cursor': cursor + len(page),
+                         'mightHaveMore': cursor - 1 + len(page) < len(webhook['payloads'])}
+        return 200, {'expirationTime': None}
+
+    def _record(self, record_id, fields):
+        return {'id': record_id, 'createdTime': _now().strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                'fields': dict(fields), 'modified': _now()}
+
+    @staticmethod
+    def _public(record):
+        return {key: record[key] for key in ('id', 'createdTime', 'fields')}
+
+    def _matches(self, formula, record):
+        if not formula:
+            return True
+        record_ids = re.findall(r"RECORD_ID\(\)='([^']*)'", formula)
+        if record_ids and record['id'] not in record_ids:
+            return False
+        for field, value in re.findall(r"\{([^}]+)\}='([^']*)'", formula):
+            if str(record['fields'].get(field, '')) != value:
+                return False
+        since = re.search(r"IS_AFTER\(LAST_MODIFIED_TIME\([^)]*\), DATETIME_PARSE\('([^']*)'\)\)", formula)
+        if since and record['modified'] <= datetime.fromisoformat(since.group(1).replace('Z', '+00:00')):
+            return False
+        for field, value in re.findall(r"IS_AFTER\(\{([^}]+)\}, DATETIME_PARSE\('([^']*)'\)\)", formula):
+            if str(record['fields'].get(field, '')) <= value:
+                return False
+        for field, value in re.findall(r"IS_BEFORE\(\{([^}]+)\}, DATETIME_PARSE\('([^']*)'\)\)", formula):
+            if str(record['fields'].get(field, '')) >= value:
+                return False
+        return True
+
+    def _list(self, table, options):
+        formula = options.get('filterByFormula')
+        records = [record for record in self.tables[table].values() if self._matches(formula, record)]
+        if options.get('maxRecords'):
+            records = records[:int(options['maxRecords'])]
+        offset = int(options.get('offset') or 0)
+        page = records[offset:offset + PAGE_SIZE]
+        result = {'records': [self._public(record) for record in page]}
+        if offset + PAGE_SIZE < len(records):
+            result['offset'] = str(offset + PAGE_SIZE)
+        return result
+
+    def _write(self, table, record_id, fields):
+        created = record_id is None
+        if created:
+            record_id = 'rec' + uuid.uuid4().hex[:14]
+            self.tables[table][record_id] = self._record(record_id, fields)
+        else:
+            record = self.tables[table][record_id]
+            record['fields'].update(fields)
+            record['modified'] = _now()
+        kind = 'createdRecordsById' if created else 'changedRecordsById'
+        self._changed(table, kind, {record_id: {'cellValuesByFieldId': {}}})
+        return self._public(self.tables[table][record_id])
+
+    async def handle(self, request):
+        await asyncio.sleep(self.latency)
+        parts = [unquote(part) for part in request.path.split('/')]
+        options = {key: values[-1] for key, values in parse_qs(request.query).items()}
+        if parts[2] == 'meta':
+            self.requests[(request.method, 'meta')] += 1
+            tables = [{'id': self.table_id(name), 'name': name} for name in self.tables]
+            return 200, 'application/json', json.dumps({'tables': tables}, ensure_ascii=False)
+        if parts[2] == 'bases':
+            self.requests[(request.method, 'webhooks')] += 1
+            body = json.loads(request.body) if request.body else {}
+            status, result = self._webhook(request.method, parts[3], parts[5:], options, body)
+            return status, 'application/json', json.dumps(result, ensure_ascii=False)
+
+        table = parts[3]
+        target = parts[4] if len(parts) > 4 else None
+        self.requests[(request.method, table)] += 1
+
+        if random.random() < self.rate_429:
+            self.requests['429'] += 1
+            return 429, 'application/json', json.dumps({'errors': [{'error': 'RATE_LIMIT_REACHED'}]})
+
+        body = json.loads(request.body) if request.body else {}
+        if request.method == 'GET' and target is None:
+            result = self._list(table, options)
+        elif request.method == 'POST' and target == 'listRecords':
+            result = self._list(table, body)
+        elif request.method == 'GET':
+            if target not in self.tables[table]:
+                return 404, 'application/json', json.dumps({'error': 'NOT_FOUND'})
+            result = self._public(self.tables[table][target])
+        elif request.method == 'POST':
+            records = body.get('records', [body])
+            result = {'records': [self._write(table, None, record['fields']) for record in records]}
+        else:
+            if target:
+                result = self._write(table, target, body['fields'])
+            else:
+                result = {'records': [self._write(table, record['id'], record['fields'])
+                                      for record in body['records']]}
+        return 200, 'application/json', json.dumps(result, ensure_ascii=False)
+
+    def total_requests(self):
+        return sum(count for key, count in self.requests.items() if key != '429')
+
+
+class FakeTelegram:
+    """Заглушка Telegram Bot API: отвечает на getMe и sendMessage (остальные методы — True) с заданной задержкой"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_id = 0
+        self.server = HTTPServer('127.0.0.1', 0)
+        self.server.add_route('POST', '/*', self.handle)
+        self.server.add_route('GET', '/*', self.handle)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.port}"
+
+    def _params(self, request):
+        content_type = request.headers.get('content-type', '')
+        if 'json' in content_type:
+            return json.loads(request.body or b'{}')
+        return {key: values[-1] for key, values in parse_qs(request.body.decode()).items()}
+
+    async def handle(self, request):
+        await asyncio.sleep(self.latency)
+        method = request.path.rsplit('/', 1)[-1]
+        self.calls[method] += 1
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        elif method == 'sendMessage':
+            params = self._params(request)
+            self._message_id += 1
+            result = {'message_id': self._message_id, 'date': int(time.time()),
+                      'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+                      'text': params.get('text', '')}
+        else:
+            result = True
+        return 200, 'application/json', json.dumps({'ok': True, 'result': result})
+
+
+class BenchmarkRunner:
+    """Прогоняет синтетических операторов через ConversationHandler приложения"""
+
+    def __init__(self, bot, application):
+        self.bot = bot
+        self.application = application
+        self.timings = defaultdict(list)
+        self.completed = Counter()
+        self._update_id = 0
+
+    def _update(self, user_id, text):
+        from telegram import Update
+
+        self._update_id += 1
+        message = {
+            'message_id': self._update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'Operator {user_id}'},
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return Update.de_json({'update_id': self._update_id, 'message': message}, self.application.bot)
+
+    def _callback(self, user_id, data):
+        """Нажатие инлайн-кнопки под сообщением формы кассы"""
+        from telegram import Update
+
+        self._update_id += 1
+        form = self.application.user_data[user_id].get('cash_form') or {}
+        query = {
+            'id': str(self._update_id),
+            'chat_instance': str(user_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'Operator {user_id}'},
+            'message': {'message_id': form.get('message_id', 0), 'date': int(time.time()),
+                        'chat': {'id': user_id, 'type': 'private'}, 'text': ''},
+            'data': data,
+        }
+        return Update.de_json({'update_id': self._update_id, 'callback_query': query}, self.application.bot)
+
+    async def step(self, name, user_id, text=None, data=None):
+        update = self._update(user_id, text) if data is None else self._callback(user_id, data)
+        started = time.perf_counter()
+        await self.application.update_processor.process_update(
+            update, self.application.process_update(update)
+        )
+        self.timings[name].append(time.perf_counter() - started)
+
+    async def cash_flow(self, operator):
+        await self.step('cash: menu', operator['tg_id'], CASH_BUTTON)
+        # Форма открывается на первом незаполненном шаге: после первой записи страница и смена уже выбраны
+        form = self.application.user_data[operator['tg_id']]['cash_form']
+        while form['step'] != 'amount':
+            options = STEPS_BY_FIELD[form['step']].options(form)
+            choice = f"{form['step']}.{random.randrange(len(options))}"
+            await self.step(f"cash: {form['step']}", operator['tg_id'], data=callback_data(PICK, choice))
+        await self.step('cash: amount', operator['tg_id'], str(random.randint(10, 5000)))
+        self.completed['cash'] += 1
+
+    async def schedule_flow(self, operator):
+        first = random.randint(1, 25)
+        await self.step('schedule: menu', operator['tg_id'], SCHEDULE_BUTTON)
+        await self.step('schedule: days', operator['tg_id'], f"{first}-{first + 5}")
+        await self.step('schedule: status', operator['tg_id'], random.choice(SHIFTS))
+        self.completed['schedule'] += 1
+
+    async def operator_session(self, operator, cash_flows, schedule_flows):
+        await self.step('start', operator['tg_id'], '/start')
+        for _ in range(cash_flows):
+            await self.cash_flow(operator)
+        for _ in range(schedule_flows):
+            await self.schedule_flow(operator)
+
+
+def seed_base(airtable, operators, pages_per_operator):
+    result = []
+    for n in range(operators):
+        tg_id = 100000 + n
+        operator_id = f"op{n}"
+        page_names = [f"Страница {n}-{k}" for k in range(pages_per_operator)]
+        page_ids = [airtable.seed('Касса', {'Name': name}) for name in page_names]
+        airtable.seed('Операторы', {'TG ID': str(tg_id), 'ID': operator_id, 'Name': f"Оператор {n}",
+                                    'Страница': page_ids})
+        airtable.seed('График', {'ID': operator_id})
+        result.append({'tg_id': tg_id, 'id': operator_id, 'pages': page_names})
+    return result
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def report(runner, airtable, telegram, elapsed):
+    updates = sum(len(values) for values in runner.timings.values())
+    flows = sum(runner.completed.values())
+    lines = [
+        f"Updates processed:      {updates} in {elapsed:.2f}s ({updates / elapsed:.1f} updates/sec)",
+        f"Completed flows:        {dict(runner.completed)}",
+        f"Airtable requests:      {airtable.total_requests()} "
+        f"({airtable.total_requests() / max(flows, 1):.2f} per completed flow, {airtable.requests['429']} x 429)",
+        f"Telegram API calls:     {sum(telegram.calls.values())} {dict(telegram.calls)}",
+        "",
+        f"{'step':<20}{'count':>8}{'p50, ms':>12}{'p99, ms':>12}{'mean, ms':>12}",
+    ]
+    for name, values in runner.timings.items():
+        lines.append(
+            f"{name:<20}{len(values):>8}{percentile(values, 0.5) * 1000:>12.1f}"
+            f"{percentile(values, 0.99) * 1000:>12.1f}{statistics.mean(values) * 1000:>12.1f}"
+        )
+    lines.append("")
+    lines.append("Airtable requests by table:")
+    for key, count in sorted(airtable.requests.items(), key=str):
+        if key != '429':
+            lines.append(f"  {key[0]:<6} {key[1]:<12} {count}")
+    return "\n".join(lines)
+
+
+async def run(args):
+    random.seed(args.seed)
+    airtable = FakeAirtable(latency=args.airtable_latency, rate_429=args.rate_429)
+    telegram = FakeTelegram(latency=args.telegram_latency)
+    await airtable.server.start()
+    await telegram.server.start()
+    operators = seed_base(airtable, args.operators, args.pages)
+
+    workdir = tempfile.mkdtemp(prefix='bot-benchmark-')
+    os.environ.update({
+        'AIRTABLE_API_KEY': 'benchmark',
+        'AIRTABLE_ENDPOINT_URL': airtable.url,
+        'TELEGRAM_BASE_URL': telegram.url,
+        'PERSISTENCE_BACKEND': 'none',
+        'METRICS_PORT': '0',
+        # Заглушка не требует паузы после 429, а с настоящими 30 секундами прогон с --rate-429 затянется
+        'AIRTABLE_RATE_LIMIT_PAUSE': '0.5',
+        'WRITE_QUEUE_PATH': os.path.join(workdir, 'write_queue.sqlite3'),
+        'REPLICA_PATH': os.path.join(workdir, 'replica.sqlite3'),
+    })
+    bot = importlib.import_module('bot')
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    application = bot.build_application('123456:BENCHMARK')
+    await application.initialize()
+    await application.start()
+    await bot.start_background_tasks(application)
+
+    try:
+        if args.warm:
+            for tenant in bot.tenants:
+                await asyncio.to_thread(tenant.replica_sync.sync_all)
+            airtable.requests.clear()
+
+        runner = BenchmarkRunner(bot, application)
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            runner.operator_session(operator, args.cash_flows, args.schedule_flows) for operator in operators
+        ))
+        elapsed = time.perf_counter() - started
+
+        # Дожидаемся отправки отложенных записей, чтобы посчитать все запросы к Airtable
+        for tenant in bot.tenants:
+            await tenant.schedule_updates.flush()
+            while tenant.write_queue.depth():
+                await asyncio.sleep(0.1)
+        print(report(runner, airtable, telegram, elapsed))
+    finally:
+        await application.stop()
+        await bot.shutdown_storage(application)
+        await application.shutdown()
+        await airtable.server.stop()
+        await telegram.server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--operators', type=int, default=20, help="число синтетических операторов")
+    parser.add_argument('--pages', type=int, default=5, help="страниц у каждого оператора")
+    parser.add_argument('--cash-flows', type=int, default=3, help="записей кассы на оператора")
+    parser.add_argument('--schedule-flows', type=int, default=1, help="изменений графика на оператора")
+    parser.add_argument('--airtable-latency', type=float, default=0.1, help="задержка Airtable, сек")
+    parser.add_argument('--telegram-latency', type=float, default=0.02, help="задержка Telegram, сек")
+    parser.add_argument('--rate-429', type=float, default=0.0, help="доля ответов 429 от Airtable")
+    parser.add_argument('--warm', action='store_true', help="заполнить кэши до начала замера")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help="выводить логи бота")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,44 @@
+import asyncio
+import glob
 import os
+import re
 import logging
+import time
+import warnings
 from datetime import datetime
 from dotenv import load_dotenv
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
-from pyairtable import Api, Base, Table
+from telegram import Update
+from telegram.error import BadRequest
+from telegram.warnings import PTBUserWarning
+from telegram.ext import (
+    Application, CallbackQueryHandler, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
+)
+from bulk_entry import MAX_FILE_SIZE, parse_entries, read_csv, split_rows
+from cash_form import (
+    PREFIX as CASH_FORM_PREFIX, SUBMIT, apply_callback, apply_text, form_summary, new_cash_form, render_form
+)
+from cache import OperatorDirectory, PageNameCache, ScheduleIndex
+from circuit_breaker import STATE_VALUES, CircuitBreaker, CircuitOpenError
+from export import FORMATS, CashExport, ExportCancelled
+from http_server import HTTPServer
+from keyboards import (
+    BACK_BUTTON, BULK_CASH_BUTTON, CASH_BUTTON, MAIN_KEYBOARD, MENU_BUTTONS,
+    MY_SCHEDULE_BUTTON, NAVIGATION_BUTTONS, NAVIGATION_KEYBOARD, OPERATION_TYPES, SCHEDULE_BUTTON,
+    SCHEDULE_STATUS_KEYBOARD, SHIFTS, TOTALS_BUTTON
+)
+from metrics import REGISTRY, add_metrics_route, instrument_handler
+from persistence import create_persistence
+from replica import PageSync, Replica, SyncEngine, TableSync
+from rate_limit import RequestScheduler
+from reminders import FanOut, ReminderScheduler, SendLimiter
+from reports import CashReports, CashSync, format_amount, format_summary, split_message
+from schedule_image import content_key, render_month, render_team, send_cached
+from serving import PerChatUpdateProcessor, run_application
+from sharding import ShardSupervisor, build_dispatcher, run_worker
+from storage import AirtableStorage, LazyApi
+from tenants import Tenant, TenantRegistry, parse_bases, tenant_path, tenant_setting
+from webhooks import ChangeReceiver, add_webhook_route
+from write_queue import UpdateCoalescer, WriteBehindQueue, remove_database
 
 # Настройка логирования
 logging.basicConfig(
@@ -19,82 +53,336 @@ load_dotenv()
 # Константы для состояний разговора
 (MENU, CASH_FLOW_SELECT_PAGE, CASH_FLOW_SELECT_SHIFT, CASH_FLOW_SELECT_TYPE, 
  CASH_FLOW_ENTER_AMOUNT, CASH_FLOW_ENTER_DATE, SCHEDULE_SELECT_DATE, 
- SCHEDULE_SELECT_SHIFT) = range(8)
+ SCHEDULE_SELECT_SHIFT, CASH_BULK_ENTER, CASH_FORM) = range(10)
+# Шаги старой пошаговой записи кассы: сохраненные разговоры в них возвращаются в меню
+LEGACY_CASH_FLOW_STATES = (
+    CASH_FLOW_SELECT_PAGE, CASH_FLOW_SELECT_SHIFT, CASH_FLOW_SELECT_TYPE, CASH_FLOW_ENTER_AMOUNT, CASH_FLOW_ENTER_DATE
+)
 
 # Константы для Airtable
-AIRTABLE_API_KEY = os.getenv('AIRTABLE_API_KEY')
-BASE_ID = "appPLEgqFVgDw0mmi"  # ID вашей базы Managers
+AIRTABLE_ENDPOINT_URL = os.getenv('AIRTABLE_ENDPOINT_URL', 'https://api.airtable.com')
+BASE_ID = os.getenv('AIRTABLE_BASE_ID', "appPLEgqFVgDw0mmi")  # ID вашей базы Managers
 OPERATORS_TABLE = "Операторы"
 CASH_TABLE = "Касса"
 SCHEDULE_TABLE = "График"
+# Базы агентств "имя:ID базы" через запятую (первая — по умолчанию); пусто — одна база BASE_ID
+AIRTABLE_BASES = parse_bases(os.getenv('AIRTABLE_BASES', ''), default=('default', BASE_ID))
+
+# Хранилище состояний разговоров и user_data (переживает перезапуски)
+PERSISTENCE_BACKEND = os.getenv('PERSISTENCE_BACKEND', 'sqlite')
+PERSISTENCE_PATH = os.getenv('PERSISTENCE_PATH', 'bot_state.sqlite3')
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv('PERSISTENCE_UPDATE_INTERVAL', '10'))
+
+# Режим работы: polling или webhook (локальный HTTP-сервер за обратным прокси)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # публичный адрес, например https://bot.example.com
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Сколько обновлений из разных чатов обрабатывать одновременно
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '16'))
+# Адрес Bot API (можно направить на локальный тестовый сервер)
+TELEGRAM_BASE_URL = os.getenv('TELEGRAM_BASE_URL')
+# Число процессов-обработчиков (обновления распределяются по ID чата); 0 — один процесс
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', '0'))
+
+# Таймауты запросов к Airtable: подключение и ответ, сек
+AIRTABLE_CONNECT_TIMEOUT = float(os.getenv('AIRTABLE_CONNECT_TIMEOUT', '5'))
+AIRTABLE_READ_TIMEOUT = float(os.getenv('AIRTABLE_READ_TIMEOUT', '15'))
+
+# Лимит запросов к каждой базе (Airtable допускает 5 запросов в секунду на базу)
+AIRTABLE_RATE_LIMIT = float(os.getenv('AIRTABLE_RATE_LIMIT', '5'))
+AIRTABLE_RATE_LIMIT_PAUSE = float(os.getenv('AIRTABLE_RATE_LIMIT_PAUSE', '30'))
+
+# Автомат отключения: при частых ошибках или медленных ответах Airtable бот переходит в режим
+# только чтения из кэшей, а записи копятся в локальной очереди до восстановления
+AIRTABLE_BREAKER_FAILURE_RATIO = float(os.getenv('AIRTABLE_BREAKER_FAILURE_RATIO', '0.5'))
+AIRTABLE_BREAKER_SLOW_CALL = float(os.getenv('AIRTABLE_BREAKER_SLOW_CALL', '5'))
+AIRTABLE_BREAKER_RESET_TIMEOUT = float(os.getenv('AIRTABLE_BREAKER_RESET_TIMEOUT', '30'))
+
+# Потоки и соединения для запросов к каждой базе
+AIRTABLE_MAX_WORKERS = int(os.getenv('AIRTABLE_MAX_WORKERS', '8'))
+
+# Очередь отложенной записи кассы в Airtable
+WRITE_QUEUE_PATH = os.getenv('WRITE_QUEUE_PATH', 'write_queue.sqlite3')
+WRITE_QUEUE_KEY_FIELD = os.getenv('WRITE_QUEUE_KEY_FIELD')  # поле "Кассы" для ключа идемпотентности
+
+# Объединение изменений дней графика в один запрос
+SCHEDULE_UPDATE_WINDOW = float(os.getenv('SCHEDULE_UPDATE_WINDOW', '2'))
+
+# Итоги кассы по операторам (/итоги): обновляются при записи и сверяются с Airtable синхронизацией
+REPORTS_DAYS = int(os.getenv('REPORTS_DAYS', '62'))
+
+# Напоминания операторам и рассылки менеджеров (на JobQueue приложения)
+REMINDERS_ENABLED = os.getenv('REMINDERS_ENABLED', '1') == '1'
+REMINDER_INTERVAL = float(os.getenv('REMINDER_INTERVAL', '900'))  # как часто искать пропущенную кассу, сек
+REMINDER_GRACE = float(os.getenv('REMINDER_GRACE', '1800'))  # сколько ждать запись после конца смены, сек
+SCHEDULE_REMINDER_TIME = os.getenv('SCHEDULE_REMINDER_TIME', '10:00')  # пусто — не напоминать о графике
+SCHEDULE_REMINDER_DAYS = int(os.getenv('SCHEDULE_REMINDER_DAYS', '7'))
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))  # сообщений в секунду при рассылке
+
+# Картинки графика: шрифт с кириллицей и сколько file_id картинок помнить
+SCHEDULE_FONT_PATH = os.getenv('SCHEDULE_FONT_PATH', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
+SCHEDULE_IMAGE_CACHE_SIZE = int(os.getenv('SCHEDULE_IMAGE_CACHE_SIZE', '500'))
+
+# Выгрузки "Кассы" для бухгалтерии (/export) и предельный размер файла для отправки в Telegram
+EXPORT_DIR = os.getenv('EXPORT_DIR', 'exports')
+EXPORT_MAX_FILE_SIZE = int(os.getenv('EXPORT_MAX_FILE_SIZE', str(50 * 1024 * 1024)))
+
+# Локальная копия таблиц: кэши заполняются с диска и обновляются только изменениями
+REPLICA_PATH = os.getenv('REPLICA_PATH', 'replica.sqlite3')
+REPLICA_SYNC_INTERVAL = float(os.getenv('REPLICA_SYNC_INTERVAL', '60'))
+REPLICA_FULL_SYNC_EVERY = int(os.getenv('REPLICA_FULL_SYNC_EVERY', '60'))
+
+# Уведомления Airtable об изменениях: публичный адрес эндпоинта, путь на служебном сервере
+# и интервал опроса, пока уведомления работают (при сбоях — REPLICA_SYNC_INTERVAL)
+AIRTABLE_WEBHOOK_URL = os.getenv('AIRTABLE_WEBHOOK_URL')
+AIRTABLE_WEBHOOK_PATH = os.getenv('AIRTABLE_WEBHOOK_PATH', '/airtable/webhook')
+AIRTABLE_WEBHOOK_POLL_INTERVAL = float(os.getenv('AIRTABLE_WEBHOOK_POLL_INTERVAL', '900'))
+
+def create_tenant(name, base_id, default=False):
+    """Собирает клиент, лимит запросов, кэши, очереди и синхронизацию одной базы
 
-# Константы для смен
-SHIFTS = ["00-08", "08-16", "16-00", "00-06", "06-12", "12-18", "18-00"]
-
-# Инициализация Airtable
-airtable = Api(AIRTABLE_API_KEY)
-base = Base(airtable, BASE_ID)
-operators_table = base.table(OPERATORS_TABLE)
-cash_table = base.table(CASH_TABLE)
-schedule_table = base.table(SCHEDULE_TABLE)
-
-def create_main_keyboard():
-    """Создает основную клавиатуру"""
-    keyboard = [
-        [KeyboardButton("💰 Записать кассу")],
-        [KeyboardButton("📅 График")]
+    Файлы агентства по умолчанию называются как раньше, остальных — с именем агентства.
+    """
+    # Клиент создается при первом запросе
+    airtable = LazyApi(
+        tenant_setting(name, 'AIRTABLE_API_KEY'),
+        endpoint_url=tenant_setting(name, 'AIRTABLE_ENDPOINT_URL', AIRTABLE_ENDPOINT_URL),
+        timeout=(AIRTABLE_CONNECT_TIMEOUT, AIRTABLE_READ_TIMEOUT)
+    )
+    operators_table = airtable.table(base_id, OPERATORS_TABLE)
+    cash_table = airtable.table(base_id, CASH_TABLE)
+    schedule_table = airtable.table(base_id, SCHEDULE_TABLE)
+
+    request_scheduler = RequestScheduler(
+        rate=AIRTABLE_RATE_LIMIT, burst=max(1, int(AIRTABLE_RATE_LIMIT)), rate_limit_pause=AIRTABLE_RATE_LIMIT_PAUSE
+    )
+    breaker = CircuitBreaker(
+        failure_ratio=AIRTABLE_BREAKER_FAILURE_RATIO,
+        slow_call=AIRTABLE_BREAKER_SLOW_CALL,
+        reset_timeout=AIRTABLE_BREAKER_RESET_TIMEOUT
+    )
+
+    # Асинхронный доступ к таблицам для обработчиков
+    storage = AirtableStorage(
+        airtable, max_workers=AIRTABLE_MAX_WORKERS, scheduler=request_scheduler, breaker=breaker
+    )
+    cash_db = storage.table(cash_table)
+    schedule_db = storage.table(schedule_table)
+
+    # Справочник операторов и кэш названий страниц (актуальность поддерживает синхронизация)
+    operator_directory = OperatorDirectory(operators_table)
+    page_cache = PageNameCache(cash_table, ttl=float('inf'))
+
+    manager_chat_ids = [
+        int(value) for value in (tenant_setting(name, 'MANAGER_CHAT_IDS') or '').split(',') if value.strip()
     ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    write_queue_path = WRITE_QUEUE_PATH if default else tenant_path(WRITE_QUEUE_PATH, name)
+    write_queue = WriteBehindQueue(
+        write_queue_path,
+        {CASH_TABLE: cash_db},
+        key_field=WRITE_QUEUE_KEY_FIELD,
+        available=breaker.available,
+        on_failed=lambda bot, records, error: report_rejected_records(bot, manager_chat_ids, records, error)
+    )
 
-def create_navigation_keyboard(include_back=True, include_main_menu=True):
-    """Создает клавиатуру с кнопками навигации"""
-    keyboard = []
-    if include_back:
-        keyboard.append([KeyboardButton("⬅️ Назад")])
-    if include_main_menu:
-        keyboard.append([KeyboardButton("🏠 В главное меню")])
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    # Записи графика операторов и объединение изменений дней в один запрос (неотправленные хранятся
+    # в файле очереди записей, как и касса)
+    schedule_index = ScheduleIndex(schedule_table)
+    schedule_updates = UpdateCoalescer(
+        schedule_db,
+        path=write_queue_path,
+        window=SCHEDULE_UPDATE_WINDOW,
+        available=breaker.available,
+        on_failed=lambda bot, updates, error: report_failed_schedule_updates(
+            bot, manager_chat_ids, schedule_index, operator_directory, updates, error
+        )
+    )
+
+    cash_reports = CashReports(days=REPORTS_DAYS, pending=lambda: set(write_queue.pending(CASH_TABLE)))
+
+    reminders = ReminderScheduler(
+        operator_directory.operators,
+        schedule_index,
+        cash_reports,
+        SHIFTS,
+        format_days=lambda days: format_days(days),
+        manager_chat_ids=manager_chat_ids,
+        interval=REMINDER_INTERVAL,
+        grace=REMINDER_GRACE,
+        # Время JobQueue — в UTC, поэтому указываем локальный часовой пояс, как у datetime.now() в обработчиках
+        schedule_time=(
+            datetime.strptime(SCHEDULE_REMINDER_TIME, "%H:%M").time().replace(tzinfo=datetime.now().astimezone().tzinfo)
+            if SCHEDULE_REMINDER_TIME else None
+        ),
+        schedule_days=SCHEDULE_REMINDER_DAYS,
+        limiter=send_limiter,
+        name=name
+    )
+
+    replica = Replica(REPLICA_PATH if default else tenant_path(REPLICA_PATH, name))
+    replica_sync = SyncEngine(
+        replica,
+        [
+            TableSync(operators_table, on_change=operator_directory.apply),
+            PageSync(cash_table, operator_directory.all_page_ids, on_change=page_cache.apply),
+            TableSync(schedule_table, on_change=schedule_index.apply),
+            CashSync(cash_table, cash_reports),
+        ],
+        interval=REPLICA_SYNC_INTERVAL,
+        full_sync_every=REPLICA_FULL_SYNC_EVERY
+    )
+    # Изменения из Airtable приходят уведомлениями, опрос остается запасным вариантом
+    change_receiver = ChangeReceiver(
+        airtable, base_id, replica_sync, AIRTABLE_WEBHOOK_URL,
+        poll_interval=AIRTABLE_WEBHOOK_POLL_INTERVAL,
+        fallback_interval=REPLICA_SYNC_INTERVAL
+    ) if AIRTABLE_WEBHOOK_URL else None
+
+    return Tenant(
+        name, base_id,
+        cash_table=cash_table,
+        request_scheduler=request_scheduler,
+        breaker=breaker,
+        storage=storage,
+        operator_directory=operator_directory,
+        page_cache=page_cache,
+        write_queue=write_queue,
+        schedule_index=schedule_index,
+        schedule_updates=schedule_updates,
+        cash_reports=cash_reports,
+        manager_chat_ids=manager_chat_ids,
+        reminders=reminders,
+        replica_sync=replica_sync,
+        change_receiver=change_receiver
+    )
 
+# Общий темп отправки для всех агентств: лимит Telegram действует на бота целиком
+send_limiter = SendLimiter(BROADCAST_RATE)
+
+tenants = TenantRegistry([
+    create_tenant(name, base_id, default=index == 0) for index, (name, base_id) in enumerate(AIRTABLE_BASES)
+])
+# Менеджеры всех агентств (могут делать рассылку своим операторам)
+MANAGER_CHAT_IDS = sorted({chat_id for tenant in tenants for chat_id in tenant.manager_chat_ids})
+
+# Метрики очередей и клиентов по базам (остальные метрики собираются в metrics.py)
+REGISTRY.callback(
+    'bot_write_queue_depth', 'Записи кассы, ожидающие отправки в Airtable',
+    lambda: {(tenant.name,): tenant.write_queue.depth() for tenant in tenants}, labels=['base']
+)
+REGISTRY.callback(
+    'bot_write_queue_failed', 'Записи кассы, отклоненные Airtable (не будут отправлены повторно)',
+    lambda: {(tenant.name,): tenant.write_queue.failed() for tenant in tenants}, labels=['base']
+)
+REGISTRY.callback(
+    'bot_schedule_updates_pending', 'Записи графика с неотправленными изменениями',
+    lambda: {(tenant.name,): tenant.schedule_updates.pending() for tenant in tenants}, labels=['base']
+)
+REGISTRY.callback(
+    'bot_airtable_circuit_state', 'Состояние автомата Airtable: 0 — замкнут, 1 — пробный запрос, 2 — разомкнут',
+    lambda: {(tenant.name,): STATE_VALUES[tenant.breaker.state] for tenant in tenants}, labels=['base']
+)
+REGISTRY.callback(
+    'bot_airtable_scheduler_queue_depth', 'Запросы, ожидающие токен планировщика',
+    lambda: {(tenant.name, name): depth for tenant in tenants
+             for name, depth in tenant.request_scheduler.snapshot()['queue_depth'].items()},
+    labels=['base', 'priority']
+)
+REGISTRY.callback(
+    'bot_airtable_scheduler_wait_seconds_total', 'Суммарное ожидание токена планировщика',
+    lambda: {(tenant.name, name): stats['wait_total'] for tenant in tenants
+             for name, stats in tenant.request_scheduler.snapshot()['wait'].items()},
+    labels=['base', 'priority'], kind='counter'
+)
+
+# Служебный HTTP-сервер с эндпоинтом /metrics (порт 0 — выключен)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9090'))
+service_server = HTTPServer(METRICS_HOST, METRICS_PORT)
+add_metrics_route(service_server)
+if AIRTABLE_WEBHOOK_URL:
+    add_webhook_route(service_server, AIRTABLE_WEBHOOK_PATH, {
+        tenant.base_id: tenant.change_receiver for tenant in tenants
+    })
+
+# Ответы в режиме только чтения (автомат Airtable разомкнут)
+UNAVAILABLE_TEXT = "⚠️ База временно недоступна. Попробуйте через несколько минут."
+PENDING_SYNC_NOTE = "\n\n⏳ База временно недоступна: данные сохранены и будут отправлены автоматически."
+
+def current_tenant(context):
+    """Агентство оператора, сохраненное при /start (для старых сессий — агентство по умолчанию)"""
+    return tenants.get(context.user_data.get('tenant'))
+
+def pending_sync_note(tenant):
+    """Пометка к подтверждению записи, пока Airtable недоступен"""
+    return PENDING_SYNC_NOTE if tenant.breaker.degraded else ""
+
+async def find_operator(user_id):
+    """Ищет оператора по TG ID во всех базах: (агентство, запись) или (None, None)"""
+    tenant, operator = tenants.find_operator(user_id)
+    if operator:
+        return tenant, operator
+    # Промах кэшей: спрашиваем все базы одновременно
+    results = await asyncio.gather(*(
+        tenant.storage.run_shared(
+            ('operator_tg_id', user_id), tenant.operator_directory.get_by_tg_id, user_id
+        )
+        for tenant in tenants
+    ), return_exceptions=True)
+    errors = []
+    for tenant, result in zip(tenants, results):
+        if isinstance(result, Exception):
+            errors.append(result)
+        elif result:
+            return tenant, result
+    # Оператор мог быть в базе, которая не ответила
+    if errors:
+        raise errors[0]
+    return None, None
+
+async def get_operator_pages(tenant, operator):
+    """Возвращает страницы оператора {название: ID} из кэша, догружая недостающие"""
+    page_ids = operator['fields'].get('Страница', [])
+    pages, missing = tenant.page_cache.lookup(page_ids)
+    # Пока Airtable недоступен, обходимся страницами из кэша
+    if missing and tenant.breaker.available():
+        try:
+            pages = await tenant.storage.run_shared(
+                ('pages', tuple(page_ids)), tenant.page_cache.resolve, page_ids
+            )
+        except Exception as e:
+            logger.error(f"Error fetching pages {missing}: {str(e)}")
+    return pages
+
+@instrument_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     # Получаем информацию о пользователе
     user_id = str(update.effective_user.id)
     
     try:
-        # Ищем оператора по TG ID
-        operators = operators_table.all()
-        operator = None
-        
-        for op in operators:
-            if op['fields'].get('TG ID') == user_id:
-                operator = op
-                break
+        # Ищем оператора по TG ID во всех базах агентств
+        tenant, operator = await find_operator(user_id)
         
         if operator:
-            logger.info(f"Found operator: {operator}")
+            logger.info(f"Found operator: {operator['id']} ({tenant.name})")
             # Сохраняем данные оператора
+            context.user_data['tenant'] = tenant.name
             context.user_data['operator_id'] = operator['fields'].get('ID')
             context.user_data['operator_name'] = operator['fields'].get('Name')
             context.user_data['manager'] = operator['fields'].get('Менеджер', [None])[0] if operator['fields'].get('Менеджер') else None
             
             # Получаем страницы оператора
-            pages = {}
-            if 'Страница' in operator['fields']:
-                for page_id in operator['fields']['Страница']:
-                    try:
-                        page = cash_table.get(page_id)
-                        if page and 'Name' in page['fields']:
-                            pages[page['fields']['Name']] = page_id
-                    except Exception as e:
-                        logger.error(f"Error fetching page {page_id}: {str(e)}")
-            
-            context.user_data['page_names'] = pages
-            logger.info(f"Saved operator data: {context.user_data}")
+            context.user_data['page_names'] = await get_operator_pages(tenant, operator)
+            logger.debug(f"Saved operator data: {context.user_data}")
             
             # Создаем основную клавиатуру
             await update.message.reply_text(
                 "Выберите действие:",
-                reply_markup=create_main_keyboard()
+                reply_markup=MAIN_KEYBOARD
             )
             return MENU
         else:
@@ -104,6 +392,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return ConversationHandler.END
             
+    except CircuitOpenError:
+        # Оператора нет в кэше, а проверить его в Airtable сейчас нельзя
+        await update.message.reply_text(UNAVAILABLE_TEXT)
+        return ConversationHandler.END
     except Exception as e:
         logger.error(f"Error in start handler: {str(e)}")
         await update.message.reply_text(
@@ -111,485 +403,912 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ConversationHandler.END
 
+async def load_cash_pages(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Загружает страницы оператора в контекст; при ошибке отвечает пользователю и возвращает None"""
+    # Получаем ID страниц из данных оператора
+    operator_id = context.user_data.get('operator_id')
+    if not operator_id:
+        logger.error("Operator ID not found in context")
+        await update.message.reply_text(
+            "Ошибка: не найден ID оператора. Попробуйте перезапустить бота командой /start",
+            reply_markup=MAIN_KEYBOARD
+        )
+        return None
+
+    # Получаем оператора из справочника его агентства
+    tenant = current_tenant(context)
+    operator = tenant.operator_directory.find_by_id(operator_id)
+    if not operator:
+        try:
+            operator = await tenant.storage.run_shared(
+                ('operator_id', operator_id), tenant.operator_directory.get_by_id, operator_id
+            )
+        except CircuitOpenError:
+            await update.message.reply_text(UNAVAILABLE_TEXT, reply_markup=MAIN_KEYBOARD)
+            return None
+    if not operator:
+        logger.error(f"Operator not found with ID: {operator_id}")
+        await update.message.reply_text(
+            "Ошибка: не найден оператор. Обратитесь к менеджеру.",
+            reply_markup=MAIN_KEYBOARD
+        )
+        return None
+
+    pages = await get_operator_pages(tenant, operator)
+
+    if not pages:
+        logger.error("No pages found for operator")
+        await update.message.reply_text(
+            "У вас нет доступных страниц. Обратитесь к менеджеру.",
+            reply_markup=MAIN_KEYBOARD
+        )
+        return None
+
+    # Сохраняем страницы в контекст
+    context.user_data['page_names'] = pages
+    logger.debug(f"Available pages: {pages}")
+    return pages
+
+@instrument_handler
 async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик главного меню"""
     text = update.message.text
-    logger.info(f"Menu selection: {text}")
+    logger.debug(f"Menu selection: {text}")
 
     # Обрабатываем кнопки навигации
-    if text in ["⬅️ Назад", "🏠 В главное меню"]:
+    if text in NAVIGATION_BUTTONS:
         await update.message.reply_text(
             "Выберите действие:",
-            reply_markup=create_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
         return MENU
 
-    if text == "💰 Записать кассу":
-        # Получаем страницы оператора
+    if text in (CASH_BUTTON, BULK_CASH_BUTTON):
         try:
-            # Получаем ID страниц из данных оператора
-            operator_id = context.user_data.get('operator_id')
-            if not operator_id:
-                logger.error("Operator ID not found in context")
-                await update.message.reply_text(
-                    "Ошибка: не найден ID оператора. Попробуйте перезапустить бота командой /start",
-                    reply_markup=create_main_keyboard()
-                )
-                return MENU
-
-            # Получаем оператора из таблицы
-            operators = operators_table.all(formula=f"{{ID}}='{operator_id}'")
-            if not operators:
-                logger.error(f"Operator not found with ID: {operator_id}")
-                await update.message.reply_text(
-                    "Ошибка: не найден оператор. Обратитесь к менеджеру.",
-                    reply_markup=create_main_keyboard()
-                )
+            pages = await load_cash_pages(update, context)
+            if not pages:
                 return MENU
 
-            operator = operators[0]
-            pages = {}
-            
-            if 'Страница' in operator['fields']:
-                for page_id in operator['fields']['Страница']:
-                    try:
-                        page = cash_table.get(page_id)
-                        if page and 'Name' in page['fields']:
-                            pages[page['fields']['Name']] = page_id
-                    except Exception as e:
-                        logger.error(f"Error fetching page {page_id}: {str(e)}")
-
-            if not pages:
-                logger.error("No pages found for operator")
+            if text == BULK_CASH_BUTTON:
+                example = next(iter(pages))
                 await update.message.reply_text(
-                    "У вас нет доступных страниц. Обратитесь к менеджеру.",
-                    reply_markup=create_main_keyboard()
+                    "Отправьте записи, по одной в строке:\n"
+                    "Страница; Смена; Тип; Сумма; Дата\n\n"
+                    f"Например:\n{example}; {SHIFTS[1]}; {OPERATION_TYPES[0]}; 1500; "
+                    f"{datetime.now().strftime('%d.%m.%Y')}\n\n"
+                    "Дату можно не указывать — будет сегодняшняя. Можно прислать CSV-файл с теми же колонками.\n\n"
+                    f"Ваши страницы: {', '.join(pages)}",
+                    reply_markup=NAVIGATION_KEYBOARD
                 )
-                return MENU
-
-            # Сохраняем страницы в контекст
-            context.user_data['page_names'] = pages
-            logger.info(f"Available pages: {pages}")
-
-            # Создаем клавиатуру со страницами
-            keyboard = [[KeyboardButton(page_name)] for page_name in pages.keys()]
-            keyboard.extend([
-                [KeyboardButton("⬅️ Назад")],
-                [KeyboardButton("🏠 В главное меню")]
-            ])
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+                return CASH_BULK_ENTER
 
-            await update.message.reply_text(
-                "Выберите страницу:",
-                reply_markup=reply_markup
-            )
-            return CASH_FLOW_SELECT_PAGE
+            # Форма кассы: одно сообщение с инлайн-кнопками, последние страница и смена уже выбраны
+            form = new_cash_form(pages, context.user_data.get('cash_defaults', {}), datetime.now().date())
+            text, markup = render_form(form)
+            message = await update.message.reply_text(text, reply_markup=markup)
+            form['message_id'] = message.message_id
+            context.user_data['cash_form'] = form
+            return CASH_FORM
 
         except Exception as e:
             logger.error(f"Error in cash flow menu: {str(e)}")
             await update.message.reply_text(
                 "Произошла ошибка. Попробуйте позже или обратитесь к менеджеру.",
-                reply_markup=create_main_keyboard()
+                reply_markup=MAIN_KEYBOARD
             )
             return MENU
 
-    elif text == "📅 График":
-        # Создаем клавиатуру с кнопками навигации
-        keyboard = [
-            [KeyboardButton("⬅️ Назад")],
-            [KeyboardButton("🏠 В главное меню")]
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        
-        await update.message.reply_text(
-            "Введите число месяца (1-31):",
-            reply_markup=reply_markup
-        )
-        return SCHEDULE_SELECT_DATE
+    elif text == MY_SCHEDULE_BUTTON:
+        return await handle_my_schedule(update, context)
+
+    elif text == TOTALS_BUTTON:
+        return await handle_totals(update, context)
+
+    elif text == SCHEDULE_BUTTON:
+        return await ask_schedule_days(update, context)
     
     else:
         # Обрабатываем неизвестные команды в главном меню
         logger.info(f"Unknown command in main menu: {text}")
         await update.message.reply_text(
             "Пожалуйста, выберите одно из доступных действий:",
-            reply_markup=create_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
         return MENU
 
-async def handle_cash_flow_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик выбора страницы для записи кассы"""
-    text = update.message.text
-    
-    if text == "⬅️ Назад" or text == "🏠 В главное меню":
-        return await handle_navigation(update, context)
-    
-    context.user_data['selected_page'] = text
-    
-    # Создаем клавиатуру с выбором смены
-    keyboard = [[KeyboardButton(shift)] for shift in SHIFTS]
-    keyboard.extend([
-        [KeyboardButton("⬅️ Назад")],
-        [KeyboardButton("🏠 В главное меню")]
-    ])
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    
-    await update.message.reply_text(
-        "Выберите смену:",
-        reply_markup=reply_markup
+def cash_record(user_data, page_id, shift, operation_type, amount, date):
+    """Поля записи таблицы "Касса" для текущего оператора"""
+    return {
+        "ID": str(user_data.get('operator_id')),
+        "Name": user_data.get('operator_name'),
+        "Касса": amount,
+        "Страница": [page_id],
+        "Смена": shift,
+        "Date": date,
+        "Тип": operation_type,
+        "Менеджер": [user_data['manager']] if user_data.get('manager') else None
+    }
+
+async def report_rejected_records(bot, manager_chat_ids, records, error):
+    """Сообщает менеджерам агентства о записях кассы, которые Airtable отклонил"""
+    if not manager_chat_ids:
+        return
+    lines = [
+        f"• {fields.get('Date')}, {fields.get('Name') or fields.get('ID')}, {fields.get('Смена')}, "
+        f"{fields.get('Тип')}: {format_amount(fields.get('Касса') or 0)}"
+        for fields in records
+    ]
+    text = (
+        "⚠️ Airtable отклонил записи кассы, они не попали в базу:\n" + "\n".join(lines) +
+        f"\n\nОшибка: {str(error)[:300]}\nВнесите записи вручную или попросите оператора отправить их заново."
+    )
+    await FanOut(bot, send_limiter).send([(chat_id, text) for chat_id in manager_chat_ids])
+
+async def report_failed_schedule_updates(bot, manager_chat_ids, schedule_index, operator_directory, updates, error):
+    """Сообщает менеджерам агентства об изменениях графика, которые не удалось отправить в Airtable"""
+    if not manager_chat_ids:
+        return
+    lines = []
+    for record_id, fields in updates:
+        operator_id = schedule_index.operator_for(record_id)
+        operator = operator_directory.find_by_id(operator_id) if operator_id else None
+        name = (operator['fields'].get('Name') if operator else None) or operator_id or record_id
+        days = ", ".join(f"{day} — {status}" for day, status in sorted(fields.items(), key=lambda item: int(item[0])))
+        lines.append(f"• {name}: {days}")
+    text = (
+        "⚠️ Не удалось сохранить изменения графика в Airtable:\n" + "\n".join(lines) +
+        f"\n\nОшибка: {str(error)[:300]}\nВнесите изменения вручную."
     )
-    return CASH_FLOW_SELECT_SHIFT
+    await FanOut(bot, send_limiter).send([(chat_id, text) for chat_id in manager_chat_ids])
+
+def submit_cash_form(context, form):
+    """Ставит запись из заполненной формы в очередь; возвращает текст итогового сообщения"""
+    values = form['values']
+    page_id = context.user_data.get('page_names', {}).get(values['page'])
+    if not page_id or not context.user_data.get('operator_id'):
+        logger.error(f"Cannot create cash record: page_id={page_id}, operator_id={context.user_data.get('operator_id')}")
+        return "Не удалось создать запись: страница или оператор не найдены. Перезапустите бота командой /start."
+
+    record = cash_record(context.user_data, page_id, values['shift'], values['type'], values['amount'], values['date'])
+    logger.debug(f"Creating record with data: {record}")
+    try:
+        # Ставим запись в очередь, в Airtable ее отправит фоновая задача
+        tenant = current_tenant(context)
+        key = tenant.write_queue.enqueue(CASH_TABLE, record)
+        tenant.cash_reports.add_local(key, record)
+        logger.info(f"Record queued successfully: {key}")
+    except Exception as e:
+        logger.error(f"Error queueing record: {str(e)}")
+        return "Не удалось создать запись в базе данных. Пожалуйста, попробуйте еще раз или обратитесь к менеджеру."
+
+    # Следующая форма откроется с этими страницей и сменой
+    context.user_data['cash_defaults'] = {'page': values['page'], 'shift': values['shift']}
+    return f"✅ Запись успешно создана!\n\n{form_summary(form)}{pending_sync_note(tenant)}"
+
+async def edit_cash_form(context, chat_id, form, text=None):
+    """Обновляет сообщение формы на месте: текущий шаг или итоговый текст без кнопок"""
+    markup = None
+    if text is None:
+        text, markup = render_form(form)
+    try:
+        await context.bot.edit_message_text(text, chat_id=chat_id, message_id=form['message_id'], reply_markup=markup)
+    except BadRequest as e:
+        # Повторное нажатие той же кнопки не меняет сообщение
+        if 'not modified' not in str(e).lower():
+            raise
+
+async def finish_cash_form(context, chat_id, form, result):
+    """Закрывает форму после отправки или отмены"""
+    context.user_data.pop('cash_form', None)
+    text = submit_cash_form(context, form) if result == SUBMIT else "Запись кассы отменена."
+    await edit_cash_form(context, chat_id, form, text)
+    return MENU
+
+@instrument_handler
+async def handle_cash_form_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Нажатие кнопки формы кассы: форма перестраивается в том же сообщении"""
+    query = update.callback_query
+    form = context.user_data.get('cash_form')
+    if not form or query.message is None or query.message.message_id != form['message_id']:
+        return await handle_stale_cash_form(update, context)
+
+    result = apply_callback(form, query.data)
+    chat_id = update.effective_chat.id
+    # Ответ на нажатие не ждет правки сообщения
+    if result:
+        _, state = await asyncio.gather(query.answer(), finish_cash_form(context, chat_id, form, result))
+        return state
+    await asyncio.gather(query.answer(), edit_cash_form(context, chat_id, form))
+    return CASH_FORM
 
-async def handle_cash_flow_shift(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик выбора смены"""
+@instrument_handler
+async def handle_cash_form_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Текстовый ответ в форме кассы: сумма, дата или название варианта"""
     text = update.message.text
-    
-    if text == "⬅️ Назад" or text == "🏠 В главное меню":
-        return await handle_navigation(update, context)
-    
-    # Сохраняем выбранную смену
-    context.user_data['selected_shift'] = text
-    
-    # Создаем клавиатуру для выбора типа операции
-    keyboard = [
-        [KeyboardButton("Касса")],
-        [KeyboardButton("Долет")],
-        [KeyboardButton("Возврат")],
-        [KeyboardButton("⬅️ Назад")],
-        [KeyboardButton("🏠 В главное меню")]
+    form = context.user_data.get('cash_form')
+    # Кнопки меню работают и во время заполнения формы; форма при этом закрывается
+    if not form or text in MENU_BUTTONS or text in NAVIGATION_BUTTONS:
+        context.user_data.pop('cash_form', None)
+        return await handle_menu(update, context)
+
+    result = apply_text(form, text)
+    if result:
+        return await finish_cash_form(context, update.effective_chat.id, form, result)
+    await edit_cash_form(context, update.effective_chat.id, form)
+    return CASH_FORM
+
+async def handle_stale_cash_form(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка старой или уже закрытой формы кассы"""
+    await update.callback_query.answer("Эта форма уже закрыта. Нажмите «Записать кассу», чтобы начать заново.")
+
+@instrument_handler
+async def handle_cash_bulk(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик пакетного ввода кассы: несколько строк в сообщении или CSV-файл"""
+    message = update.message
+
+    if message.text in NAVIGATION_BUTTONS:
+        await message.reply_text(
+            "Выберите действие:",
+            reply_markup=MAIN_KEYBOARD
+        )
+        return MENU
+
+    if not context.user_data.get('operator_id') or not context.user_data.get('operator_name'):
+        await message.reply_text(
+            "Ошибка: не найден оператор. Попробуйте перезапустить бота командой /start",
+            reply_markup=MAIN_KEYBOARD
+        )
+        return MENU
+
+    try:
+        if message.document:
+            if message.document.file_size and message.document.file_size > MAX_FILE_SIZE:
+                await message.reply_text(
+                    f"Файл слишком большой (не больше {MAX_FILE_SIZE // 1024} КБ).",
+                    reply_markup=NAVIGATION_KEYBOARD
+                )
+                return CASH_BULK_ENTER
+            file = await message.document.get_file()
+            rows = read_csv(bytes(await file.download_as_bytearray()))
+        else:
+            rows = split_rows(message.text or '')
+    except ValueError:
+        await message.reply_text(
+            "Не удалось прочитать файл. Сохраните его как CSV в кодировке UTF-8.",
+            reply_markup=NAVIGATION_KEYBOARD
+        )
+        return CASH_BULK_ENTER
+
+    # Все строки проверяются локально по кэшу страниц; при ошибках ничего не записывается
+    entries, errors = parse_entries(rows, context.user_data.get('page_names', {}), SHIFTS, OPERATION_TYPES)
+    if errors:
+        shown = errors[:20] + ([f"... и еще {len(errors) - 20}"] if len(errors) > 20 else [])
+        await message.reply_text(
+            "Ничего не записано. Исправьте ошибки и отправьте записи заново:\n" + "\n".join(shown),
+            reply_markup=NAVIGATION_KEYBOARD
+        )
+        return CASH_BULK_ENTER
+    if not entries:
+        await message.reply_text(
+            "Не найдено ни одной записи. Отправьте строки в формате: Страница; Смена; Тип; Сумма; Дата",
+            reply_markup=NAVIGATION_KEYBOARD
+        )
+        return CASH_BULK_ENTER
+
+    records = [
+        cash_record(context.user_data, entry['page_id'], entry['shift'], entry['type'], entry['amount'], entry['date'])
+        for entry in entries
     ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    
-    await update.message.reply_text(
-        "Выберите тип операции:",
-        reply_markup=reply_markup
+    try:
+        # Записи уходят в Airtable пачками через очередь
+        tenant = current_tenant(context)
+        keys = tenant.write_queue.enqueue_many(CASH_TABLE, records)
+        for key, record in zip(keys, records):
+            tenant.cash_reports.add_local(key, record)
+        logger.info(f"Queued {len(records)} bulk cash records")
+    except Exception as e:
+        logger.error(f"Error queueing bulk records: {str(e)}")
+        await message.reply_text(
+            "Не удалось сохранить записи. Пожалуйста, попробуйте еще раз или обратитесь к менеджеру.",
+            reply_markup=MAIN_KEYBOARD
+        )
+        return MENU
+
+    totals = {}
+    for entry in entries:
+        totals[entry['type']] = totals.get(entry['type'], 0) + entry['amount']
+    await message.reply_text(
+        f"✅ Принято записей: {len(entries)}\n\n"
+        + "\n".join(f"📝 {operation_type}: {total}" for operation_type, total in totals.items())
+        + pending_sync_note(tenant),
+        reply_markup=MAIN_KEYBOARD
+    )
+    return MENU
+
+def team_totals(tenant, today):
+    """Отчет менеджера по всем операторам агентства: сегодня и с начала месяца"""
+    cash_reports = tenant.cash_reports
+    page_names, _ = tenant.page_cache.lookup(tenant.operator_directory.all_page_ids())
+    operator_names = {
+        str(operator['fields']['ID']): operator['fields'].get('Name') or str(operator['fields']['ID'])
+        for operator in tenant.operator_directory.operators() if operator['fields'].get('ID')
+    }
+    team = f"Команда ({tenant.name})" if len(tenants) > 1 else "Команда"
+    today_report = format_summary(
+        f"{team}, сегодня, {today.strftime('%d.%m.%Y')}",
+        cash_reports.team_summary(today, today),
+        page_names,
+        details=('operator', 'page'),
+        operator_names=operator_names
+    )
+    month_report = format_summary(
+        f"{team}, с начала месяца",
+        cash_reports.team_summary(today.replace(day=1), today),
+        page_names,
+        details=('operator', 'page'),
+        operator_names=operator_names
     )
-    return CASH_FLOW_SELECT_TYPE
+    return f"{today_report}\n\n{month_report}"
 
-async def handle_cash_flow_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик выбора типа операции"""
-    text = update.message.text
-    
-    if text == "⬅️ Назад" or text == "🏠 В главное меню":
-        return await handle_navigation(update, context)
-    
-    # Проверяем тип операции
-    valid_types = ["Касса", "Долет", "Возврат"]
-    
-    if text not in valid_types:
+@instrument_handler
+async def handle_totals(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отчет /итоги: касса оператора за сегодня и с начала месяца, менеджеру — по его агентствам"""
+    operator_id = context.user_data.get('operator_id')
+    managed = [tenant for tenant in tenants if update.effective_user.id in tenant.manager_chat_ids]
+    if not operator_id and not managed:
         await update.message.reply_text(
-            "Пожалуйста, выберите тип операции из предложенных вариантов.",
-            reply_markup=ReplyKeyboardMarkup([
-                [KeyboardButton("Касса")],
-                [KeyboardButton("Долет")],
-                [KeyboardButton("Возврат")],
-                [KeyboardButton("⬅️ Назад")],
-                [KeyboardButton("🏠 В главное меню")]
-            ], resize_keyboard=True)
+            "Ошибка: не найден ID оператора. Попробуйте перезапустить бота командой /start",
+            reply_markup=MAIN_KEYBOARD
         )
-        return CASH_FLOW_SELECT_TYPE
-    
-    # Сохраняем тип операции
-    context.user_data['operation_type'] = text
-    
-    # Создаем клавиатуру для ввода суммы
-    keyboard = [
-        [KeyboardButton("⬅️ Назад")],
-        [KeyboardButton("🏠 В главное меню")]
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    
-    await update.message.reply_text(
-        "Введите сумму:",
-        reply_markup=reply_markup
+        return MENU
+    # /итоги работает из любого шага; открытая форма кассы больше не ждет ввода
+    context.user_data.pop('cash_form', None)
+
+    today = datetime.now().date()
+    reports = []
+    if operator_id:
+        cash_reports = current_tenant(context).cash_reports
+        page_names = context.user_data.get('page_names', {})
+        today_report = format_summary(
+            f"Сегодня, {today.strftime('%d.%m.%Y')}",
+            cash_reports.summary(operator_id, today, today),
+            page_names
+        )
+        month_report = format_summary(
+            "С начала месяца",
+            cash_reports.summary(operator_id, today.replace(day=1), today),
+            page_names,
+            details=('day', 'page')
+        )
+        reports.append(f"{today_report}\n\n{month_report}")
+    reports.extend(team_totals(tenant, today) for tenant in managed)
+
+    for report in reports:
+        for part in split_message(report):
+            await update.message.reply_text(part, reply_markup=MAIN_KEYBOARD)
+    return MENU
+
+@instrument_handler
+async def handle_my_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Календарь оператора на текущий месяц (картинка перерисовывается только при изменении графика)"""
+    operator_id = context.user_data.get('operator_id')
+    if not operator_id:
+        await update.message.reply_text(
+            "Ошибка: не найден ID оператора. Попробуйте перезапустить бота командой /start",
+            reply_markup=MAIN_KEYBOARD
+        )
+        return MENU
+
+    tenant = current_tenant(context)
+    if tenant.schedule_index.find(operator_id) is None:
+        await update.message.reply_text(
+            "❌ Не удалось найти вашу запись в графике. Обратитесь к менеджеру.",
+            reply_markup=MAIN_KEYBOARD
+        )
+        return MENU
+
+    today = datetime.now().date()
+    title = context.user_data.get('operator_name') or str(operator_id)
+    days = tenant.schedule_index.days(operator_id)
+    key = content_key('month', today.year, today.month,
+                      [tenant.name, str(operator_id), title, {str(day): status for day, status in days.items()}])
+    await send_cached(
+        update.message,
+        context.bot_data.setdefault('schedule_images', {}),
+        key,
+        lambda: render_month(title, today.year, today.month, days, font_path=SCHEDULE_FONT_PATH),
+        filename='schedule.png',
+        cache_size=SCHEDULE_IMAGE_CACHE_SIZE,
+        reply_markup=MAIN_KEYBOARD
     )
-    return CASH_FLOW_ENTER_AMOUNT
+    return MENU
 
-async def handle_cash_flow_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик ввода суммы"""
-    text = update.message.text
-    
-    if text == "⬅️ Назад" or text == "🏠 В главное меню":
-        return await handle_navigation(update, context)
-    
+@instrument_handler
+async def handle_team_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сводный график операторов менеджера: /team, одна картинка на агентство"""
+    today = datetime.now().date()
+    for tenant in tenants:
+        if update.effective_user.id not in tenant.manager_chat_ids:
+            continue
+        # Только по имени: у операторов с одинаковыми именами сравнивались бы словари дней
+        rows = sorted((
+            (operator['fields'].get('Name') or str(operator['fields']['ID']),
+             tenant.schedule_index.days(operator['fields']['ID']))
+            for operator in tenant.operator_directory.operators()
+            if operator['fields'].get('ID')
+        ), key=lambda row: row[0])
+        title = f"График команды ({tenant.name})" if len(tenants) > 1 else "График команды"
+        key = content_key('team', today.year, today.month,
+                          [tenant.name, [(name, {str(day): status for day, status in days.items()})
+                                         for name, days in rows]])
+        await send_cached(
+            update.message,
+            context.bot_data.setdefault('schedule_images', {}),
+            key,
+            lambda: render_team(title, today.year, today.month, rows, font_path=SCHEDULE_FONT_PATH),
+            filename=f"team-{tenant.name}-{today.strftime('%Y-%m')}.png",
+            document=True,
+            cache_size=SCHEDULE_IMAGE_CACHE_SIZE
+        )
+
+@instrument_handler
+async def handle_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Рассылка менеджера всем операторам: /broadcast текст"""
+    text = update.message.text.partition(' ')[2].strip()
+    if not text:
+        await update.message.reply_text("Использование: /broadcast текст сообщения")
+        return
+
+    await update.message.reply_text("📣 Рассылка запущена")
+
+    # Менеджер рассылает операторам своих агентств
+    managed = [tenant for tenant in tenants if update.effective_user.id in tenant.manager_chat_ids]
+
+    async def run():
+        delivered = total = 0
+        for tenant in managed:
+            tenant_delivered, tenant_total = await tenant.reminders.broadcast(context.bot, text)
+            delivered += tenant_delivered
+            total += tenant_total
+        logger.info(f"Broadcast from {update.effective_user.id}: {delivered} of {total} delivered")
+        await update.message.reply_text(f"📣 Рассылка завершена: доставлено {delivered} из {total}")
+
+    # Рассылка идет в фоне, чтобы не задерживать другие обновления этого чата
+    context.application.create_task(run())
+
+# Выполняющиеся выгрузки по пути файла (повторная команда не запускает вторую такую же)
+running_exports = {}
+
+def parse_export_args(args):
+    """Разбирает аргументы /export: даты, формат, page=название, manager=ID записи менеджера"""
+    dates = []
+    options = {'fmt': 'csv', 'page': None, 'manager': None}
+    for arg in args:
+        key, _, value = arg.partition('=')
+        if value and key in ('page', 'manager'):
+            options[key] = value.replace('_', ' ') if key == 'page' else value
+        elif arg.lower() in FORMATS:
+            options['fmt'] = arg.lower()
+        else:
+            dates.append(datetime.strptime(arg, "%d.%m.%Y").date())
+    today = datetime.now().date()
+    if len(dates) > 2:
+        raise ValueError("Too many dates")
+    # Без дат — текущий месяц, с одной датой — от нее по сегодня
+    start = dates[0] if dates else today.replace(day=1)
+    end = dates[1] if len(dates) == 2 else today
+    if start > end:
+        raise ValueError("Start date is after end date")
+    return start, end, options
+
+@instrument_handler
+async def handle_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выгрузка "Кассы" для бухгалтерии: /export [с] [по] [csv|jsonl] [page=...] [manager=...]"""
     try:
-        amount = float(text)
-        context.user_data['amount'] = amount
-        
-        # Создаем клавиатуру с кнопкой "Сегодня" и навигацией
-        keyboard = [
-            [KeyboardButton("📅 Сегодня")],
-            [KeyboardButton("⬅️ Назад")],
-            [KeyboardButton("🏠 В главное меню")]
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        
+        start, end, options = parse_export_args(context.args or [])
+    except ValueError:
         await update.message.reply_text(
-            "Введите дату в формате ДД.ММ.ГГГГ или нажмите 'Сегодня':",
-            reply_markup=reply_markup
+            "Использование: /export ДД.ММ.ГГГГ ДД.ММ.ГГГГ [csv|jsonl] [page=Страница] [manager=ID]\n"
+            "Без дат — текущий месяц. Пробелы в названии страницы замените на _."
         )
-        return CASH_FLOW_ENTER_DATE
-    except ValueError:
+        return
+
+    for tenant in tenants:
+        if update.effective_user.id not in tenant.manager_chat_ids:
+            continue
+        pages, _ = tenant.page_cache.lookup(tenant.operator_directory.all_page_ids())
+        page_id = None
+        if options['page']:
+            page_id = next((page_id for name, page_id in pages.items()
+                            if name.lower() == options['page'].lower()), None)
+            if not page_id:
+                await update.message.reply_text(f"Страница «{options['page']}» не найдена.")
+                continue
+
+        export = CashExport(
+            tenant.cash_table, EXPORT_DIR, start, end,
+            fmt=options['fmt'], page_id=page_id, manager_id=options['manager'],
+            page_names={page_id: name for name, page_id in pages.items()},
+            prefix='cash' if tenant is tenants.default else f"cash-{tenant.name}"
+        )
+        if export.path in running_exports:
+            await update.message.reply_text("⏳ Такая выгрузка уже выполняется.")
+            continue
+        running_exports[export.path] = export
         await update.message.reply_text(
-            "Пожалуйста, введите корректное число."
+            f"⏳ Выгрузка кассы за {start.strftime('%d.%m.%Y')}–{end.strftime('%d.%m.%Y')} запущена"
         )
-        return CASH_FLOW_ENTER_AMOUNT
+        # Не через application.create_task: остановка бота не должна ждать конца длинной выгрузки
+        asyncio.get_running_loop().create_task(send_export(update, export))
 
-async def handle_cash_flow_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик ввода даты"""
-    text = update.message.text
-    
-    if text == "⬅️ Назад" or text == "🏠 В главное меню":
-        return await handle_navigation(update, context)
-    
+async def send_export(update, export):
+    """Выполняет выгрузку в потоке и отправляет файл"""
     try:
-        # Получаем дату
-        if text == "📅 Сегодня":
-            date = datetime.now().strftime("%Y-%m-%d")
-        else:
-            try:
-                # Преобразуем дату из формата ДД.ММ.ГГГГ в ГГГГ-ММ-ДД
-                parsed_date = datetime.strptime(text, "%d.%m.%Y")
-                date = parsed_date.strftime("%Y-%m-%d")
-            except ValueError:
-                await update.message.reply_text(
-                    "Пожалуйста, введите дату в формате ДД.ММ.ГГГГ или нажмите 'Сегодня'",
-                    reply_markup=ReplyKeyboardMarkup([
-                        [KeyboardButton("📅 Сегодня")],
-                        [KeyboardButton("⬅️ Назад")],
-                        [KeyboardButton("🏠 В главное меню")]
-                    ], resize_keyboard=True)
-                )
-                return CASH_FLOW_ENTER_DATE
-        
-        # Получаем все необходимые данные из контекста
-        operator_id = context.user_data.get('operator_id')
-        operator_name = context.user_data.get('operator_name')
-        page_name = context.user_data.get('selected_page')
-        page_id = context.user_data.get('page_names', {}).get(page_name)
-        shift = context.user_data.get('selected_shift')
-        operation_type = context.user_data.get('operation_type')
-        display_operation_type = context.user_data.get('display_operation_type')
-        amount = float(context.user_data.get('amount', 0))
-
-        logger.info(f"Context data before creating record:")
-        logger.info(f"operator_id: {operator_id}")
-        logger.info(f"operator_name: {operator_name}")
-        logger.info(f"page_name: {page_name}")
-        logger.info(f"page_id: {page_id}")
-        logger.info(f"shift: {shift}")
-        logger.info(f"operation_type: {operation_type}")
-        logger.info(f"display_operation_type: {display_operation_type}")
-        logger.info(f"amount: {amount}")
-        logger.info(f"date: {date}")
-        
-        # Проверяем наличие всех необходимых данных
-        if not all([operator_id, operator_name, page_id, shift, operation_type, amount, date]):
-            missing_fields = []
-            if not operator_id: missing_fields.append("ID оператора")
-            if not operator_name: missing_fields.append("Имя оператора")
-            if not page_id: missing_fields.append("ID страницы")
-            if not shift: missing_fields.append("Смена")
-            if not operation_type: missing_fields.append("Тип операции")
-            if not amount: missing_fields.append("Сумма")
-            if not date: missing_fields.append("Дата")
-            
-            logger.error(f"Missing required fields: {', '.join(missing_fields)}")
-            await update.message.reply_text(
-                f"Не удалось создать запись. Отсутствуют необходимые данные: {', '.join(missing_fields)}. Начните заново.",
-                reply_markup=create_main_keyboard()
-            )
-            return MENU
-        
-        # Создаем запись в Airtable
-        record = {
-            "ID": str(operator_id),
-            "Name": operator_name,
-            "Касса": amount,
-            "Страница": [page_id],
-            "Смена": shift,
-            "Date": date,
-            "Тип": operation_type,
-            "Менеджер": [context.user_data['manager']] if context.user_data.get('manager') else None
-        }
-        
-        logger.info(f"Creating record with data: {record}")
-        
-        try:
-            # Создаем запись
-            result = cash_table.create(record)
-            logger.info(f"Record created successfully: {result}")
-            
-            # Отправляем сообщение об успехе
-            await update.message.reply_text(
-                f"✅ Запись успешно создана!\n\n"
-                f"📄 Страница: {page_name}\n"
-                f"⏰ Смена: {shift}\n"
-                f"📝 Тип: {operation_type}\n"
-                f"💵 Сумма: {amount}\n"
-                f"📅 Дата: {text}",
-                reply_markup=create_main_keyboard()
-            )
-            return MENU
-        except Exception as e:
-            logger.error(f"Error creating record in Airtable: {str(e)}")
-            await update.message.reply_text(
-                "Не удалось создать запись в базе данных. Пожалуйста, попробуйте еще раз или обратитесь к менеджеру.",
-                reply_markup=create_main_keyboard()
-            )
-            return MENU
-            
+        path, count = await asyncio.to_thread(export.run)
+    except ExportCancelled as e:
+        logger.info(str(e))
+        return
     except Exception as e:
-        logger.error(f"Error in handle_cash_flow_date: {str(e)}")
+        logger.error(f"Error exporting {export.path}: {str(e)}")
         await update.message.reply_text(
-            "Произошла ошибка при обработке даты. Пожалуйста, попробуйте еще раз.",
-            reply_markup=create_main_keyboard()
+            "❌ Выгрузка прервана. Повторите команду — она продолжится с места остановки."
         )
-        return MENU
+        return
+    finally:
+        running_exports.pop(export.path, None)
+
+    if os.path.getsize(path) > EXPORT_MAX_FILE_SIZE:
+        await update.message.reply_text(
+            f"✅ Выгружено записей: {count}. Файл слишком большой для Telegram и сохранен на сервере: {path}"
+        )
+        return
+    with open(path, 'rb') as f:
+        await update.message.reply_document(f, filename=os.path.basename(path), caption=f"✅ Записей: {count}")
+
+def parse_days(text):
+    """Разбирает дни месяца вида "5", "1, 3, 7" или "1-15"; возвращает отсортированный список или None"""
+    days = set()
+    for part in text.replace(" ", "").split(","):
+        try:
+            if "-" in part:
+                first, last = (int(value) for value in part.split("-", 1))
+            else:
+                first = last = int(part)
+        except ValueError:
+            return None
+        if not 1 <= first <= last <= 31:
+            return None
+        days.update(range(first, last + 1))
+    return sorted(days)
+
+def format_days(days):
+    """Форматирует список дней, сворачивая подряд идущие в диапазоны: 1-5, 8"""
+    ranges = []
+    for day in days:
+        if ranges and ranges[-1][1] == day - 1:
+            ranges[-1][1] = day
+        else:
+            ranges.append([day, day])
+    return ", ".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
 
+@instrument_handler
 async def handle_schedule_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик выбора даты для графика"""
     text = update.message.text
     
-    if text == "⬅️ Назад" or text == "🏠 В главное меню":
-        return await handle_navigation(update, context)
+    if text in NAVIGATION_BUTTONS:
+        return await handle_navigation(update, context, SCHEDULE_SELECT_DATE)
     
-    try:
-        day = int(text)
-        if 1 <= day <= 31:
-            context.user_data['selected_date'] = day
-            
-            # Создаем клавиатуру с вариантами смен, статуса и навигацией
-            keyboard = [
-                [KeyboardButton("00-08"), KeyboardButton("08-16")],
-                [KeyboardButton("16-00"), KeyboardButton("00-06")],
-                [KeyboardButton("06-12"), KeyboardButton("12-18")],
-                [KeyboardButton("18-00")],
-                [KeyboardButton("🏖️ Выходной")],
-                [KeyboardButton("🔄 Замена")],
-                [KeyboardButton("⬅️ Назад")],
-                [KeyboardButton("🏠 В главное меню")]
-            ]
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            
-            await update.message.reply_text(
-                f"Выберите статус для {day} числа:",
-                reply_markup=reply_markup
-            )
-            return SCHEDULE_SELECT_SHIFT
-        else:
-            await update.message.reply_text(
-                "Пожалуйста, введите число от 1 до 31",
-                reply_markup=ReplyKeyboardMarkup([
-                    [KeyboardButton("⬅️ Назад")],
-                    [KeyboardButton("🏠 В главное меню")]
-                ], resize_keyboard=True)
-            )
-            return SCHEDULE_SELECT_DATE
-    except ValueError:
+    days = parse_days(text)
+    if days:
+        context.user_data['selected_dates'] = days
+        
+        await update.message.reply_text(
+            f"Выберите статус для {format_days(days)} числа:",
+            reply_markup=SCHEDULE_STATUS_KEYBOARD
+        )
+        return SCHEDULE_SELECT_SHIFT
+    else:
         await update.message.reply_text(
-            "Пожалуйста, введите корректное число от 1 до 31",
-            reply_markup=ReplyKeyboardMarkup([
-                [KeyboardButton("⬅️ Назад")],
-                [KeyboardButton("🏠 В главное меню")]
-            ], resize_keyboard=True)
+            "Пожалуйста, введите число от 1 до 31, несколько чисел через запятую "
+            "или диапазон (например: 5, 7-10)",
+            reply_markup=NAVIGATION_KEYBOARD
         )
         return SCHEDULE_SELECT_DATE
 
+@instrument_handler
 async def handle_schedule_shift(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик выбора статуса для графика"""
     text = update.message.text
     
-    if text == "⬅️ Назад" or text == "🏠 В главное меню":
-        return await handle_navigation(update, context)
+    if text in NAVIGATION_BUTTONS:
+        return await handle_navigation(update, context, SCHEDULE_SELECT_SHIFT)
     
     text = text.replace("🏖️ ", "").replace("🔄 ", "")
     
     operator_id = context.user_data['operator_id']
-    day = context.user_data['selected_date']
+    days = context.user_data['selected_dates']
     
     # Находим запись в графике для данного оператора
-    schedule_records = schedule_table.all(
-        formula=f"{{ID}}='{operator_id}'"
-    )
+    tenant = current_tenant(context)
+    record_id = tenant.schedule_index.find(operator_id)
+    if not record_id:
+        try:
+            record_id = await tenant.storage.run_shared(
+                ('schedule_record', operator_id), tenant.schedule_index.get, operator_id
+            )
+        except CircuitOpenError:
+            await update.message.reply_text(UNAVAILABLE_TEXT, reply_markup=MAIN_KEYBOARD)
+            return MENU
     
-    if schedule_records:
-        record = schedule_records[0]
-        # Обновляем поле с номером дня
-        schedule_table.update(record['id'], {
-            str(day): text
-        })
+    if record_id:
+        # Обновляем поля с номерами дней (изменения за несколько секунд уходят одним запросом)
+        changes = {str(day): text for day in days}
+        tenant.schedule_updates.add(record_id, changes)
+        tenant.replica_sync.patch(SCHEDULE_TABLE, record_id, changes)
         
+        if len(days) == 1:
+            details = f"📅 День {days[0]}: установлен статус '{text}'"
+        else:
+            details = f"📅 Дни {format_days(days)}: установлен статус '{text}'"
         await update.message.reply_text(
-            f"✅ График успешно обновлен!\n📅 День {day}: установлен статус '{text}'",
-            reply_markup=create_main_keyboard()
+            f"✅ График успешно обновлен!\n{details}{pending_sync_note(tenant)}",
+            reply_markup=MAIN_KEYBOARD
         )
     else:
         await update.message.reply_text(
             "❌ Не удалось найти вашу запись в графике. Обратитесь к менеджеру.",
-            reply_markup=create_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
     
     return MENU
 
-async def handle_navigation(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик навигации (Назад/В главное меню)"""
-    text = update.message.text
-    
-    if text == "🏠 В главное меню":
-        await update.message.reply_text(
-            "Выберите действие:",
-            reply_markup=create_main_keyboard()
-        )
-        return MENU
-    elif text == "⬅️ Назад":
-        # Определяем текущее состояние и возвращаемся на шаг назад
-        current_state = context.user_data.get('state', MENU)
-        if current_state == CASH_FLOW_ENTER_DATE:
-            return await handle_cash_flow_type(update, context)
-        elif current_state == CASH_FLOW_ENTER_AMOUNT:
-            return await handle_cash_flow_shift(update, context)
-        elif current_state == CASH_FLOW_SELECT_TYPE:
-            return await handle_cash_flow_page(update, context)
-        elif current_state == CASH_FLOW_SELECT_SHIFT:
-            return await handle_menu(update, context)
-        elif current_state == CASH_FLOW_SELECT_PAGE:
-            return await handle_menu(update, context)
-        elif current_state == SCHEDULE_SELECT_SHIFT:
-            return await handle_schedule_date(update, context)
-        elif current_state == SCHEDULE_SELECT_DATE:
-            return await handle_menu(update, context)
-    
+async def ask_schedule_days(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Первый шаг графика: ввод дней"""
+    await update.message.reply_text(
+        "Введите число месяца (1-31), несколько через запятую или диапазон (например: 1-15):",
+        reply_markup=NAVIGATION_KEYBOARD
+    )
+    return SCHEDULE_SELECT_DATE
+
+# Куда ведет "Назад" из шагов графика (остальные шаги возвращают в главное меню)
+BACK_STEPS = {
+    SCHEDULE_SELECT_SHIFT: ask_schedule_days,
+}
+
+@instrument_handler
+async def handle_navigation(update: Update, context: ContextTypes.DEFAULT_TYPE, state=MENU):
+    """Обработчик навигации (Назад/В главное меню) из шага state"""
+    if update.message.text == BACK_BUTTON and state in BACK_STEPS:
+        return await BACK_STEPS[state](update, context)
+    await update.message.reply_text(
+        "Выберите действие:",
+        reply_markup=MAIN_KEYBOARD
+    )
     return MENU
 
-def main():
-    """Основная функция запуска бота"""
-    # Получаем токен бота из переменных окружения
-    token = os.getenv('TELEGRAM_BOT_TOKEN')
-    
-    # Создаем приложение
-    application = Application.builder().token(token).build()
+async def start_background_tasks(application: Application):
+    """Запускает фоновые задачи после инициализации приложения"""
+    for tenant in tenants:
+        tenant.write_queue.start(application)
+        tenant.schedule_updates.start(application)
+    if REMINDERS_ENABLED:
+        if application.job_queue:
+            for tenant in tenants:
+                tenant.reminders.start(application.job_queue)
+        else:
+            logger.warning("JobQueue is not available, install python-telegram-bot[job-queue] to enable reminders")
+    if METRICS_PORT:
+        await service_server.start()
+    for tenant in tenants:
+        # Обработчики в режиме SHARD_WORKERS только перечитывают копию, уведомления им не нужны
+        if tenant.change_receiver and not tenant.replica_sync.following:
+            tenant.change_receiver.start()
+
+async def shutdown_storage(application: Application):
+    """Останавливает фоновые задачи и пул потоков Airtable"""
+    for tenant in tenants:
+        tenant.replica_sync.stop()
+        if tenant.change_receiver:
+            tenant.change_receiver.stop()
+    # Выгрузки останавливаются после текущей страницы и продолжатся при повторной команде
+    for export in list(running_exports.values()):
+        export.cancel()
+    await service_server.stop()
+    for tenant in tenants:
+        # Неотправленные изменения графика останутся в файле очереди до следующего запуска
+        await tenant.schedule_updates.flush()
+        tenant.schedule_updates.stop()
+        await tenant.write_queue.stop()
+        tenant.storage.shutdown()
+
+def application_builder(token):
+    builder = Application.builder().token(token)
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_BASE_URL.rstrip('/')}/bot")
+    return builder
+
+def build_application(token):
+    """Создает приложение с обработчиком разговора (без запуска)"""
+    persistence = create_persistence(PERSISTENCE_BACKEND, PERSISTENCE_PATH, PERSISTENCE_UPDATE_INTERVAL)
+    builder = (
+        application_builder(token)
+        .concurrent_updates(PerChatUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(start_background_tasks)
+        .post_shutdown(shutdown_storage)
+    )
+    if persistence:
+        builder = builder.persistence(persistence)
+    application = builder.build()
     
+    # Форма кассы одна на пользователя, поэтому разговор ведется по чату, а не по сообщению
+    warnings.filterwarnings('ignore', message=r".*'CallbackQueryHandler' will not be tracked", category=PTBUserWarning)
+    # "/итоги" не команда для Telegram (кириллица), поэтому исключаем ее из текстового ввода
+    # во всех шагах и обрабатываем как команду: в точках входа и в fallbacks
+    totals_command = filters.Regex(r'^/итоги')
+    text_input = filters.TEXT & ~filters.COMMAND & ~totals_command
     # Создаем обработчик разговора
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
+        entry_points=[
+            CommandHandler('start', start), CommandHandler('totals', handle_totals),
+            MessageHandler(totals_command, handle_totals),
+        ],
         states={
-            MENU: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_menu)],
-            CASH_FLOW_SELECT_PAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_cash_flow_page)],
-            CASH_FLOW_SELECT_SHIFT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_cash_flow_shift)],
-            CASH_FLOW_SELECT_TYPE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_cash_flow_type)],
-            CASH_FLOW_ENTER_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_cash_flow_amount)],
-            CASH_FLOW_ENTER_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_cash_flow_date)],
-            SCHEDULE_SELECT_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_schedule_date)],
-            SCHEDULE_SELECT_SHIFT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_schedule_shift)],
+            MENU: [MessageHandler(text_input, handle_menu)],
+            CASH_FORM: [
+                CallbackQueryHandler(handle_cash_form_callback, pattern=f'^{CASH_FORM_PREFIX}:'),
+                MessageHandler(text_input, handle_cash_form_text),
+            ],
+            **{state: [MessageHandler(text_input, handle_menu)] for state in LEGACY_CASH_FLOW_STATES},
+            SCHEDULE_SELECT_DATE: [MessageHandler(text_input, handle_schedule_date)],
+            SCHEDULE_SELECT_SHIFT: [MessageHandler(text_input, handle_schedule_shift)],
+            CASH_BULK_ENTER: [
+                MessageHandler(text_input | filters.Document.ALL, handle_cash_bulk)
+            ],
         },
-        fallbacks=[CommandHandler('start', start)]
+        fallbacks=[
+            CommandHandler('start', start), CommandHandler('totals', handle_totals),
+            MessageHandler(totals_command, handle_totals),
+        ],
+        name='main',
+        persistent=persistence is not None
     )
     
     # Добавляем обработчик разговора в приложение
     application.add_handler(conv_handler)
+    # Кнопки форм, которые разговор уже не ждет (форма закрыта или заменена новой)
+    application.add_handler(CallbackQueryHandler(handle_stale_cash_form, pattern=f'^{CASH_FORM_PREFIX}:'))
+    if MANAGER_CHAT_IDS:
+        managers = filters.User(user_id=MANAGER_CHAT_IDS)
+        application.add_handler(CommandHandler('broadcast', handle_broadcast, filters=managers))
+        application.add_handler(CommandHandler('team', handle_team_schedule, filters=managers))
+        application.add_handler(CommandHandler('export', handle_export, filters=managers))
+    return application
+
+def validate_config():
+    """Проверяет настройки до запуска; возвращает список ошибок"""
+    errors = []
+    if not os.getenv('TELEGRAM_BOT_TOKEN'):
+        errors.append("TELEGRAM_BOT_TOKEN is not set")
+    for tenant in tenants:
+        if not tenant_setting(tenant.name, 'AIRTABLE_API_KEY'):
+            errors.append(f"AIRTABLE_API_KEY is not set for base {tenant.name}")
+    if BOT_MODE not in ('polling', 'webhook'):
+        errors.append(f"Unknown BOT_MODE: {BOT_MODE} (expected polling or webhook)")
+    elif BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        errors.append("WEBHOOK_URL is required in webhook mode")
+    if PERSISTENCE_BACKEND not in ('sqlite', 'pickle', 'none'):
+        errors.append(f"Unknown PERSISTENCE_BACKEND: {PERSISTENCE_BACKEND} (expected sqlite, pickle or none)")
+    elif SHARD_WORKERS > 1 and PERSISTENCE_BACKEND == 'pickle':
+        errors.append("Pickle persistence cannot be shared between shard workers, use sqlite")
+    if AIRTABLE_RATE_LIMIT <= 0:
+        errors.append("AIRTABLE_RATE_LIMIT must be positive")
+    if AIRTABLE_WEBHOOK_URL and not METRICS_PORT:
+        errors.append("AIRTABLE_WEBHOOK_URL requires the service HTTP server (METRICS_PORT)")
+    if AIRTABLE_WEBHOOK_URL and SHARD_WORKERS > 1:
+        # Вебхук регистрируется только в одном процессе, а в режиме шардов его некому продлевать
+        errors.append("AIRTABLE_WEBHOOK_URL is not supported with SHARD_WORKERS > 1, unset it to use polling")
+    return errors
+
+def restore_caches():
+    """Заполняет кэши и итоги из локальной копии и неотправленных записей очереди"""
+    started = time.perf_counter()
+    for tenant in tenants:
+        try:
+            tenant.replica_sync.restore()
+        except Exception as e:
+            logger.error(f"Error restoring replica of {tenant.name}: {str(e)}")
+        for key, fields in tenant.write_queue.pending(CASH_TABLE).items():
+            tenant.cash_reports.add_local(key, fields)
+    cold = [tenant.name for tenant in tenants if not tenant.operator_directory.loaded]
+    logger.info(
+        f"Caches restored in {time.perf_counter() - started:.2f}s: "
+        f"{'cold, waiting for the first sync: ' + ', '.join(cold) if cold else 'warm'}"
+    )
+
+def adopt_orphan_queues(active):
+    """Переносит в основные очереди записи обработчиков с номером >= active
+
+    После уменьшения SHARD_WORKERS (или возврата к одному процессу) их файлы никто не отправляет,
+    а операторам уже ответили, что записи сохранены. Вызывается до запуска обработчиков.
+    """
+    root, ext = os.path.splitext(WRITE_QUEUE_PATH)
+    for tenant in tenants:
+        suffix = '' if tenant is tenants.default else f"-{tenant.name}"
+        pattern = re.compile(re.escape(root) + r'-(\d+)' + re.escape(suffix + ext) + '$')
+        for path in sorted(glob.glob(f"{glob.escape(root)}-*{ext}")):
+            match = pattern.match(path)
+            if not match or int(match.group(1)) < active:
+                continue
+            try:
+                count = tenant.write_queue.absorb(path) + tenant.schedule_updates.absorb(path)
+                # Записи уже в основной очереди; повторный перенос после сбоя не создаст дублей
+                remove_database(path)
+                if count:
+                    logger.warning(f"Moved {count} queued records of a stopped shard worker from {path} to {tenant.name}")
+            except Exception as e:
+                logger.error(f"Error moving queued records from {path}: {str(e)}")
+
+def shard_environment(index):
+    """Окружение процесса-обработчика: своя очередь записей, порт метрик и доля лимита Airtable"""
+    root, ext = os.path.splitext(WRITE_QUEUE_PATH)
+    return {
+        'SHARD_WORKERS': '0',
+        # Напоминания отправляет только первый обработчик, у каждого из них полные кэши
+        'REMINDERS_ENABLED': '1' if REMINDERS_ENABLED and index == 0 else '0',
+        # Первый обработчик использует основной файл и досылает записи, оставшиеся от обычного режима
+        'WRITE_QUEUE_PATH': f"{root}-{index}{ext}" if index else WRITE_QUEUE_PATH,
+        'METRICS_PORT': str(METRICS_PORT + index) if METRICS_PORT else '0',
+        # Лимит делится между обработчиками и супервизором, который синхронизирует копию
+        'AIRTABLE_RATE_LIMIT': str(AIRTABLE_RATE_LIMIT / (SHARD_WORKERS + 1)),
+    }
+
+def run_shard(index, updates):
+    """Точка входа процесса-обработчика в режиме SHARD_WORKERS"""
+    application = build_application(os.getenv('TELEGRAM_BOT_TOKEN'))
+    # Копию синхронизирует супервизор, обработчик только перечитывает ее
+    restore_caches()
+    for tenant in tenants:
+        tenant.replica_sync.start(follow=True)
+    run_worker(application, updates)
+
+def main():
+    """Основная функция запуска бота"""
+    # Проверяем настройки до создания приложения и клиентов
+    errors = validate_config()
+    if errors:
+        for error in errors:
+            logger.error(f"Configuration error: {error}")
+        raise SystemExit(1)
+
+    # Получаем токен бота из переменных окружения
+    token = os.getenv('TELEGRAM_BOT_TOKEN')
+    
+    # Создаем приложение: обработчик разговоров или диспетчер для процессов-обработчиков
+    if SHARD_WORKERS > 1:
+        supervisor = ShardSupervisor(run_shard, SHARD_WORKERS, environment=shard_environment)
+        application = build_dispatcher(application_builder(token), supervisor)
+    else:
+        application = build_application(token)
+    
+    # Записи обработчиков, которых больше нет, отправит основная очередь (обработчик 0 или этот процесс)
+    adopt_orphan_queues(SHARD_WORKERS if SHARD_WORKERS > 1 else 1)
+
+    # Заполняем кэши из локальной копии (бот отвечает сразу) и обновляем их из Airtable в фоне
+    restore_caches()
+    for tenant in tenants:
+        tenant.replica_sync.start()
     
     # Запускаем бота
-    application.run_polling()
+    run_application(
+        application,
+        mode=BOT_MODE,
+        webhook_url=WEBHOOK_URL,
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET
+    )
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
@@ -0,0 +1,121 @@
+import csv
+import io
+import math
+from datetime import datetime
+
+# Ограничения пакетного ввода
+MAX_ROWS = 200
+MAX_FILE_SIZE = 256 * 1024
+
+# Первая строка CSV с такими значениями считается заголовком
+HEADER_CELLS = ('страница', 'page')
+
+
+def split_rows(text):
+    """Разбивает сообщение на строки полей; разделитель ";", табуляция или ","
+
+    Запятая используется как разделитель, только если в тексте нет ";" и табуляций,
+    поэтому суммы с десятичной запятой нужно писать через ";".
+    """
+    if ';' in text:
+        delimiter = ';'
+    elif '\t' in text:
+        delimiter = '\t'
+    else:
+        delimiter = ','
+    lines = [line for line in text.splitlines() if line.strip()]
+    return list(csv.reader(lines, delimiter=delimiter))
+
+
+def read_csv(data):
+    """Читает загруженный CSV-файл (UTF-8 или Windows-1251) в строки полей"""
+    for encoding in ('utf-8-sig', 'cp1251'):
+        try:
+            text = data.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        raise ValueError("Unsupported file encoding")
+    first_line = text.split('\n', 1)[0]
+    delimiter = ';' if ';' in first_line else '\t' if '\t' in first_line else ','
+    return [row for row in csv.reader(io.StringIO(text), delimiter=delimiter) if any(cell.strip() for cell in row)]
+
+
+def parse_amount(text):
+    """Сумма: допускаются пробелы между разрядами и десятичная запятая"""
+    amount = float(text.replace(' ', '').replace('\xa0', '').replace(',', '.'))
+    # float() принимает и "inf", "nan", "1e400" — такие суммы Airtable отклонит
+    if not math.isfinite(amount) or amount <= 0:
+        raise ValueError("Amount must be a positive number")
+    return amount
+
+
+def parse_date(text, today):
+    """Дата ДД.ММ.ГГГГ, ДД.ММ.ГГ или ДД.ММ (текущий год); пусто или "сегодня" — today"""
+    text = text.strip()
+    if not text or text.lower() == 'сегодня':
+        return today
+    for fmt in ('%d.%m.%Y', '%d.%m.%y'):
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            pass
+    return datetime.strptime(f"{text}.{today.year}", '%d.%m.%Y').date()
+
+
+def parse_entries(rows, pages, shifts, operation_types, today=None):
+    """Проверяет строки "Страница; Смена; Тип; Сумма; Дата" по кэшу страниц и справочникам
+
+    Возвращает (записи, ошибки); записи — словари с page, page_id, shift, type, amount, date.
+    """
+    today = today or datetime.now().date()
+    pages_by_name = {name.strip().lower(): (name, page_id) for name, page_id in pages.items()}
+    types_by_name = {name.lower(): name for name in operation_types}
+
+    first = 1
+    if rows and rows[0] and rows[0][0].strip().lower() in HEADER_CELLS:
+        rows = rows[1:]
+        first = 2
+    if len(rows) > MAX_ROWS:
+        return [], [f"Слишком много строк: {len(rows)} (не больше {MAX_ROWS})"]
+
+    entries = []
+    errors = []
+    for number, row in enumerate(rows, first):
+        cells = [cell.strip() for cell in row]
+        if len(cells) not in (4, 5):
+            errors.append(f"Строка {number}: нужно 4 или 5 полей, получено {len(cells)}")
+            continue
+        page, shift, operation_type, amount = cells[:4]
+        date = cells[4] if len(cells) == 5 else ''
+
+        problems = []
+        page_entry = pages_by_name.get(page.lower())
+        if page_entry is None:
+            problems.append(f"неизвестная страница «{page}»")
+        if shift not in shifts:
+            problems.append(f"неизвестная смена «{shift}»")
+        if operation_type.lower() not in types_by_name:
+            problems.append(f"неизвестный тип «{operation_type}»")
+        try:
+            amount = parse_amount(amount)
+        except ValueError:
+            problems.append(f"некорректная сумма «{amount}»")
+        try:
+            date = parse_date(date, today)
+        except ValueError:
+            problems.append(f"некорректная дата «{date}»")
+
+        if problems:
+            errors.append(f"Строка {number}: {', '.join(problems)}")
+            continue
+        entries.append({
+            'page': page_entry[0],
+            'page_id': page_entry[1],
+            'shift': shift,
+            'type': types_by_name[operation_type.lower()],
+            'amount': amount,
+            'date': date.strftime("%Y-%m-%d"),
+        })
+    return entries, errors
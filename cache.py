@@ -0,0 +1,249 @@
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from metrics import record_lookup
+from replica import modified_since
+
+logger = logging.getLogger(__name__)
+
+
+class OperatorDirectory:
+    """Справочник операторов в памяти с индексами по TG ID и ID оператора"""
+
+    def __init__(self, table, miss_refresh_interval=10):
+        self.table = table
+        self.miss_refresh_interval = miss_refresh_interval
+
+        self._records = {}
+        self._by_tg_id = {}
+        self._by_id = {}
+        self._loaded = False
+        self._cursor = None
+        self._last_refresh = 0.0
+        self._refresh_lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def refresh(self, full=False, max_age=None):
+        """Обновляет справочник из Airtable: полная загрузка или только измененные записи
+
+        С max_age загрузка пропускается (возвращается False), если справочник уже загружен и
+        обновлялся не раньше max_age секунд назад — например, другим потоком, пока этот ждал блокировку.
+        """
+        with self._refresh_lock:
+            if max_age is not None and self._loaded and time.monotonic() - self._last_refresh < max_age:
+                return False
+            started = datetime.now(timezone.utc)
+            if full or self._cursor is None:
+                self.apply(self.table.all(), full=True, cursor=started)
+            else:
+                self.apply(self.table.all(formula=modified_since(self._cursor)), cursor=started)
+            return True
+
+    def apply(self, records, full=False, cursor=None):
+        """Применяет загруженные записи: полную выборку или только изменения"""
+        merged = {} if full else dict(self._records)
+        for record in records:
+            merged[record['id']] = record
+        self._index(merged)
+
+        if full:
+            self._loaded = True
+            logger.info(f"Operator directory loaded: {len(merged)} operators")
+        elif records:
+            logger.info(f"Operator directory updated: {len(records)} changed operators")
+        if cursor:
+            self._cursor = cursor
+        self._last_refresh = time.monotonic()
+
+    def _index(self, records):
+        """Перестраивает индексы и атомарно подменяет их"""
+        by_tg_id = {}
+        by_id = {}
+        for record in records.values():
+            fields = record['fields']
+            if fields.get('TG ID'):
+                by_tg_id[str(fields['TG ID'])] = record
+            if fields.get('ID'):
+                by_id[str(fields['ID'])] = record
+
+        self._records = records
+        self._by_tg_id = by_tg_id
+        self._by_id = by_id
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            # Одновременные первые запросы ждут одну полную загрузку
+            self.refresh(full=True, max_age=float('inf'))
+
+    def _refresh_on_miss(self):
+        """Дозагружает изменения при промахе (например, только что добавленный оператор)"""
+        if time.monotonic() - self._last_refresh < self.miss_refresh_interval:
+            return False
+        # Справочник мог обновить другой поток, пока этот ждал блокировку: все равно ищем заново
+        self.refresh(max_age=self.miss_refresh_interval)
+        return True
+
+    def find_by_tg_id(self, tg_id):
+        """Ищет оператора по TG ID только в памяти, без обращения к Airtable"""
+        operator = self._by_tg_id.get(str(tg_id))
+        record_lookup('operators', operator is not None)
+        return operator
+
+    def find_by_id(self, operator_id):
+        """Ищет оператора по полю ID только в памяти, без обращения к Airtable"""
+        operator = self._by_id.get(str(operator_id))
+        record_lookup('operators', operator is not None)
+        return operator
+
+    def get_by_tg_id(self, tg_id):
+        """Возвращает запись оператора по TG ID или None"""
+        self.ensure_loaded()
+        operator = self._by_tg_id.get(str(tg_id))
+        if operator is None and self._refresh_on_miss():
+            operator = self._by_tg_id.get(str(tg_id))
+        return operator
+
+    def get_by_id(self, operator_id):
+        """Возвращает запись оператора по полю ID или None"""
+        self.ensure_loaded()
+        operator = self._by_id.get(str(operator_id))
+        if operator is None and self._refresh_on_miss():
+            operator = self._by_id.get(str(operator_id))
+        return operator
+
+    def operators(self):
+        """Все операторы справочника"""
+        return list(self._records.values())
+
+    def all_page_ids(self):
+        """Возвращает ID всех страниц, привязанных к операторам"""
+        page_ids = []
+        for record in self._records.values():
+            page_ids.extend(record['fields'].get('Страница', []))
+        return list(dict.fromkeys(page_ids))
+
+
+class PageNameCache:
+    """Общий для всех пользователей кэш названий страниц по ID записи"""
+
+    def __init__(self, table, ttl=3600, chunk_size=50):
+        self.table = table
+        self.ttl = ttl
+        self.chunk_size = chunk_size
+        self._names = {}
+
+    def lookup(self, page_ids):
+        """Возвращает найденные в кэше страницы {название: ID} и список отсутствующих ID"""
+        pages, missing = self._lookup(page_ids)
+        record_lookup('pages', True, len(page_ids) - len(missing))
+        record_lookup('pages', False, len(missing))
+        return pages, missing
+
+    def _lookup(self, page_ids):
+        now = time.monotonic()
+        pages = {}
+        missing = []
+        for page_id in page_ids:
+            cached = self._names.get(page_id)
+            if cached is None or now - cached[1] > self.ttl:
+                missing.append(page_id)
+            elif cached[0]:
+                pages[cached[0]] = page_id
+        return pages, missing
+
+    def fetch(self, page_ids):
+        """Загружает названия страниц одним запросом RECORD_ID() на каждую пачку ID"""
+        for i in range(0, len(page_ids), self.chunk_size):
+            chunk = page_ids[i:i + self.chunk_size]
+            formula = "OR(" + ",".join(f"RECORD_ID()='{page_id}'" for page_id in chunk) + ")"
+            records = self.table.all(formula=formula, fields=['Name'])
+
+            now = time.monotonic()
+            found = {record['id']: record['fields'].get('Name') for record in records}
+            for page_id in chunk:
+                # Отсутствующие записи тоже кэшируем, чтобы не запрашивать их повторно
+                self._names[page_id] = (found.get(page_id), now)
+
+    def resolve(self, page_ids):
+        """Возвращает страницы {название: ID}, догружая недостающие из Airtable"""
+        pages, missing = self.lookup(page_ids)
+        if missing:
+            self.fetch(missing)
+            pages, missing = self._lookup(page_ids)
+        return pages
+
+    def apply(self, records, full=False, cursor=None):
+        """Применяет записи страниц, полученные синхронизацией"""
+        now = time.monotonic()
+        names = {} if full else dict(self._names)
+        for record in records:
+            names[record['id']] = (record['fields'].get('Name'), now)
+        self._names = names
+
+    def invalidate(self, page_ids=None):
+        if page_ids is None:
+            self._names.clear()
+        else:
+            for page_id in page_ids:
+                self._names.pop(page_id, None)
+
+
+class ScheduleIndex:
+    """Соответствие ID оператора и ID его записи в таблице "График\""""
+
+    def __init__(self, table):
+        self.table = table
+        self._record_ids = {}
+        # Статусы по дням месяца: ID оператора -> {день: статус}
+        self._days = {}
+
+    def load(self):
+        """Загружает соответствие для всех операторов (только поле ID)"""
+        self.apply(self.table.all(fields=['ID']), full=True)
+
+    def apply(self, records, full=False, cursor=None):
+        """Применяет записи графика: полную выборку или только изменения"""
+        record_ids = {} if full else dict(self._record_ids)
+        days = {} if full else dict(self._days)
+        for record in records:
+            if record['fields'].get('ID'):
+                operator_id = str(record['fields']['ID'])
+                record_ids[operator_id] = record['id']
+                days[operator_id] = {int(name): value for name, value in record['fields'].items()
+                                     if name.isdigit() and value}
+        self._record_ids = record_ids
+        self._days = days
+        if full:
+            logger.info(f"Schedule index loaded: {len(record_ids)} records")
+
+    def find(self, operator_id):
+        """Ищет ID записи графика только в памяти"""
+        record_id = self._record_ids.get(str(operator_id))
+        record_lookup('schedule', record_id is not None)
+        return record_id
+
+    def get(self, operator_id):
+        """Возвращает ID записи графика, при промахе запрашивает Airtable"""
+        record_id = self.find(operator_id)
+        if record_id is None:
+            records = self.table.all(formula=f"{{ID}}='{operator_id}'", fields=['ID'], max_records=1)
+            if records:
+                record_id = records[0]['id']
+                self._record_ids[str(operator_id)] = record_id
+        return record_id
+
+    def operator_for(self, record_id):
+        """ID оператора по ID записи графика или None"""
+        return next((operator_id for operator_id, known in self._record_ids.items() if known == record_id), None)
+
+    def days(self, operator_id):
+        """Заполненные дни графика оператора {день: статус} (пусто, если график не загружен)"""
+        return self._days.get(str(operator_id), {})
+
+    def invalidate(self, operator_id):
+        self._record_ids.pop(str(operator_id), None)
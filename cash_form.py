@@ -0,0 +1,176 @@
+from datetime import date, timedelta
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from bulk_entry import parse_amount, parse_date
+from keyboards import OPERATION_TYPES, SHIFTS
+from reports import format_amount
+
+# Префикс данных кнопок формы; callback_data ограничены 64 байтами, поэтому варианты передаются индексами
+PREFIX = 'cf'
+PICK, EDIT, BACK, CANCEL = 'pick', 'edit', 'back', 'cancel'
+
+# Результаты действий с формой
+SUBMIT = 'submit'
+CANCELLED = 'cancelled'
+
+
+def _date_text(value):
+    return date.fromisoformat(value).strftime('%d.%m.%Y')
+
+
+def _date_choices(form):
+    today = date.fromisoformat(form['today'])
+    days = [today - timedelta(days=i) for i in range(3)]
+    labels = ["Сегодня", "Вчера", days[2].strftime('%d.%m')]
+    return [(label, day.isoformat()) for label, day in zip(labels, days)]
+
+
+class Step:
+    """Шаг формы: поле, подпись в сводке, вопрос, варианты кнопками и/или разбор текста"""
+
+    def __init__(self, field, label, prompt, choices=None, columns=1, parse=None, text=str):
+        self.field = field
+        self.label = label
+        self.prompt = prompt
+        self.choices = choices  # form -> [(подпись, значение)]
+        self.columns = columns
+        self.parse = parse  # (form, текст) -> значение; ValueError — неверный ввод
+        self.text = text  # значение -> текст для сводки
+
+    def options(self, form):
+        return self.choices(form) if self.choices else []
+
+
+# Шаги в порядке заполнения; форма открывается на первом незаполненном шаге
+STEPS = [
+    Step('page', "📄 Страница", "Выберите страницу:",
+         choices=lambda form: [(name, name) for name in form['pages']]),
+    Step('shift', "⏰ Смена", "Выберите смену:",
+         choices=lambda form: [(shift, shift) for shift in SHIFTS], columns=2),
+    Step('type', "📝 Тип", "Выберите тип операции:",
+         choices=lambda form: [(name, name) for name in OPERATION_TYPES], columns=3),
+    Step('date', "📅 Дата", "Выберите дату или отправьте ее в формате ДД.ММ.ГГГГ:",
+         choices=_date_choices, columns=3, text=_date_text,
+         parse=lambda form, text: parse_date(text, date.fromisoformat(form['today'])).isoformat()),
+    Step('amount', "💵 Сумма", "Введите сумму:",
+         parse=lambda form, text: parse_amount(text), text=format_amount),
+]
+STEPS_BY_FIELD = {step.field: step for step in STEPS}
+
+
+def new_cash_form(pages, defaults, today):
+    """Новая форма: последние страница и смена оператора и сегодняшняя дата уже выбраны"""
+    values = {'date': today.isoformat()}
+    if defaults.get('page') in pages:
+        values['page'] = defaults['page']
+    if defaults.get('shift') in SHIFTS:
+        values['shift'] = defaults['shift']
+    form = {'pages': list(pages), 'today': today.isoformat(), 'values': values,
+            'history': [], 'step': None, 'error': None, 'message_id': None}
+    form['step'] = next_step(form)
+    return form
+
+
+def next_step(form):
+    """Первый незаполненный шаг или None, если форма заполнена"""
+    return next((step.field for step in STEPS if step.field not in form['values']), None)
+
+
+def callback_data(action, argument=''):
+    return f"{PREFIX}:{action}:{argument}"
+
+
+def _advance(form, value):
+    form['values'][form['step']] = value
+    form['history'].append(form['step'])
+    form['step'] = next_step(form)
+    return SUBMIT if form['step'] is None else None
+
+
+def _back(form):
+    """Шаг назад: к предыдущему показанному шагу, иначе к предыдущему по порядку"""
+    if form['history']:
+        form['step'] = form['history'].pop()
+        return None
+    index = [step.field for step in STEPS].index(form['step'])
+    if index == 0:
+        return CANCELLED
+    form['step'] = STEPS[index - 1].field
+    return None
+
+
+def apply_callback(form, data):
+    """Обрабатывает нажатие кнопки формы; возвращает SUBMIT, CANCELLED или None (показать форму)"""
+    form['error'] = None
+    _, action, argument = data.split(':', 2)
+    if action == CANCEL:
+        return CANCELLED
+    if action == BACK:
+        return _back(form)
+    if action == EDIT and argument in STEPS_BY_FIELD:
+        form['history'].append(form['step'])
+        form['step'] = argument
+        return None
+    if action == PICK:
+        field, _, index = argument.partition('.')
+        # Кнопка со старого шага (например, двойное нажатие) — просто показываем текущий шаг
+        if field != form['step']:
+            return None
+        options = STEPS_BY_FIELD[field].options(form)
+        try:
+            return _advance(form, options[int(index)][1])
+        except (ValueError, IndexError):
+            form['error'] = "Выберите вариант кнопкой."
+    return None
+
+
+def apply_text(form, text):
+    """Обрабатывает текстовый ответ на текущий шаг (сумма, дата или подпись варианта)"""
+    form['error'] = None
+    step = STEPS_BY_FIELD[form['step']]
+    text = text.strip()
+    for label, value in step.options(form):
+        if label.lower() == text.lower():
+            return _advance(form, value)
+    if step.parse:
+        try:
+            return _advance(form, step.parse(form, text))
+        except ValueError:
+            form['error'] = f"Не удалось разобрать «{text}». {step.prompt}"
+            return None
+    form['error'] = "Выберите вариант кнопкой."
+    return None
+
+
+def form_summary(form):
+    """Строки сводки со значениями формы"""
+    lines = []
+    for step in STEPS:
+        value = form['values'].get(step.field)
+        lines.append(f"{step.label}: {step.text(value) if value is not None else '—'}")
+    return "\n".join(lines)
+
+
+def render_form(form):
+    """Текст и клавиатура формы для текущего шага"""
+    step = STEPS_BY_FIELD[form['step']]
+    text = f"💰 Запись кассы\n\n{form_summary(form)}\n\n{form['error'] or step.prompt}"
+
+    current = form['values'].get(step.field)
+    buttons = [
+        InlineKeyboardButton(f"• {label}" if value == current else label, callback_data=callback_data(PICK, f"{step.field}.{index}"))
+        for index, (label, value) in enumerate(step.options(form))
+    ]
+    rows = [buttons[i:i + step.columns] for i in range(0, len(buttons), step.columns)]
+    # Уже выбранные значения можно поменять, не проходя форму заново
+    edits = [
+        InlineKeyboardButton(f"✏️ {other.label.split(' ', 1)[1]}", callback_data=callback_data(EDIT, other.field))
+        for other in STEPS
+        if other.field != step.field and other.choices and other.field in form['values']
+    ]
+    if edits:
+        rows.append(edits)
+    rows.append([InlineKeyboardButton("⬅️ Назад", callback_data=callback_data(BACK)),
+                 InlineKeyboardButton("✖️ Отмена", callback_data=callback_data(CANCEL))])
+    return text, InlineKeyboardMarkup(rows)
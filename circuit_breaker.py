@@ -0,0 +1,93 @@
+import collections
+import logging
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Состояния автомата
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Запрос не отправлен: автомат разомкнут, Airtable считается недоступным"""
+
+
+class CircuitBreaker:
+    """Автомат для запросов к Airtable: размыкается при частых ошибках или медленных ответах
+
+    Считаются последние window запросов; ошибка, ответ 5xx/429 или ответ дольше slow_call
+    секунд — неудача. Пока автомат разомкнут, запросы сразу завершаются CircuitOpenError.
+    Через reset_timeout секунд пропускается один пробный запрос: успех замыкает автомат,
+    неудача снова размыкает.
+    """
+
+    def __init__(self, window=20, min_calls=5, failure_ratio=0.5, slow_call=5.0, reset_timeout=30):
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.slow_call = slow_call
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._results = collections.deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def degraded(self):
+        """Airtable недоступен или проверяется пробным запросом"""
+        return self._state != CLOSED
+
+    def _probe_due(self):
+        return not self._probing and time.monotonic() - self._opened_at >= self.reset_timeout
+
+    def available(self):
+        """Можно ли сейчас отправить запрос (замкнут или пора отправить пробный)"""
+        with self._lock:
+            return self._state == CLOSED or self._probe_due()
+
+    def before_call(self):
+        """Разрешение на запрос: возвращает True для пробного запроса, при разомкнутом — CircuitOpenError"""
+        with self._lock:
+            if self._state == CLOSED:
+                return False
+            if self._probe_due():
+                self._state = HALF_OPEN
+                self._probing = True
+                logger.info("Airtable circuit breaker half-open, sending a probe request")
+                return True
+        raise CircuitOpenError("Airtable is unavailable (circuit breaker is open)")
+
+    def record(self, success, duration, probe=False):
+        """Учитывает результат запроса, разрешенного before_call"""
+        failed = not success or duration > self.slow_call
+        with self._lock:
+            if probe:
+                self._probing = False
+                if failed:
+                    self._open("probe request failed")
+                else:
+                    self._state = CLOSED
+                    self._results.clear()
+                    logger.info("Airtable circuit breaker closed, requests resumed")
+                return
+            if self._state != CLOSED:
+                # Запрос был отправлен до размыкания
+                return
+            self._results.append(failed)
+            failures = sum(self._results)
+            if len(self._results) >= self.min_calls and failures >= self.failure_ratio * len(self._results):
+                self._open(f"{failures} of last {len(self._results)} requests failed or were slower than {self.slow_call}s")
+
+    def _open(self, reason):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._results.clear()
+        logger.warning(f"Airtable circuit breaker open for {self.reset_timeout}s: {reason}")
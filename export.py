@@ -0,0 +1,193 @@
+import csv
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+from datetime import timedelta
+
+from requests import HTTPError
+
+from rate_limit import BACKGROUND, use_priority
+
+logger = logging.getLogger(__name__)
+
+# Поля "Кассы" в выгрузке (в порядке столбцов CSV)
+EXPORT_FIELDS = ['Date', 'ID', 'Name', 'Страница', 'Смена', 'Тип', 'Касса', 'Менеджер']
+FORMATS = ('csv', 'jsonl')
+EXTENSIONS = {'csv': 'csv', 'jsonl': 'jsonl.gz'}
+
+
+class ExportCancelled(Exception):
+    """Выгрузка остановлена (например, при остановке бота); ее можно продолжить позже"""
+
+
+def date_formula(start, end):
+    """Формула Airtable для записей с датой в [start, end] (поле Date без времени)"""
+    after = (start - timedelta(days=1)).isoformat()
+    before = (end + timedelta(days=1)).isoformat()
+    return f"AND(IS_AFTER({{Date}}, DATETIME_PARSE('{after}')), IS_BEFORE({{Date}}, DATETIME_PARSE('{before}')))"
+
+
+def fetch_pages(table, options, offset=None):
+    """Страницы записей из Airtable по одной: (записи, offset следующей страницы или None)"""
+    if offset:
+        options = dict(options, offset=offset)
+    for response in table.api.iterate_requests(
+        method='get',
+        url=table.urls.records,
+        fallback=('post', table.urls.records_post),
+        options=options,
+    ):
+        yield response.get('records', []), response.get('offset')
+
+
+def filter_records(records, page_id=None, manager_id=None):
+    """Отбирает записи по странице и менеджеру (ID связанных записей)"""
+    for record in records:
+        fields = record['fields']
+        if page_id and page_id not in (fields.get('Страница') or []):
+            continue
+        if manager_id and manager_id not in (fields.get('Менеджер') or []):
+            continue
+        yield record
+
+
+def to_rows(records, page_names):
+    """Записи -> строки выгрузки; связанные страницы заменяются названиями"""
+    for record in records:
+        fields = record['fields']
+        row = {'record_id': record['id']}
+        for name in EXPORT_FIELDS:
+            value = fields.get(name)
+            if name == 'Страница':
+                value = ", ".join(page_names.get(page_id, page_id) for page_id in value or [])
+            elif isinstance(value, list):
+                value = ", ".join(str(item) for item in value)
+            row[name] = value
+        yield row
+
+
+class CashExport:
+    """Выгрузка записей "Кассы" в CSV или JSONL (gzip) постранично, с контрольными точками
+
+    В памяти держится только одна страница записей. После каждой страницы сохраняется
+    контрольная точка (offset Airtable, размер файла, число строк), поэтому прерванная
+    выгрузка с теми же параметрами продолжается с последней записанной страницы.
+    """
+
+    def __init__(self, table, directory, start, end, fmt='csv', page_id=None, manager_id=None,
+                 page_names=None, page_size=100, prefix='cash'):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown export format: {fmt}")
+        self.table = table
+        self.start = start
+        self.end = end
+        self.fmt = fmt
+        self.page_id = page_id
+        self.manager_id = manager_id
+        self.page_names = page_names or {}
+        self.page_size = page_size
+
+        self.params = {'start': start.isoformat(), 'end': end.isoformat(), 'format': fmt,
+                       'page': page_id, 'manager': manager_id, 'prefix': prefix}
+        digest = hashlib.sha256(json.dumps(self.params, sort_keys=True).encode()).hexdigest()[:8]
+        name = f"{prefix}-{start.strftime('%Y%m%d')}-{end.strftime('%Y%m%d')}-{digest}.{EXTENSIONS[fmt]}"
+        self.path = os.path.join(directory, name)
+        self.part_path = self.path + '.part'
+        self.checkpoint_path = self.path + '.checkpoint'
+        self._cancelled = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+
+    def cancel(self):
+        """Останавливает выгрузку после текущей страницы (контрольная точка сохраняется)"""
+        self._cancelled.set()
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, encoding='utf-8') as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if checkpoint.get('params') != self.params or not os.path.exists(self.part_path):
+            return None
+        if os.path.getsize(self.part_path) < checkpoint['position']:
+            return None
+        return checkpoint
+
+    def _save_checkpoint(self, offset, position, count):
+        data = {'params': self.params, 'offset': offset, 'position': position, 'count': count,
+                'done': offset is None}
+        temporary = self.checkpoint_path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(temporary, self.checkpoint_path)
+
+    def _encode(self, rows, header):
+        """Байты одной страницы; для JSONL — отдельный член gzip, чтобы файл можно было дописывать"""
+        if self.fmt == 'csv':
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=['record_id'] + EXPORT_FIELDS)
+            if header:
+                writer.writeheader()
+            writer.writerows(rows)
+            # BOM в начале файла, чтобы Excel открыл кириллицу
+            return (('\ufeff' if header else '') + buffer.getvalue()).encode('utf-8')
+        lines = "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+        return gzip.compress(lines.encode('utf-8')) if lines else b''
+
+    def run(self):
+        """Выполняет выгрузку (блокирующий вызов); возвращает (путь к файлу, число строк)"""
+        if os.path.exists(self.path) and not os.path.exists(self.checkpoint_path):
+            os.remove(self.path)
+        checkpoint = self._load_checkpoint()
+        if checkpoint and checkpoint.get('done'):
+            # Все страницы записаны, прервались перед переименованием файла
+            return self._finish(checkpoint['count'])
+        if checkpoint:
+            offset, position, count = checkpoint['offset'], checkpoint['position'], checkpoint['count']
+            logger.info(f"Resuming export {self.path} after {count} rows")
+        else:
+            offset, position, count = None, 0, 0
+
+        options = {'formula': date_formula(self.start, self.end), 'fields': EXPORT_FIELDS,
+                   'page_size': self.page_size}
+        with use_priority(BACKGROUND), open(self.part_path, 'r+b' if position else 'wb') as output:
+            output.truncate(position)
+            output.seek(position)
+            try:
+                count = self._write_pages(output, options, offset, count)
+            except HTTPError as e:
+                # Offset Airtable действует ограниченное время: начинаем выгрузку заново
+                if not offset or e.response is None or e.response.status_code != 422:
+                    raise
+                logger.warning(f"Export offset expired, restarting {self.path}: {str(e)}")
+                output.seek(0)
+                output.truncate()
+                count = self._write_pages(output, options, None, 0)
+
+        return self._finish(count)
+
+    def _finish(self, count):
+        os.replace(self.part_path, self.path)
+        os.remove(self.checkpoint_path)
+        logger.info(f"Exported {count} cash records to {self.path}")
+        return self.path, count
+
+    def _write_pages(self, output, options, offset, count):
+        header = output.tell() == 0
+        for records, next_offset in fetch_pages(self.table, options, offset):
+            rows = list(to_rows(filter_records(records, self.page_id, self.manager_id), self.page_names))
+            data = self._encode(rows, header)
+            if data:
+                output.write(data)
+                output.flush()
+                os.fsync(output.fileno())
+                header = False
+            count += len(rows)
+            self._save_checkpoint(next_offset, output.tell(), count)
+            if next_offset and self._cancelled.is_set():
+                raise ExportCancelled(f"Export {self.path} cancelled after {count} rows")
+        return count
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+REASONS = {200: 'OK', 204: 'No Content', 400: 'Bad Request', 401: 'Unauthorized',
+           404: 'Not Found', 405: 'Method Not Allowed', 429: 'Too Many Requests',
+           500: 'Internal Server Error'}
+
+Request = namedtuple('Request', ['method', 'path', 'query', 'headers', 'body'])
+
+
+class HTTPServer:
+    """Минимальный HTTP-сервер на asyncio для служебных эндпоинтов (метрики, вебхуки)"""
+
+    def __init__(self, host='127.0.0.1', port=9090, max_body=1024 * 1024):
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self._routes = {}
+        self._server = None
+
+    def add_route(self, method, path, handler):
+        """Регистрирует обработчик: async handler(request) -> (status, content_type, body)
+
+        Путь, оканчивающийся на "/*", совпадает со всеми путями с этим префиксом.
+        """
+        self._routes[(method, path)] = handler
+
+    def _find(self, method, path):
+        handler = self._routes.get((method, path))
+        if handler:
+            return handler, True
+        known_path = False
+        for (route_method, route_path), route_handler in self._routes.items():
+            matches = route_path == path or (route_path.endswith('/*') and path.startswith(route_path[:-1]))
+            if matches and route_method == method:
+                return route_handler, True
+            known_path = known_path or matches
+        return None, known_path
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        # При port=0 система выбирает свободный порт
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"HTTP server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            length = int(headers.get('content-length', 0))
+            if length > self.max_body:
+                await self._respond(writer, 400, 'text/plain', b'Body too large')
+                return
+            body = await reader.readexactly(length) if length else b''
+
+            url = urlsplit(target)
+            handler, known_path = self._find(method, url.path)
+            if handler is None:
+                await self._respond(writer, 405 if known_path else 404, 'text/plain', b'')
+                return
+            status, content_type, payload = await handler(Request(method, url.path, url.query, headers, body))
+            await self._respond(writer, status, content_type, payload)
+        except (ValueError, asyncio.IncompleteReadError):
+            await self._respond(writer, 400, 'text/plain', b'Bad request')
+        except Exception as e:
+            logger.error(f"Error handling HTTP request: {str(e)}")
+            await self._respond(writer, 500, 'text/plain', b'')
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, content_type, payload):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        head = (
+            f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        writer.write(head.encode('latin-1') + payload)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
@@ -0,0 +1,39 @@
+from telegram import KeyboardButton, ReplyKeyboardMarkup
+
+# Константы для смен
+SHIFTS = ["00-08", "08-16", "16-00", "00-06", "06-12", "12-18", "18-00"]
+
+# Типы операций кассы
+OPERATION_TYPES = ["Касса", "Долет", "Возврат"]
+
+# Тексты кнопок
+CASH_BUTTON = "💰 Записать кассу"
+BULK_CASH_BUTTON = "📋 Несколько записей"
+SCHEDULE_BUTTON = "📅 График"
+MY_SCHEDULE_BUTTON = "🗓 Мой график"
+TOTALS_BUTTON = "📊 Итоги"
+BACK_BUTTON = "⬅️ Назад"
+MAIN_MENU_BUTTON = "🏠 В главное меню"
+DAY_OFF_BUTTON = "🏖️ Выходной"
+REPLACEMENT_BUTTON = "🔄 Замена"
+MENU_BUTTONS = (CASH_BUTTON, BULK_CASH_BUTTON, SCHEDULE_BUTTON, MY_SCHEDULE_BUTTON, TOTALS_BUTTON)
+NAVIGATION_BUTTONS = (BACK_BUTTON, MAIN_MENU_BUTTON)
+
+
+def _rows(*labels):
+    """Строки клавиатуры по одной кнопке в каждой"""
+    return [[KeyboardButton(label)] for label in labels]
+
+
+def _markup(rows):
+    return ReplyKeyboardMarkup(rows, resize_keyboard=True)
+
+
+# Статические клавиатуры собираются один раз при импорте
+MAIN_KEYBOARD = _markup(_rows(*MENU_BUTTONS))
+NAVIGATION_KEYBOARD = _markup(_rows(*NAVIGATION_BUTTONS))
+SCHEDULE_STATUS_KEYBOARD = _markup(
+    [[KeyboardButton(shift) for shift in SHIFTS[i:i + 2]] for i in range(0, len(SHIFTS), 2)]
+    + _rows(DAY_OFF_BUTTON, REPLACEMENT_BUTTON, *NAVIGATION_BUTTONS)
+)
+
@@ -0,0 +1,218 @@
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+trace_logger = logging.getLogger('tracing')
+
+# Границы корзин гистограмм задержек, сек
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (list(extra.items()) if extra else [])
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Metric:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def header(self, kind):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {kind}"]
+
+
+class Counter(Metric):
+    """Монотонно растущий счетчик"""
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def collect(self):
+        lines = self.header('counter')
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram(Metric):
+    """Гистограмма значений (задержек) с фиксированными корзинами"""
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.setdefault(key, {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['buckets'][i] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    def collect(self):
+        lines = self.header('histogram')
+        with self._lock:
+            for key, state in self._values.items():
+                for bound, count in zip(self.buckets, state['buckets']):
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, {'le': bound})} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, {'le': '+Inf'})} {state['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {state['sum']}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {state['count']}")
+        return lines
+
+
+class CallbackMetric(Metric):
+    """Метрика, значения которой вычисляются при сборе: callback() -> {(значения меток): число}"""
+
+    def __init__(self, name, help, labels=(), kind='gauge', callback=None):
+        super().__init__(name, help, labels)
+        self.kind = kind
+        self.callback = callback
+
+    def collect(self):
+        lines = self.header(self.kind)
+        try:
+            values = self.callback()
+        except Exception as e:
+            logger.error(f"Error collecting metric {self.name}: {str(e)}")
+            return lines
+        for key, value in values.items():
+            key = key if isinstance(key, tuple) else (key,)
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, help, callback, labels=(), kind='gauge'):
+        return self.register(CallbackMetric(name, help, labels, kind, callback))
+
+    def render(self):
+        """Текстовый формат экспорта Prometheus"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_LATENCY = REGISTRY.histogram(
+    'bot_handler_duration_seconds', 'Время обработки обновления обработчиком', ['handler']
+)
+HANDLER_ERRORS = REGISTRY.counter(
+    'bot_handler_errors_total', 'Необработанные исключения в обработчиках', ['handler']
+)
+AIRTABLE_REQUESTS = REGISTRY.counter(
+    'bot_airtable_requests_total', 'HTTP-запросы к Airtable', ['table', 'method', 'status']
+)
+AIRTABLE_LATENCY = REGISTRY.histogram(
+    'bot_airtable_request_duration_seconds', 'Длительность HTTP-запросов к Airtable', ['table', 'method']
+)
+CACHE_LOOKUPS = REGISTRY.counter(
+    'bot_cache_lookups_total', 'Обращения к кэшам в памяти', ['cache', 'result']
+)
+
+
+def record_lookup(cache, hit, count=1):
+    CACHE_LOOKUPS.inc(count, cache=cache, result='hit' if hit else 'miss')
+
+
+# Трассировка: текущая трасса и спан передаются через контекст (в том числе в пул потоков)
+current_trace = contextvars.ContextVar('current_trace', default=None)
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+@contextlib.contextmanager
+def span(name, trace_id=None, **attributes):
+    """Спан трассировки; по завершении пишет структурированную запись в логгер tracing"""
+    trace_token = current_trace.set(trace_id) if trace_id else None
+    parent = current_span.get()
+    span_id = uuid.uuid4().hex[:16]
+    span_token = current_span.set(span_id)
+    started = time.perf_counter()
+    error = None
+    try:
+        yield span_id
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        if trace_logger.isEnabledFor(logging.DEBUG):
+            trace_logger.debug(json.dumps({
+                'trace_id': current_trace.get(),
+                'span_id': span_id,
+                'parent_id': parent,
+                'name': name,
+                'duration_ms': round(duration * 1000, 3),
+                'error': error,
+                **attributes,
+            }, ensure_ascii=False))
+        current_span.reset(span_token)
+        if trace_token:
+            current_trace.reset(trace_token)
+
+
+def instrument_handler(func):
+    """Замеряет время обработчика и открывает корневой спан трассы для обновления"""
+    @functools.wraps(func)
+    async def wrapper(update, context, *args, **kwargs):
+        update_id = getattr(update, 'update_id', None)
+        started = time.perf_counter()
+        with span(func.__name__, trace_id=f"update-{update_id}", update_id=update_id):
+            try:
+                return await func(update, context, *args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(handler=func.__name__)
+                raise
+            finally:
+                HANDLER_LATENCY.observe(time.perf_counter() - started, handler=func.__name__)
+    return wrapper
+
+
+def add_metrics_route(server, registry=REGISTRY):
+    """Подключает эндпоинт /metrics к служебному HTTP-серверу"""
+    async def handle_metrics(request):
+        return 200, 'text/plain; version=0.0.4; charset=utf-8', registry.render()
+    server.add_route('GET', '/metrics', handle_metrics)
@@ -0,0 +1,218 @@
+import asyncio
+import json
+import logging
+import sqlite3
+from copy import deepcopy
+
+from telegram.ext import BasePersistence, PersistenceInput, PicklePersistence
+
+logger = logging.getLogger(__name__)
+
+
+def flatten_bot_data(data):
+    """bot_data -> {(ключ, элемент): JSON}: значения-словари раскладываются по элементам, остальные — элемент ''"""
+    items = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            for item, item_value in value.items():
+                items[(key, json.dumps(item))] = json.dumps(item_value, ensure_ascii=False)
+        else:
+            items[(key, '')] = json.dumps(value, ensure_ascii=False)
+    return items
+
+
+class SQLitePersistence(BasePersistence):
+    """Хранение состояний ConversationHandler, user_data и chat_data в SQLite
+
+    Изменения накапливаются в памяти и записываются одной транзакцией. bot_data хранится
+    по строке на элемент (например, на каждый file_id картинки), и записываются только
+    измененные элементы: процессы-обработчики с общим файлом не перетирают данные друг друга.
+    """
+
+    def __init__(self, path, update_interval=10, flush_delay=0.5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.path = path
+        self.flush_delay = flush_delay
+
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS user_data (id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS chat_data (id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS bot_data_items ("
+                " key TEXT NOT NULL, item TEXT NOT NULL, data TEXT NOT NULL,"
+                " PRIMARY KEY (key, item))"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                " name TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL,"
+                " PRIMARY KEY (name, key))"
+            )
+
+        self._user_data = self._load('user_data')
+        self._chat_data = self._load('chat_data')
+        self._migrate_bot_data()
+        self._bot_data = self._load_bot_data()
+        # Сохраненные элементы bot_data: с ними сравнивается каждое обновление
+        self._bot_items = flatten_bot_data(self._bot_data)
+        self._conversations = {}
+        for name, key, state in self._db.execute("SELECT name, key, state FROM conversations"):
+            self._conversations.setdefault(name, {})[tuple(json.loads(key))] = json.loads(state)
+
+        # Несохраненные изменения: (таблица, ключ) -> данные или None для удаления
+        self._dirty = {}
+        self._flush_task = None
+
+    def _load(self, table):
+        return {row_id: json.loads(data) for row_id, data in self._db.execute(f"SELECT id, data FROM {table}")}
+
+    def _migrate_bot_data(self):
+        """Переносит bot_data из прежнего формата (одна строка со всеми данными) в bot_data_items"""
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            # Таблицу мог уже перенести другой процесс-обработчик
+            if not self._db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'bot_data'").fetchone():
+                return
+            row = self._db.execute("SELECT data FROM bot_data WHERE id = 0").fetchone()
+            items = flatten_bot_data(json.loads(row[0])) if row else {}
+            self._db.executemany(
+                "INSERT OR IGNORE INTO bot_data_items (key, item, data) VALUES (?, ?, ?)",
+                [(key, item, data) for (key, item), data in items.items()]
+            )
+            self._db.execute("DROP TABLE bot_data")
+        logger.info(f"Migrated {len(items)} bot_data entries in {self.path}")
+
+    def _load_bot_data(self):
+        bot_data = {}
+        for key, item, data in self._db.execute("SELECT key, item, data FROM bot_data_items"):
+            if item == '':
+                bot_data[key] = json.loads(data)
+            else:
+                bot_data.setdefault(key, {})[json.loads(item)] = json.loads(data)
+        return bot_data
+
+    def _stage(self, table, key, data):
+        self._dirty[(table, key)] = data
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        await self.flush()
+
+    async def flush(self):
+        """Записывает все накопленные изменения одной транзакцией"""
+        dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        with self._db:
+            for (table, key), data in dirty.items():
+                if table == 'bot_data_items':
+                    if data is None:
+                        self._db.execute("DELETE FROM bot_data_items WHERE key = ? AND item = ?", key)
+                    else:
+                        self._db.execute(
+                            "INSERT OR REPLACE INTO bot_data_items (key, item, data) VALUES (?, ?, ?)", key + (data,)
+                        )
+                elif table == 'conversations':
+                    name, conversation_key = key
+                    if data is None:
+                        self._db.execute(
+                            "DELETE FROM conversations WHERE name = ? AND key = ?",
+                            (name, json.dumps(list(conversation_key)))
+                        )
+                    else:
+                        self._db.execute(
+                            "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                            (name, json.dumps(list(conversation_key)), json.dumps(data))
+                        )
+                elif data is None:
+                    self._db.execute(f"DELETE FROM {table} WHERE id = ?", (key,))
+                else:
+                    self._db.execute(
+                        f"INSERT OR REPLACE INTO {table} (id, data) VALUES (?, ?)",
+                        (key, json.dumps(data, ensure_ascii=False))
+                    )
+        logger.debug(f"Persisted {len(dirty)} changes to {self.path}")
+
+    async def get_user_data(self):
+        return deepcopy(self._user_data)
+
+    async def get_chat_data(self):
+        return deepcopy(self._chat_data)
+
+    async def get_bot_data(self):
+        return deepcopy(self._bot_data)
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return dict(self._conversations.get(name, {}))
+
+    async def update_conversation(self, name, key, new_state):
+        conversations = self._conversations.setdefault(name, {})
+        if conversations.get(key) == new_state:
+            return
+        if new_state is None:
+            conversations.pop(key, None)
+        else:
+            conversations[key] = new_state
+        self._stage('conversations', (name, tuple(key)), new_state)
+
+    async def update_user_data(self, user_id, data):
+        if self._user_data.get(user_id) == data:
+            return
+        self._user_data[user_id] = deepcopy(data)
+        self._stage('user_data', user_id, self._user_data[user_id])
+
+    async def update_chat_data(self, chat_id, data):
+        if self._chat_data.get(chat_id) == data:
+            return
+        self._chat_data[chat_id] = deepcopy(data)
+        self._stage('chat_data', chat_id, self._chat_data[chat_id])
+
+    async def update_bot_data(self, data):
+        items = flatten_bot_data(data)
+        for key, value in items.items():
+            if self._bot_items.get(key) != value:
+                self._stage('bot_data_items', key, value)
+        for key in self._bot_items.keys() - items.keys():
+            self._stage('bot_data_items', key, None)
+        self._bot_items = items
+        self._bot_data = deepcopy(data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._user_data.pop(user_id, None)
+        self._stage('user_data', user_id, None)
+
+    async def drop_chat_data(self, chat_id):
+        self._chat_data.pop(chat_id, None)
+        self._stage('chat_data', chat_id, None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+
+def create_persistence(backend, path, update_interval=10):
+    """Создает хранилище состояний: sqlite, pickle или none (без сохранения)"""
+    if backend == 'sqlite':
+        return SQLitePersistence(path, update_interval=update_interval)
+    if backend == 'pickle':
+        return PicklePersistence(path, update_interval=update_interval)
+    if backend == 'none':
+        return None
+    raise ValueError(f"Unknown persistence backend: {backend}")
@@ -0,0 +1,98 @@
+import contextlib
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Классы приоритета: чем меньше число, тем раньше запрос получит токен
+WRITE, INTERACTIVE, BACKGROUND = range(3)
+PRIORITY_NAMES = {WRITE: 'write', INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+
+# Приоритет текущего запроса (передается через контекст, чтобы дойти до HTTP-уровня)
+request_priority = contextvars.ContextVar('request_priority', default=INTERACTIVE)
+
+
+@contextlib.contextmanager
+def use_priority(priority):
+    """Выполняет запросы внутри блока с указанным приоритетом"""
+    token = request_priority.set(priority)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+class RequestScheduler:
+    """Токен-бакет с очередью по приоритетам для всех запросов к одной базе Airtable"""
+
+    def __init__(self, rate=5.0, burst=5, rate_limit_pause=30.0):
+        self.rate = rate
+        self.burst = burst
+        # После ответа 429 Airtable не принимает запросы базы 30 секунд
+        self.rate_limit_pause = rate_limit_pause
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._seq = itertools.count()
+        self._stats = {priority: {'requests': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+                       for priority in PRIORITY_NAMES}
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, priority=None):
+        """Блокирует поток, пока запрос с данным приоритетом не получит токен"""
+        if priority is None:
+            priority = request_priority.get()
+        started = time.monotonic()
+        entry = (priority, next(self._seq))
+
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    self._refill()
+                    if self._waiting[0] == entry and self._tokens >= 1:
+                        heapq.heappop(self._waiting)
+                        self._tokens -= 1
+                        break
+                    # Ждать по таймеру должен только первый в очереди, остальных разбудят
+                    timeout = (1 - self._tokens) / self.rate if self._waiting[0] == entry else None
+                    self._cond.wait(timeout)
+            except BaseException:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                raise
+            finally:
+                self._cond.notify_all()
+
+            waited = time.monotonic() - started
+            stats = self._stats[priority]
+            stats['requests'] += 1
+            stats['wait_total'] += waited
+            stats['wait_max'] = max(stats['wait_max'], waited)
+
+    def throttle(self):
+        """После ответа 429 от Airtable: следующий токен будет выдан не раньше чем через rate_limit_pause секунд"""
+        with self._cond:
+            self._refill()
+            self._tokens = min(self._tokens, 0.0, 1 - self.rate_limit_pause * self.rate)
+            self._cond.notify_all()
+
+    def snapshot(self):
+        """Глубина очереди и время ожидания по классам приоритета"""
+        with self._cond:
+            depth = {name: 0 for name in PRIORITY_NAMES.values()}
+            for priority, _ in self._waiting:
+                depth[PRIORITY_NAMES[priority]] += 1
+            return {
+                'queue_depth': depth,
+                'wait': {PRIORITY_NAMES[priority]: dict(stats) for priority, stats in self._stats.items()},
+            }
@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+from telegram.error import Forbidden, RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+# Сколько дней хранить отметки об отправленных напоминаниях
+SENT_RETENTION_DAYS = 3
+
+
+class SendLimiter:
+    """Темп отправки сообщений ботом: не больше rate в секунду на все рассылки и агентства
+
+    Лимит Telegram (около 30 сообщений в секунду) действует на бота целиком, поэтому
+    один ограничитель передается всем рассылкам процесса.
+    """
+
+    def __init__(self, rate=25):
+        self.rate = rate
+        self._next = 0.0
+
+    async def wait(self):
+        """Ждет очередного интервала отправки (очередь — в порядке вызова)"""
+        now = time.monotonic()
+        slot = max(now, self._next)
+        self._next = slot + 1 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class FanOut:
+    """Рассылка сообщений пачками с общим ограничителем скорости
+
+    Сообщения в один чат объединяются в одно, поэтому каждый чат получает не больше
+    одного сообщения за рассылку (лимит Telegram — примерно сообщение в секунду на чат).
+    """
+
+    def __init__(self, bot, limiter, batch_size=25):
+        self.bot = bot
+        self.limiter = limiter
+        self.batch_size = batch_size
+
+    async def _send_one(self, chat_id, text):
+        for attempt in range(2):
+            await self.limiter.wait()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                return True
+            except RetryAfter as e:
+                delay = e.retry_after
+                delay = delay.total_seconds() if isinstance(delay, timedelta) else delay
+                logger.warning(f"Flood control while sending to {chat_id}, waiting {delay}s")
+                await asyncio.sleep(delay)
+            except Forbidden:
+                logger.info(f"Chat {chat_id} blocked the bot, skipping")
+                return False
+            except TelegramError as e:
+                logger.error(f"Error sending message to {chat_id}: {str(e)}")
+                return False
+        return False
+
+    async def send(self, messages):
+        """Отправляет сообщения [(chat_id, текст)]; возвращает число доставленных"""
+        by_chat = {}
+        for chat_id, text in messages:
+            by_chat.setdefault(chat_id, []).append(text)
+        queue = [(chat_id, "\n\n".join(texts)) for chat_id, texts in by_chat.items()]
+
+        delivered = 0
+        for i in range(0, len(queue), self.batch_size):
+            batch = queue[i:i + self.batch_size]
+            results = await asyncio.gather(*(self._send_one(chat_id, text) for chat_id, text in batch))
+            delivered += sum(results)
+        return delivered
+
+
+def operator_chat_id(operator):
+    """TG ID оператора как ID чата или None"""
+    try:
+        return int(operator['fields'].get('TG ID'))
+    except (TypeError, ValueError):
+        return None
+
+
+def shift_end(day, shift):
+    """Время окончания смены вида "08-16" в день day ("16-00" заканчивается в полночь)"""
+    end_hour = int(shift.split('-')[1]) or 24
+    return datetime.combine(day, datetime.min.time()) + timedelta(hours=end_hour)
+
+
+class ReminderScheduler:
+    """Напоминания операторам о пропущенной кассе и незаполненном графике на JobQueue
+
+    Все проверки идут по кэшам в памяти (справочник, график, итоги кассы), без запросов к Airtable.
+    """
+
+    def __init__(self, operators, schedule, reports, shifts, format_days, manager_chat_ids=(),
+                 interval=900, grace=1800, schedule_time=None, schedule_days=7, limiter=None, name='default'):
+        # Имя агентства: отметки об отправке общие для всех баз, а ID операторов в разных базах совпадают
+        self.name = name
+        self.operators = operators
+        self.schedule = schedule
+        self.reports = reports
+        self.shifts = shifts
+        self.format_days = format_days
+        self.manager_chat_ids = list(manager_chat_ids)
+        self.interval = interval
+        self.grace = timedelta(seconds=grace)
+        self.schedule_time = schedule_time
+        self.schedule_days = schedule_days
+        self.limiter = limiter or SendLimiter()
+
+    def start(self, job_queue):
+        job_queue.run_repeating(self.check_cash, interval=self.interval, first=60, name=f'cash-reminders-{self.name}')
+        if self.schedule_time:
+            job_queue.run_daily(self.check_schedule, time=self.schedule_time, name=f'schedule-reminders-{self.name}')
+        logger.info("Reminder jobs scheduled")
+
+    def _sent(self, context):
+        """Отметки об отправленных напоминаниях в bot_data (сохраняются вместе с состояниями)"""
+        sent = context.bot_data.setdefault('reminders_sent', {})
+        oldest = (datetime.now() - timedelta(days=SENT_RETENTION_DAYS)).date().isoformat()
+        for key in [key for key, day in sent.items() if day < oldest]:
+            del sent[key]
+        return sent
+
+    def missing_cash(self, now):
+        """Операторы без записи кассы за закончившиеся смены по графику: [(оператор, день, смена)]"""
+        missing = []
+        for operator in self.operators():
+            operator_id = operator['fields'].get('ID')
+            if not operator_id or operator_chat_id(operator) is None:
+                continue
+            schedule = self.schedule.days(operator_id)
+            # Смены за вчера и сегодня; график хранит только дни текущего месяца
+            for day in (now.date() - timedelta(days=1), now.date()):
+                shift = schedule.get(day.day)
+                if day.month != now.month or shift not in self.shifts:
+                    continue
+                if shift_end(day, shift) + self.grace > now:
+                    continue
+                if shift not in self.reports.shifts(operator_id, day):
+                    missing.append((operator, day, shift))
+        return missing
+
+    def empty_schedule(self, today):
+        """Операторы с незаполненными днями графика на ближайшие schedule_days дней: [(оператор, дни)]"""
+        days = [day for day in (today + timedelta(days=i) for i in range(self.schedule_days))
+                if day.month == today.month]
+        result = []
+        for operator in self.operators():
+            operator_id = operator['fields'].get('ID')
+            if not operator_id or operator_chat_id(operator) is None:
+                continue
+            schedule = self.schedule.days(operator_id)
+            empty = [day.day for day in days if day.day not in schedule]
+            if empty:
+                result.append((operator, empty))
+        return result
+
+    async def check_cash(self, context):
+        now = datetime.now()
+        sent = self._sent(context)
+        messages = []
+        reminded = []
+        for operator, day, shift in self.missing_cash(now):
+            key = f"{self.name}:cash:{operator['fields']['ID']}:{day.isoformat()}:{shift}"
+            if key in sent:
+                continue
+            sent[key] = day.isoformat()
+            messages.append((
+                operator_chat_id(operator),
+                f"⏰ Нет записи кассы за смену {shift} {day.strftime('%d.%m')}. "
+                f"Нажмите «Записать кассу», чтобы добавить ее."
+            ))
+            name = operator['fields'].get('Name', operator['fields']['ID'])
+            reminded.append(f"{name} — {day.strftime('%d.%m')} {shift}")
+
+        if not messages:
+            return
+        if self.manager_chat_ids:
+            digest = "⏰ Нет записей кассы за смены:\n" + "\n".join(reminded)
+            messages.extend((manager_chat_id, digest) for manager_chat_id in self.manager_chat_ids)
+        delivered = await FanOut(context.bot, self.limiter).send(messages)
+        logger.info(f"Cash reminders: {len(reminded)} missing shifts, {delivered} messages delivered")
+
+    async def check_schedule(self, context):
+        today = datetime.now().date()
+        sent = self._sent(context)
+        messages = []
+        for operator, days in self.empty_schedule(today):
+            key = f"{self.name}:schedule:{operator['fields']['ID']}:{today.isoformat()}"
+            if key in sent:
+                continue
+            sent[key] = today.isoformat()
+            messages.append((
+                operator_chat_id(operator),
+                f"📅 Заполните график: не указан статус на {self.format_days(days)} число."
+            ))
+        if messages:
+            delivered = await FanOut(context.bot, self.limiter).send(messages)
+            logger.info(f"Schedule reminders: {len(messages)} operators, {delivered} delivered")
+
+    async def broadcast(self, bot, text):
+        """Рассылка сообщения менеджера всем операторам; возвращает (доставлено, всего)"""
+        chat_ids = {operator_chat_id(operator) for operator in self.operators()} - {None}
+        delivered = await FanOut(bot, self.limiter).send([(chat_id, text) for chat_id in chat_ids])
+        return delivered, len(chat_ids)
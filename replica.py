@@ -0,0 +1,302 @@
+import json
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+
+from rate_limit import BACKGROUND, use_priority
+
+logger = logging.getLogger(__name__)
+
+# Запас по времени для дельта-синхронизации (часы Airtable и наши могут расходиться)
+CURSOR_SKEW = timedelta(seconds=30)
+
+
+def modified_since(cursor, field=None):
+    """Формула Airtable для записей, измененных после cursor (с запасом CURSOR_SKEW)"""
+    since = (cursor - CURSOR_SKEW).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    modified = f"LAST_MODIFIED_TIME({{{field}}})" if field else "LAST_MODIFIED_TIME()"
+    return f"IS_AFTER({modified}, DATETIME_PARSE('{since}'))"
+
+
+class Replica:
+    """Локальная копия таблиц Airtable в SQLite с курсорами синхронизации"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS records ("
+                " table_name TEXT NOT NULL, id TEXT NOT NULL, fields TEXT NOT NULL,"
+                " PRIMARY KEY (table_name, id))"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS cursors (table_name TEXT PRIMARY KEY, cursor TEXT NOT NULL)"
+            )
+            self._db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def load(self, table_name):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, fields FROM records WHERE table_name = ?", (table_name,)
+            ).fetchall()
+        return [{'id': record_id, 'fields': json.loads(fields)} for record_id, fields in rows]
+
+    def ids(self, table_name):
+        with self._lock:
+            rows = self._db.execute("SELECT id FROM records WHERE table_name = ?", (table_name,)).fetchall()
+        return {row[0] for row in rows}
+
+    def upsert(self, table_name, records):
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO records (table_name, id, fields) VALUES (?, ?, ?)",
+                [(table_name, record['id'], json.dumps(record['fields'], ensure_ascii=False))
+                 for record in records]
+            )
+
+    def replace(self, table_name, records):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM records WHERE table_name = ?", (table_name,))
+            self._db.executemany(
+                "INSERT INTO records (table_name, id, fields) VALUES (?, ?, ?)",
+                [(table_name, record['id'], json.dumps(record['fields'], ensure_ascii=False))
+                 for record in records]
+            )
+
+    def patch(self, table_name, record_id, fields):
+        """Обновляет поля записи в копии; возвращает обновленную запись или None"""
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT fields FROM records WHERE table_name = ? AND id = ?", (table_name, record_id)
+            ).fetchone()
+            if row is None:
+                return None
+            merged = dict(json.loads(row[0]), **fields)
+            self._db.execute(
+                "UPDATE records SET fields = ? WHERE table_name = ? AND id = ?",
+                (json.dumps(merged, ensure_ascii=False), table_name, record_id)
+            )
+        return {'id': record_id, 'fields': merged}
+
+    def get_cursor(self, table_name):
+        with self._lock:
+            row = self._db.execute("SELECT cursor FROM cursors WHERE table_name = ?", (table_name,)).fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def set_cursor(self, table_name, cursor):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO cursors (table_name, cursor) VALUES (?, ?)",
+                (table_name, cursor.isoformat())
+            )
+
+    def get_state(self, key):
+        """Служебное значение (JSON), сохраненное вместе с копией, или None"""
+        with self._lock:
+            row = self._db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_state(self, key, value):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, json.dumps(value))
+            )
+
+    def close(self):
+        self._db.close()
+
+
+class TableSync:
+    """Синхронизация одной таблицы: полная выгрузка или только измененные записи"""
+
+    # Можно ли обновлять отдельные записи по уведомлению об изменениях (иначе — дельта-синхронизация)
+    targeted = True
+
+    def __init__(self, table, fields=None, on_change=None):
+        self.table = table
+        self.fields = fields
+        self.on_change = on_change
+
+    @property
+    def name(self):
+        return self.table.name
+
+    def _all(self, **options):
+        if self.fields:
+            options['fields'] = self.fields
+        return self.table.all(**options)
+
+    def pull_full(self):
+        return self._all()
+
+    def pull_changes(self, cursor, known_ids):
+        return self._all(formula=modified_since(cursor))
+
+    def pull_records(self, record_ids, chunk_size=50):
+        """Записи с указанными ID (один запрос RECORD_ID() на каждую пачку)"""
+        records = []
+        for i in range(0, len(record_ids), chunk_size):
+            chunk = record_ids[i:i + chunk_size]
+            formula = "OR(" + ",".join(f"RECORD_ID()='{record_id}'" for record_id in chunk) + ")"
+            records.extend(self._all(formula=formula))
+        return records
+
+
+class PageSync(TableSync):
+    """Синхронизация названий страниц: только записи "Кассы", привязанные к операторам"""
+
+    def __init__(self, table, page_ids, on_change=None, chunk_size=50):
+        super().__init__(table, fields=['Name'], on_change=on_change)
+        self.page_ids = page_ids
+        self.chunk_size = chunk_size
+
+    def _fetch(self, page_ids):
+        return super().pull_records(page_ids, self.chunk_size)
+
+    def pull_full(self):
+        return self._fetch(self.page_ids())
+
+    def pull_changes(self, cursor, known_ids):
+        referenced = self.page_ids()
+        wanted = set(referenced)
+        # Переименованные страницы (в "Кассе" много записей, поэтому фильтруем по полю Name)
+        changed = [record for record in self._all(formula=modified_since(cursor, 'Name'))
+                   if record['id'] in wanted]
+        # Новые страницы, которые еще не попали в копию
+        changed_ids = {record['id'] for record in changed}
+        missing = [page_id for page_id in referenced if page_id not in known_ids and page_id not in changed_ids]
+        return changed + self._fetch(missing)
+
+    def pull_records(self, record_ids, chunk_size=None):
+        # Из "Кассы" нужны только страницы операторов, остальные записи пропускаем
+        wanted = set(self.page_ids())
+        return self._fetch([record_id for record_id in record_ids if record_id in wanted])
+
+
+class SyncEngine:
+    """Фоновая синхронизация локальной копии с Airtable и обновление кэшей в памяти"""
+
+    def __init__(self, replica, syncs, interval=60, full_sync_every=60):
+        self.replica = replica
+        self.syncs = {sync.name: sync for sync in syncs}
+        self.interval = interval
+        self.full_sync_every = full_sync_every
+        self._cycles = 0
+        self._restored = {}
+        # Фоновая синхронизация и обновления по уведомлениям не должны перемешивать изменения кэшей
+        self._sync_lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.following = False
+
+    def restore(self):
+        """Заполняет кэши из локальной копии без обращения к Airtable
+
+        Таблицы, которые не синхронизировались с прошлого вызова, пропускаются.
+        """
+        for name, sync in self.syncs.items():
+            cursor = self.replica.get_cursor(name)
+            if cursor is None or cursor == self._restored.get(name):
+                continue
+            records = self.replica.load(name)
+            if sync.on_change:
+                sync.on_change(records, full=True, cursor=cursor)
+            if name not in self._restored:
+                logger.info(f"Restored {len(records)} records of {name} from replica")
+            self._restored[name] = cursor
+
+    def sync(self, name, full=False):
+        """Синхронизирует одну таблицу: полностью или начиная с сохраненного курсора"""
+        sync = self.syncs[name]
+        with self._sync_lock:
+            started = datetime.now(timezone.utc)
+            cursor = self.replica.get_cursor(name)
+
+            if full or cursor is None:
+                full = True
+                records = sync.pull_full()
+                self.replica.replace(name, records)
+            else:
+                records = sync.pull_changes(cursor, self.replica.ids(name))
+                self.replica.upsert(name, records)
+            self.replica.set_cursor(name, started)
+
+            if records or full:
+                logger.info(f"Synced {name}: {len(records)} records ({'full' if full else 'changes'})")
+            if sync.on_change:
+                sync.on_change(records, full=full, cursor=started)
+
+    def sync_all(self, full=False):
+        for name in self.syncs:
+            try:
+                self.sync(name, full=full)
+            except Exception as e:
+                logger.error(f"Error syncing {name}: {str(e)}")
+
+    def sync_table(self, table_name, full=False):
+        """Синхронизирует все копии таблицы Airtable table_name (например, после удаления записей)"""
+        for name, sync in self.syncs.items():
+            if sync.table.name == table_name:
+                self.sync(name, full=full)
+
+    def refresh_records(self, table_name, record_ids):
+        """Точечно обновляет записи таблицы Airtable table_name в копии и кэшах
+
+        Курсор не сдвигается: следующая дельта-синхронизация еще раз проверит эти записи.
+        """
+        record_ids = sorted(record_ids)
+        for name, sync in self.syncs.items():
+            if sync.table.name != table_name:
+                continue
+            if not sync.targeted:
+                self.sync(name)
+                continue
+            with self._sync_lock:
+                records = sync.pull_records(record_ids)
+                self.replica.upsert(name, records)
+                if sync.on_change:
+                    sync.on_change(records, full=False)
+            logger.info(f"Refreshed {name}: {len(records)} of {len(record_ids)} changed records")
+
+    def patch(self, name, record_id, fields):
+        """Оптимистично обновляет запись в копии и кэшах после записи в Airtable"""
+        record = self.replica.patch(name, record_id, fields)
+        sync = self.syncs.get(name)
+        if record and sync and sync.on_change:
+            sync.on_change([record], full=False)
+
+    def start(self, follow=False):
+        """Запускает фоновую синхронизацию: сразу и затем раз в interval секунд
+
+        С follow=True копию синхронизирует другой процесс, а здесь кэши только
+        перечитываются из общего файла копии.
+        """
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self.following = follow
+        target = self._follow if follow else self._run
+        self._thread = threading.Thread(target=target, name="replica-sync", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            with use_priority(BACKGROUND):
+                # Периодически делаем полную синхронизацию, чтобы убрать удаленные записи
+                self.sync_all(full=self._cycles % self.full_sync_every == 0 and self._cycles > 0)
+            self._cycles += 1
+            self._stop.wait(self.interval)
+
+    def _follow(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.restore()
+            except Exception as e:
+                logger.error(f"Error reloading replica: {str(e)}")
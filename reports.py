@@ -0,0 +1,209 @@
+import logging
+import threading
+from datetime import date, datetime, timedelta
+
+from replica import TableSync, modified_since
+
+logger = logging.getLogger(__name__)
+
+# Поля "Кассы", нужные для итогов
+CASH_FIELDS = ['ID', 'Date', 'Смена', 'Страница', 'Тип', 'Касса']
+
+
+def _entry(fields):
+    """Запись кассы -> (ID оператора, (дата, смена, ID страницы, тип), сумма) или None"""
+    operator_id = fields.get('ID')
+    day = fields.get('Date')
+    if not operator_id or not day:
+        return None
+    pages = fields.get('Страница') or [None]
+    key = (day[:10], fields.get('Смена') or '', pages[0] or '', fields.get('Тип') or '')
+    try:
+        amount = float(fields.get('Касса') or 0)
+    except (TypeError, ValueError):
+        amount = 0.0
+    return str(operator_id), key, amount
+
+
+class CashReports:
+    """Итоги кассы по операторам в памяти: дополняются при каждой записи и сверяются с Airtable
+
+    pending() возвращает ключи записей, еще не отправленных из очереди в Airtable.
+    """
+
+    def __init__(self, days=62, pending=None):
+        self.days = days
+        self.pending = pending or (lambda: set())
+        self._lock = threading.Lock()
+        # Итоги: ID оператора -> (дата, смена, ID страницы, тип) -> [сумма, число записей]
+        self._totals = {}
+        # Учтенные записи: ключ -> (ID оператора, ключ итога, сумма); локальные — с префиксом local:
+        self._entries = {}
+        self._settled = None
+
+    def _insert(self, record_key, entry):
+        operator_id, key, amount = entry
+        totals = self._totals.setdefault(operator_id, {}).setdefault(key, [0.0, 0])
+        totals[0] += amount
+        totals[1] += 1
+        self._entries[record_key] = entry
+
+    def _add(self, record_key, fields):
+        self._remove(record_key)
+        entry = _entry(fields)
+        if entry is not None:
+            self._insert(record_key, entry)
+
+    def _remove(self, record_key):
+        entry = self._entries.pop(record_key, None)
+        if entry is None:
+            return
+        operator_id, key, amount = entry
+        totals = self._totals[operator_id][key]
+        totals[0] -= amount
+        totals[1] -= 1
+        if not totals[1]:
+            del self._totals[operator_id][key]
+
+    def add_local(self, queue_key, fields):
+        """Учитывает запись, поставленную в очередь (еще не дошедшую до Airtable)"""
+        with self._lock:
+            self._add(f"local:{queue_key}", fields)
+
+    def prepare(self):
+        """Запоминает локальные записи, уже отправленные в Airtable, перед загрузкой изменений
+
+        После применения загруженных записей эти локальные копии убираются, чтобы не считать их дважды.
+        """
+        pending = self.pending()
+        with self._lock:
+            self._settled = {key for key in self._entries
+                             if key.startswith('local:') and key[6:] not in pending}
+
+    def apply(self, records, full=False, cursor=None):
+        """Применяет записи "Кассы", полученные синхронизацией"""
+        if self._settled is None:
+            self.prepare()
+        with self._lock:
+            settled, self._settled = self._settled, None
+            if full:
+                local = {key: entry for key, entry in self._entries.items()
+                         if key.startswith('local:') and key not in settled}
+                self._totals = {}
+                self._entries = {}
+                for key, entry in local.items():
+                    self._insert(key, entry)
+            for record in records:
+                self._add(record['id'], record['fields'])
+            for key in settled:
+                self._remove(key)
+        if full:
+            logger.info(f"Cash reports rebuilt: {len(self._entries)} records")
+
+    def shifts(self, operator_id, day):
+        """Смены, за которые у оператора есть записи кассы в этот день"""
+        day = day.isoformat()
+        with self._lock:
+            keys = list(self._totals.get(str(operator_id), {}))
+        return {key[1] for key in keys if key[0] == day}
+
+    def summary(self, operator_id, start, end):
+        """Итоги оператора за период [start, end] по дням, сменам, страницам и типам"""
+        operator_id = str(operator_id)
+        with self._lock:
+            totals = [((operator_id,) + key, value) for key, value in self._totals.get(operator_id, {}).items()]
+        return _summarize(totals, start, end)
+
+    def team_summary(self, start, end):
+        """Итоги всех операторов базы за период (отчет менеджера), в том числе по операторам"""
+        with self._lock:
+            totals = [((operator_id,) + key, value)
+                      for operator_id, by_key in self._totals.items() for key, value in by_key.items()]
+        return _summarize(totals, start, end)
+
+
+def _summarize(totals, start, end):
+    """Итоги [((ID оператора, дата, смена, ID страницы, тип), (сумма, число записей))] за период по группам"""
+    start, end = start.isoformat(), end.isoformat()
+    result = {'type': {}, 'day': {}, 'shift': {}, 'page': {}, 'operator': {}, 'count': 0}
+    for (operator_id, day, shift, page_id, operation_type), (amount, count) in totals:
+        if not start <= day <= end:
+            continue
+        result['count'] += count
+        for group, value in (('day', day), ('shift', shift), ('page', page_id), ('operator', operator_id)):
+            by_type = result[group].setdefault(value, {})
+            by_type[operation_type] = by_type.get(operation_type, 0) + amount
+        result['type'][operation_type] = result['type'].get(operation_type, 0) + amount
+    return result
+
+
+class CashSync(TableSync):
+    """Сверка итогов с Airtable: записи "Кассы" за последние days дней"""
+
+    # Локальные записи снимаются с итогов только вместе со всеми записями, полученными после курсора
+    targeted = False
+
+    def __init__(self, table, reports):
+        super().__init__(table, fields=CASH_FIELDS, on_change=reports.apply)
+        self.reports = reports
+
+    @property
+    def name(self):
+        return f"{self.table.name} (итоги)"
+
+    def _window(self):
+        since = date.today() - timedelta(days=self.reports.days)
+        return f"IS_AFTER({{Date}}, DATETIME_PARSE('{since.isoformat()}'))"
+
+    def pull_full(self):
+        self.reports.prepare()
+        return self._all(formula=self._window())
+
+    def pull_changes(self, cursor, known_ids):
+        self.reports.prepare()
+        return self._all(formula=f"AND({modified_since(cursor)}, {self._window()})")
+
+
+def format_amount(amount):
+    return f"{amount:,.2f}".replace(',', ' ').replace('.00', '')
+
+
+def format_summary(title, summary, page_names=None, details=('shift', 'page'), operator_names=None):
+    """Текст отчета для Telegram; operator_names — {ID оператора: имя} для разбивки по операторам"""
+    if not summary['count']:
+        return f"📊 {title}\nЗаписей нет."
+    pages = {page_id: name for name, page_id in (page_names or {}).items()}
+    labels = {'day': "По дням", 'shift': "По сменам", 'page': "По страницам", 'operator': "По операторам"}
+
+    def by_type(values):
+        return ", ".join(f"{operation_type}: {format_amount(amount)}" for operation_type, amount in sorted(values.items()))
+
+    lines = [f"📊 {title} (записей: {summary['count']})", by_type(summary['type'])]
+    for group in details:
+        lines.append("")
+        lines.append(f"{labels[group]}:")
+        rows = []
+        for value, values in sorted(summary[group].items()):
+            if group == 'page':
+                value = pages.get(value, value)
+            elif group == 'operator':
+                value = (operator_names or {}).get(value, value)
+            elif group == 'day':
+                value = datetime.strptime(value, "%Y-%m-%d").strftime("%d.%m")
+            rows.append(f"  {value or '—'}: {by_type(values)}")
+        # Дни и смены уже по порядку, страницы и операторы — по названию
+        lines.extend(sorted(rows) if group in ('page', 'operator') else rows)
+    return "\n".join(lines)
+
+
+def split_message(text, limit=4000):
+    """Делит длинный отчет по строкам на части не длиннее limit (лимит Telegram — 4096 символов)"""
+    parts = []
+    current = ""
+    for line in text.split("\n"):
+        if current and len(current) + len(line) + 1 > limit:
+            parts.append(current)
+            current = line[:limit]
+        else:
+            current = f"{current}\n{line}" if current else line[:limit]
+    return parts + [current]
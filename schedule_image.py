@@ -0,0 +1,179 @@
+import asyncio
+import calendar
+import hashlib
+import io
+import json
+import logging
+from functools import lru_cache
+
+from telegram.error import BadRequest
+
+logger = logging.getLogger(__name__)
+
+# Версия оформления входит в ключ кэша: после изменения картинки нарисуются заново
+RENDER_VERSION = 1
+
+MONTHS = ["Январь", "Февраль", "Март", "Апрель", "Май", "Июнь",
+          "Июль", "Август", "Сентябрь", "Октябрь", "Ноябрь", "Декабрь"]
+WEEKDAYS = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+
+DAY_OFF = "Выходной"
+REPLACEMENT = "Замена"
+# Короткие подписи статусов для сводного графика
+SHORT_LABELS = {DAY_OFF: "вых", REPLACEMENT: "зам"}
+
+BACKGROUND = (255, 255, 255)
+GRID = (200, 200, 200)
+TEXT = (33, 33, 33)
+MUTED = (150, 150, 150)
+WEEKEND = (245, 245, 245)
+STATUS_COLORS = {DAY_OFF: (200, 230, 201), REPLACEMENT: (255, 224, 178)}
+SHIFT_COLORS = {
+    "00-08": (197, 202, 233), "08-16": (187, 222, 251), "16-00": (209, 196, 233),
+    "00-06": (178, 235, 242), "06-12": (255, 249, 196), "12-18": (255, 236, 179), "18-00": (225, 190, 231),
+}
+OTHER_COLOR = (236, 239, 241)
+
+
+def content_key(kind, year, month, content):
+    """Ключ картинки: хеш содержимого (не меняется, пока не изменился график)"""
+    data = json.dumps([RENDER_VERSION, kind, year, month, content], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()[:32]
+
+
+@lru_cache(maxsize=16)
+def _font(path, size):
+    """Шрифт TrueType с кириллицей; без него — встроенный шрифт Pillow"""
+    from PIL import ImageFont
+
+    if path:
+        try:
+            return ImageFont.truetype(path, size)
+        except OSError:
+            logger.warning(f"Font {path} not found, using the default font")
+    return ImageFont.load_default(size)
+
+
+def _color(status):
+    if not status:
+        return BACKGROUND
+    return STATUS_COLORS.get(status) or SHIFT_COLORS.get(status) or OTHER_COLOR
+
+
+def _centered(draw, box, text, font, fill=TEXT):
+    left, top, right, bottom = box
+    width = draw.textlength(text, font=font)
+    draw.text(((left + right - width) / 2, (top + bottom) / 2), text, font=font, fill=fill, anchor='lm')
+
+
+def _fit(draw, text, font, width):
+    """Обрезает текст с многоточием, чтобы он поместился в width пикселей"""
+    if draw.textlength(text, font=font) <= width:
+        return text
+    while text and draw.textlength(text + "…", font=font) > width:
+        text = text[:-1]
+    return text + "…"
+
+
+def _png(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def render_month(title, year, month, days, font_path=None):
+    """Календарь оператора на месяц: PNG со статусами дней {день: статус}"""
+    from PIL import Image, ImageDraw
+
+    cell_width, cell_height, margin, header = 120, 76, 20, 90
+    weeks = calendar.monthcalendar(year, month)
+    width = margin * 2 + cell_width * 7
+    height = header + margin + cell_height * len(weeks)
+    image = Image.new('RGB', (width, height), BACKGROUND)
+    draw = ImageDraw.Draw(image)
+
+    draw.text((margin, 16), f"{title} — {MONTHS[month - 1]} {year}", font=_font(font_path, 26), fill=TEXT)
+    for column, weekday in enumerate(WEEKDAYS):
+        left = margin + column * cell_width
+        _centered(draw, (left, 58, left + cell_width, header), weekday, _font(font_path, 18),
+                  fill=MUTED if column >= 5 else TEXT)
+
+    for row, week in enumerate(weeks):
+        for column, day in enumerate(week):
+            left = margin + column * cell_width
+            top = header + row * cell_height
+            box = (left, top, left + cell_width, top + cell_height)
+            if not day:
+                draw.rectangle(box, fill=WEEKEND, outline=GRID)
+                continue
+            status = days.get(day)
+            draw.rectangle(box, fill=_color(status) if status else (WEEKEND if column >= 5 else BACKGROUND), outline=GRID)
+            draw.text((left + 8, top + 6), str(day), font=_font(font_path, 16), fill=TEXT)
+            if status:
+                _centered(draw, (left, top + 24, left + cell_width, top + cell_height), status, _font(font_path, 17))
+    return _png(image)
+
+
+def render_team(title, year, month, rows, font_path=None):
+    """Сводный график команды за один проход: строки (имя, {день: статус}), столбцы — дни месяца"""
+    from PIL import Image, ImageDraw
+
+    days_in_month = calendar.monthrange(year, month)[1]
+    name_width, cell_width, cell_height, margin, header = 220, 44, 26, 16, 80
+    width = margin * 2 + name_width + cell_width * days_in_month
+    height = header + margin + cell_height * max(len(rows), 1)
+    image = Image.new('RGB', (width, height), BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    font = _font(font_path, 12)
+
+    draw.text((margin, 12), f"{title} — {MONTHS[month - 1]} {year}", font=_font(font_path, 22), fill=TEXT)
+    for day in range(1, days_in_month + 1):
+        left = margin + name_width + (day - 1) * cell_width
+        weekend = calendar.weekday(year, month, day) >= 5
+        _centered(draw, (left, 50, left + cell_width, header), str(day), _font(font_path, 13),
+                  fill=MUTED if weekend else TEXT)
+
+    for index, (name, days) in enumerate(rows):
+        top = header + index * cell_height
+        name_font = _font(font_path, 14)
+        draw.text((margin, top + cell_height / 2), _fit(draw, name, name_font, name_width - 10),
+                  font=name_font, fill=TEXT, anchor='lm')
+        for day in range(1, days_in_month + 1):
+            left = margin + name_width + (day - 1) * cell_width
+            status = days.get(day)
+            weekend = calendar.weekday(year, month, day) >= 5
+            fill = _color(status) if status else (WEEKEND if weekend else BACKGROUND)
+            draw.rectangle((left, top, left + cell_width, top + cell_height), fill=fill, outline=GRID)
+            if status:
+                _centered(draw, (left, top, left + cell_width, top + cell_height),
+                          SHORT_LABELS.get(status, status), font)
+    return _png(image)
+
+
+async def send_cached(message, cache, key, render, filename, document=False, cache_size=500, **kwargs):
+    """Отправляет картинку по file_id из cache {ключ: file_id}; при промахе рисует ее в потоке
+
+    Пока содержимое не изменилось, картинка не рисуется и не загружается в Telegram повторно.
+    """
+    file_id = cache.get(key)
+    if file_id:
+        try:
+            if document:
+                return await message.reply_document(file_id, **kwargs)
+            return await message.reply_photo(file_id, **kwargs)
+        except BadRequest as e:
+            # file_id мог устареть (например, после смены токена бота)
+            logger.warning(f"Cached image {key} was rejected, rendering again: {str(e)}")
+            cache.pop(key, None)
+
+    data = await asyncio.to_thread(render)
+    if document:
+        sent = await message.reply_document(data, filename=filename, **kwargs)
+        cache[key] = sent.document.file_id
+    else:
+        sent = await message.reply_photo(data, filename=filename, **kwargs)
+        cache[key] = sent.photo[-1].file_id
+    # Самые старые ключи вытесняются (словарь хранит порядок добавления)
+    for old_key in list(cache)[:max(0, len(cache) - cache_size)]:
+        del cache[old_key]
+    return sent
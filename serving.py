@@ -0,0 +1,70 @@
+import asyncio
+import logging
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает обновления параллельно, но в пределах одного чата строго по порядку
+
+    Обновление сначала ждет своей очереди в чате и только потом занимает один из
+    max_concurrent_updates слотов, поэтому медленный чат не занимает слоты ожидающими
+    обновлениями и не задерживает остальные чаты.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._chats = {}
+
+    async def process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await super().process_update(update, coroutine)
+            return
+
+        # Блокировка чата (ожидающие получают ее по очереди) и число ожидающих ее обновлений
+        entry = self._chats.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        except asyncio.CancelledError:
+            # Отмена в очереди чата: обработка не начиналась
+            coroutine.close()
+            raise
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat.id]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def run_application(application, mode='polling', webhook_url=None, listen='0.0.0.0',
+                    port=8443, url_path='', secret_token=None):
+    """Запускает бота в режиме polling или webhook (локальный HTTP-сервер)"""
+    if mode == 'webhook':
+        if not webhook_url:
+            raise ValueError("WEBHOOK_URL is required in webhook mode")
+        logger.info(f"Starting webhook server on {listen}:{port}/{url_path}")
+        application.run_webhook(
+            listen=listen,
+            port=port,
+            url_path=url_path,
+            webhook_url=f"{webhook_url.rstrip('/')}/{url_path}",
+            secret_token=secret_token
+        )
+    elif mode == 'polling':
+        application.run_polling()
+    else:
+        raise ValueError(f"Unknown bot mode: {mode}")
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+logger = logging.getLogger(__name__)
+
+
+class ShardSupervisor:
+    """Процессы-обработчики обновлений: распределение по ID чата и перезапуск упавших
+
+    target(index, updates) — точка входа процесса, updates — его очередь обновлений.
+    environment(index) — переменные окружения процесса (свои файлы, порты, лимиты).
+    """
+
+    def __init__(self, target, shards, environment=None, check_interval=1.0,
+                 max_restart_delay=60, stable_after=60, stop_timeout=30):
+        self.target = target
+        self.shards = shards
+        self.environment = environment
+        self.check_interval = check_interval
+        self.max_restart_delay = max_restart_delay
+        self.stable_after = stable_after
+        self.stop_timeout = stop_timeout
+
+        # spawn: обработчики не наследуют потоки, соединения и пулы родителя
+        self._context = multiprocessing.get_context('spawn')
+        self.queues = [self._context.Queue() for _ in range(shards)]
+        self.processes = [None] * shards
+        self._started = [0.0] * shards
+        self._restarts = [0] * shards
+        self._monitor = None
+
+    def shard_for(self, update):
+        """Номер обработчика для обновления: все обновления одного чата попадают в один процесс"""
+        if update.effective_chat:
+            key = update.effective_chat.id
+        elif update.effective_user:
+            key = update.effective_user.id
+        else:
+            key = update.update_id
+        return key % self.shards
+
+    async def handle(self, update: Update, context):
+        """Обработчик приложения-диспетчера: передает обновление нужному процессу"""
+        self.queues[self.shard_for(update)].put(update.to_dict())
+
+    def _spawn(self, index):
+        environment = self.environment(index) if self.environment else {}
+        saved = {name: os.environ.get(name) for name in environment}
+        # Процесс, запущенный через spawn, получает копию окружения на момент запуска
+        os.environ.update(environment)
+        try:
+            process = self._context.Process(
+                target=self.target, args=(index, self.queues[index]), name=f"shard-{index}"
+            )
+            process.start()
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+        self.processes[index] = process
+        self._started[index] = time.monotonic()
+        logger.info(f"Started shard worker {index} (pid {process.pid})")
+
+    async def start(self, application=None):
+        for index in range(self.shards):
+            self._spawn(index)
+        self._monitor = asyncio.create_task(self._watch())
+
+    async def _watch(self):
+        next_restart = {}
+        while True:
+            await asyncio.sleep(self.check_interval)
+            now = time.monotonic()
+            for index, process in enumerate(self.processes):
+                if process.is_alive():
+                    if now - self._started[index] > self.stable_after:
+                        self._restarts[index] = 0
+                    continue
+
+                if index not in next_restart:
+                    # Экспоненциальная задержка, чтобы падающий при запуске процесс не перезапускался в цикле
+                    delay = min(2 ** self._restarts[index], self.max_restart_delay)
+                    next_restart[index] = now + delay
+                    logger.warning(
+                        f"Shard worker {index} exited with code {process.exitcode}, restarting in {delay}s"
+                    )
+                if now >= next_restart[index]:
+                    del next_restart[index]
+                    self._restarts[index] += 1
+                    self._spawn(index)
+
+    async def stop(self, application=None):
+        """Останавливает обработчики: они дорабатывают уже полученные обновления"""
+        if self._monitor:
+            self._monitor.cancel()
+        for updates in self.queues:
+            updates.put(None)
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            await asyncio.to_thread(process.join, self.stop_timeout)
+            if process.is_alive():
+                logger.warning(f"Shard worker {index} did not stop in time, terminating")
+                process.terminate()
+
+
+def build_dispatcher(builder, supervisor):
+    """Приложение-диспетчер: получает обновления из Telegram и раздает их обработчикам"""
+    application = builder.post_init(supervisor.start).post_stop(supervisor.stop).build()
+    application.add_handler(TypeHandler(Update, supervisor.handle))
+    return application
+
+
+async def _serve(application, updates):
+    await application.initialize()
+    await application.start()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        while True:
+            try:
+                data = await asyncio.to_thread(updates.get, timeout=1)
+            except queue.Empty:
+                # Супервизор завершился аварийно и не прислал сигнал остановки
+                if not multiprocessing.parent_process().is_alive():
+                    break
+                continue
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run_worker(application, updates):
+    """Цикл процесса-обработчика: обновления приходят из очереди супервизора, а не из Telegram"""
+    # Сигналы остановки получает вся группа процессов; обработчики останавливает супервизор
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, signal.SIG_IGN)
+    asyncio.run(_serve(application, updates))
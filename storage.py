@@ -0,0 +1,213 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlsplit
+
+from requests.adapters import HTTPAdapter
+
+from metrics import AIRTABLE_LATENCY, AIRTABLE_REQUESTS, span
+from rate_limit import INTERACTIVE, WRITE, use_priority
+
+logger = logging.getLogger(__name__)
+
+
+def table_from_url(url):
+    """Название таблицы из адреса запроса вида /v0/{base}/{table}/..."""
+    parts = urlsplit(url).path.split('/')
+    return unquote(parts[3]) if len(parts) > 3 else ''
+
+
+class AirtableAdapter(HTTPAdapter):
+    """HTTP-адаптер: автомат отключения, токен у планировщика, метрики и спан трассировки
+
+    Ответ 429 повторяется здесь же (до rate_limit_retries раз): после паузы планировщика
+    и с новым токеном того же приоритета, чтобы каждый повтор проходил через автомат и метрики.
+    """
+
+    def __init__(self, scheduler=None, breaker=None, rate_limit_retries=5, **kwargs):
+        self.scheduler = scheduler
+        self.breaker = breaker
+        self.rate_limit_retries = rate_limit_retries
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        attempt = 0
+        while True:
+            response = self._send_once(request, **kwargs)
+            if response.status_code != 429:
+                return response
+            logger.warning("Airtable rate limit exceeded (429)")
+            if not self.scheduler or attempt >= self.rate_limit_retries:
+                return response
+            self.scheduler.throttle()
+            response.close()
+            attempt += 1
+
+    def _send_once(self, request, **kwargs):
+        table = table_from_url(request.url)
+        # При разомкнутом автомате запрос завершается сразу, не занимая токен планировщика
+        probe = self.breaker.before_call() if self.breaker else False
+        if self.scheduler:
+            self.scheduler.acquire()
+        started = time.perf_counter()
+        status = 'error'
+        with span('airtable', table=table, method=request.method):
+            try:
+                response = super().send(request, **kwargs)
+                status = response.status_code
+            finally:
+                duration = time.perf_counter() - started
+                AIRTABLE_LATENCY.observe(duration, table=table, method=request.method)
+                AIRTABLE_REQUESTS.inc(table=table, method=request.method, status=status)
+                if self.breaker:
+                    success = status != 'error' and status < 500 and status != 429
+                    self.breaker.record(success, duration, probe)
+        return response
+
+
+def configure_connection_pool(api, size, scheduler=None, breaker=None):
+    """Расширяет пул соединений сессии pyairtable и ставит перед ним планировщик запросов и автомат"""
+    # Без повторов urllib3: они шли бы в обход планировщика, автомата и метрик (429 повторяет адаптер)
+    adapter = AirtableAdapter(scheduler, breaker, max_retries=0, pool_connections=1, pool_maxsize=size)
+    api.session.mount("https://", adapter)
+    api.session.mount("http://", adapter)
+
+
+class LazyApi:
+    """Клиент pyairtable, создаваемый при первом запросе
+
+    Импорт pyairtable занимает большую часть времени запуска, а с прогретыми кэшами
+    первые запросы к Airtable делает только фоновая синхронизация.
+    """
+
+    def __init__(self, api_key, endpoint_url=None, timeout=None):
+        self.api_key = api_key
+        self.endpoint_url = endpoint_url
+        self.timeout = timeout
+        self._api = None
+        self._setup = []
+        self._lock = threading.Lock()
+
+    def on_create(self, callback):
+        """callback(api) вызывается сразу после создания клиента"""
+        with self._lock:
+            if self._api is None:
+                self._setup.append(callback)
+                return
+        callback(self._api)
+
+    def get(self):
+        with self._lock:
+            if self._api is None:
+                started = time.perf_counter()
+                from pyairtable import Api
+
+                api = Api(self.api_key, endpoint_url=self.endpoint_url, timeout=self.timeout)
+                for callback in self._setup:
+                    callback(api)
+                self._api = api
+                logger.info(f"Airtable client created in {time.perf_counter() - started:.2f}s")
+            return self._api
+
+    def table(self, base_id, name):
+        return LazyTable(self, base_id, name)
+
+
+class LazyTable:
+    """Таблица pyairtable с отложенным созданием клиента; name доступно сразу"""
+
+    def __init__(self, client, base_id, name):
+        self.client = client
+        self.base_id = base_id
+        self.name = name
+        self._table = None
+
+    def __getattr__(self, attr):
+        if self._table is None:
+            self._table = self.client.get().table(self.base_id, self.name)
+        return getattr(self._table, attr)
+
+
+class AirtableStorage:
+    """Неблокирующий доступ к Airtable: синхронные вызовы pyairtable уходят в пул потоков"""
+
+    def __init__(self, api, max_workers=8, scheduler=None, breaker=None):
+        self.api = api
+        self.scheduler = scheduler
+        self.breaker = breaker
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="airtable")
+        self._inflight = {}
+        api.on_create(lambda created: configure_connection_pool(created, max_workers, scheduler, breaker))
+
+    def table(self, table):
+        return AsyncTable(self, table)
+
+    async def run(self, func, *args, priority=INTERACTIVE, **kwargs):
+        """Выполняет синхронную функцию в пуле потоков, не блокируя цикл событий"""
+        def call():
+            with use_priority(priority):
+                return func(*args, **kwargs)
+
+        # Копируем контекст, чтобы трасса обработчика дошла до HTTP-запросов в потоке
+        context = contextvars.copy_context()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, context.run, call)
+
+    async def run_shared(self, key, func, *args, **kwargs):
+        """Как run, но одинаковые одновременные чтения (по ключу key) выполняются один раз"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.run(func, *args, **kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(functools.partial(self._forget, key))
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class AsyncTable:
+    """Асинхронная обертка над таблицей pyairtable"""
+
+    def __init__(self, storage, table):
+        self.storage = storage
+        self.table = table
+
+    @property
+    def name(self):
+        return self.table.name
+
+    async def _read(self, method, *args, priority=INTERACTIVE, **options):
+        key = (self.name, method, repr(args), repr(sorted(options.items())))
+        return await self.storage.run_shared(
+            key, getattr(self.table, method), *args, priority=priority, **options
+        )
+
+    async def all(self, priority=INTERACTIVE, **options):
+        return await self._read('all', priority=priority, **options)
+
+    async def first(self, priority=INTERACTIVE, **options):
+        return await self._read('first', priority=priority, **options)
+
+    async def get(self, record_id, priority=INTERACTIVE, **options):
+        return await self._read('get', record_id, priority=priority, **options)
+
+    async def create(self, fields, **options):
+        return await self.storage.run(self.table.create, fields, priority=WRITE, **options)
+
+    async def update(self, record_id, fields, **options):
+        return await self.storage.run(self.table.update, record_id, fields, priority=WRITE, **options)
+
+    async def batch_create(self, records, **options):
+        return await self.storage.run(self.table.batch_create, records, priority=WRITE, **options)
+
+    async def batch_update(self, records, **options):
+        return await self.storage.run(self.table.batch_update, records, priority=WRITE, **options)
@@ -0,0 +1,73 @@
+import os
+import re
+
+# Имя агентства используется в именах файлов и переменных окружения (с буквы, чтобы
+# не совпасть с файлами процессов-обработчиков write_queue-1.sqlite3)
+NAME_PATTERN = re.compile(r'^[A-Za-z][A-Za-z0-9_]*$')
+
+
+def parse_bases(value, default):
+    """Разбирает список баз "имя:ID базы" через запятую; пусто — [default]"""
+    bases = []
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        name, _, base_id = item.strip().partition(':')
+        if not NAME_PATTERN.match(name) or not base_id:
+            raise ValueError(f"Invalid AIRTABLE_BASES entry: {item.strip()} (expected name:appXXXXXXXX)")
+        if name in (known for known, _ in bases):
+            raise ValueError(f"Duplicate base name in AIRTABLE_BASES: {name}")
+        bases.append((name, base_id))
+    return bases or [default]
+
+
+def tenant_setting(name, key, default=None):
+    """Настройка агентства: переменная KEY_ИМЯ, иначе общая KEY"""
+    return os.getenv(f"{key}_{name.upper()}") or os.getenv(key, default)
+
+
+def tenant_path(path, name):
+    """Файл агентства рядом с общим: write_queue.sqlite3 -> write_queue-имя.sqlite3"""
+    root, ext = os.path.splitext(path)
+    return f"{root}-{name}{ext}"
+
+
+class Tenant:
+    """Агентство со своей базой Airtable
+
+    У каждого агентства свой клиент с пулом соединений, лимит запросов, автомат отключения,
+    кэши, очередь записей и синхронизация, поэтому нагрузка одного не тормозит остальных.
+    """
+
+    def __init__(self, name, base_id, **components):
+        self.name = name
+        self.base_id = base_id
+        self.__dict__.update(components)
+
+    def __repr__(self):
+        return f"Tenant({self.name!r}, {self.base_id!r})"
+
+
+class TenantRegistry:
+    """Агентства процесса; первое — агентство по умолчанию (для сессий без сохраненного агентства)"""
+
+    def __init__(self, tenants):
+        self.tenants = {tenant.name: tenant for tenant in tenants}
+        self.default = tenants[0]
+
+    def __iter__(self):
+        return iter(self.tenants.values())
+
+    def __len__(self):
+        return len(self.tenants)
+
+    def get(self, name):
+        return self.tenants.get(name, self.default)
+
+    def find_operator(self, tg_id):
+        """Ищет оператора по TG ID в кэшах всех агентств: (агентство, запись) или (None, None)"""
+        for tenant in self:
+            operator = tenant.operator_directory.find_by_tg_id(tg_id)
+            if operator:
+                return tenant, operator
+        return None, None
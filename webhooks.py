@@ -0,0 +1,215 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Состояние вебхука в локальной копии базы: ID, секрет подписи и курсор следующего пакета изменений
+STATE_KEY = 'airtable_webhook'
+# Уведомлять только об изменениях данных таблиц (не схемы)
+SPECIFICATION = {'options': {'filters': {'dataTypes': ['tableData']}}}
+
+
+def verify_mac(secret, body, header):
+    """Проверяет заголовок X-Airtable-Content-MAC секретом вебхука (base64)"""
+    digest = hmac.new(base64.b64decode(secret), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(f"hmac-sha256={digest}", header or '')
+
+
+def collect_changes(payloads, table_names):
+    """Разбирает пакеты изменений Airtable
+
+    Возвращает ({таблица: ID измененных и новых записей}, таблицы с удаленными записями,
+    ID таблиц, которых нет в table_names {ID таблицы: название}).
+    """
+    changed = {}
+    destroyed = set()
+    unknown = set()
+    for payload in payloads:
+        for table_id, change in payload.get('changedTablesById', {}).items():
+            name = table_names.get(table_id)
+            if name is None:
+                unknown.add(table_id)
+                continue
+            record_ids = changed.setdefault(name, set())
+            record_ids.update(change.get('changedRecordsById', {}))
+            record_ids.update(change.get('createdRecordsById', {}))
+            if change.get('destroyedRecordIds'):
+                destroyed.add(name)
+    return changed, destroyed, unknown
+
+
+class ChangeReceiver:
+    """Уведомления Airtable об изменениях одной базы: точечное обновление копии и кэшей
+
+    Airtable присылает на notify_url только сигнал; сами изменения забираются по курсору
+    и обновляются только затронутые записи. Пока уведомления работают, копия опрашивается
+    редко (poll_interval); если вебхук не удалось зарегистрировать или забрать изменения,
+    опрос возвращается к fallback_interval.
+    """
+
+    def __init__(self, client, base_id, sync_engine, notify_url, poll_interval=900, fallback_interval=60,
+                 refresh_interval=12 * 3600):
+        self.client = client
+        self.base_id = base_id
+        self.sync_engine = sync_engine
+        self.notify_url = notify_url
+        self.poll_interval = poll_interval
+        self.fallback_interval = fallback_interval
+        # Вебхуки Airtable истекают через 7 дней без продления
+        self.refresh_interval = refresh_interval
+        self._state = sync_engine.replica.get_state(STATE_KEY)
+        self._table_names = None
+        self._dirty = False
+        self._task = None
+        self._drain_task = None
+
+    def _urls(self):
+        return self.client.get().base(self.base_id).urls
+
+    def _save(self, state):
+        self.sync_engine.replica.set_state(STATE_KEY, state)
+        self._state = state
+
+    def register(self):
+        """Создает вебхук базы или продлевает сохраненный (блокирующий вызов)"""
+        api = self.client.get()
+        urls = self._urls()
+        state = self._state
+        hooks = {hook['id']: hook for hook in api.get(urls.webhooks).get('webhooks', [])}
+        hook = hooks.get(state['id']) if state else None
+
+        if hook is None:
+            created = api.post(urls.webhooks, json={'notificationUrl': self.notify_url, 'specification': SPECIFICATION})
+            state = {'id': created['id'], 'secret': created['macSecretBase64'], 'cursor': 1}
+            logger.info(f"Airtable webhook {state['id']} created for base {self.base_id}")
+        else:
+            if not hook.get('areNotificationsEnabled', True):
+                # Airtable выключает уведомления, если они долго не доставлялись
+                api.post(urls.webhooks / state['id'] / 'enableNotifications', json={'enable': True})
+            api.post(urls.webhooks / state['id'] / 'refresh')
+            logger.info(f"Airtable webhook {state['id']} refreshed for base {self.base_id}")
+
+        # Вебхуки с тем же адресом остались от потерянной копии: они дублировали бы уведомления
+        for hook_id, other in hooks.items():
+            if hook_id != state['id'] and other.get('notificationUrl') == self.notify_url:
+                api.delete(urls.webhooks / hook_id)
+                logger.info(f"Deleted stale Airtable webhook {hook_id}")
+        self._save(state)
+
+    def _load_table_names(self):
+        """ID таблиц базы -> названия (в изменениях Airtable таблицы указаны по ID)"""
+        try:
+            tables = self.client.get().get(self._urls().tables).get('tables', [])
+        except Exception as e:
+            logger.warning(f"Cannot read schema of base {self.base_id}, changes will be synced by cursor: {str(e)}")
+            return None
+        return {table['id']: table['name'] for table in tables}
+
+    def _fetch_payloads(self, cursor):
+        api = self.client.get()
+        url = self._urls().webhooks / self._state['id'] / 'payloads'
+        payloads = []
+        while True:
+            page = api.get(url, params={'cursor': cursor})
+            payloads.extend(page.get('payloads', []))
+            cursor = page.get('cursor', cursor)
+            if not page.get('mightHaveMore'):
+                return payloads, cursor
+
+    def process(self):
+        """Забирает изменения после сохраненного курсора и обновляет затронутые записи (блокирующий вызов)"""
+        payloads, cursor = self._fetch_payloads(self._state['cursor'])
+        if not payloads:
+            return
+
+        if self._table_names is None:
+            self._table_names = self._load_table_names()
+        changed, destroyed, unknown = collect_changes(payloads, self._table_names or {})
+        if unknown and self._table_names is not None:
+            # Таблицу могли переименовать или пересоздать
+            self._table_names = self._load_table_names() or self._table_names
+            changed, destroyed, unknown = collect_changes(payloads, self._table_names)
+
+        if self._table_names is None or any(payload.get('error') for payload in payloads):
+            # Без схемы (или при ошибке в пакете) подтягиваем изменения обычной синхронизацией
+            self.sync_engine.sync_all()
+        else:
+            for table_name in destroyed:
+                # Удаления убирает только полная синхронизация таблицы
+                self.sync_engine.sync_table(table_name, full=True)
+            for table_name, record_ids in changed.items():
+                if table_name not in destroyed:
+                    self.sync_engine.refresh_records(table_name, record_ids)
+        self._save(dict(self._state, cursor=cursor))
+        logger.info(f"Applied {len(payloads)} Airtable change payloads for base {self.base_id}")
+
+    async def handle(self, body, mac, webhook_id):
+        """Обрабатывает уведомление: отвечает сразу, изменения забираются в фоне"""
+        if not self._state or webhook_id != self._state['id']:
+            # Уведомление старого вебхука: 200, чтобы Airtable не повторял его
+            return 200, 'text/plain', b''
+        if not verify_mac(self._state['secret'], body, mac):
+            logger.warning(f"Rejected Airtable notification with invalid MAC for base {self.base_id}")
+            return 401, 'text/plain', b''
+        self.notify()
+        return 200, 'text/plain', b''
+
+    def notify(self):
+        """Запускает загрузку изменений; уведомления, пришедшие во время загрузки, объединяются"""
+        self._dirty = True
+        if self._drain_task is None or self._drain_task.done():
+            self._drain_task = asyncio.get_running_loop().create_task(self._drain())
+
+    async def _drain(self):
+        while self._dirty:
+            self._dirty = False
+            try:
+                await asyncio.to_thread(self.process)
+                self.sync_engine.interval = self.poll_interval
+            except Exception as e:
+                logger.error(f"Error applying Airtable changes for base {self.base_id}: {str(e)}")
+                self.sync_engine.interval = self.fallback_interval
+
+    def start(self):
+        """Запускает регистрацию и продление вебхука в цикле событий приложения"""
+        # Не через application.create_task: Application.stop() ждет такие задачи, а цикл бесконечный
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        for task in (self._task, self._drain_task):
+            if task:
+                task.cancel()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.register)
+                self.sync_engine.interval = self.poll_interval
+                delay = self.refresh_interval
+                # Изменения, накопившиеся, пока бот не работал
+                self.notify()
+            except Exception as e:
+                logger.error(f"Error registering Airtable webhook for base {self.base_id}: {str(e)}")
+                self.sync_engine.interval = self.fallback_interval
+                delay = self.fallback_interval
+            await asyncio.sleep(delay)
+
+
+def add_webhook_route(server, path, receivers):
+    """Подключает эндпоинт уведомлений Airtable; receivers — {ID базы: ChangeReceiver}"""
+    async def handle_notification(request):
+        try:
+            notification = json.loads(request.body)
+            base_id = notification['base']['id']
+            webhook_id = notification['webhook']['id']
+        except (ValueError, KeyError, TypeError):
+            return 400, 'text/plain', b'Bad notification'
+        receiver = receivers.get(base_id)
+        if receiver is None:
+            return 404, 'text/plain', b''
+        return await receiver.handle(request.body, request.headers.get('x-airtable-content-mac'), webhook_id)
+    server.add_route('POST', path, handle_notification)
@@ -0,0 +1,412 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+import uuid
+
+from requests import HTTPError
+
+from circuit_breaker import CircuitOpenError
+from rate_limit import WRITE
+
+logger = logging.getLogger(__name__)
+
+# Airtable принимает не больше 10 записей в одном batch-запросе
+BATCH_SIZE = 10
+
+
+def is_permanent(error):
+    """Ошибку валидации записи (422, INVALID_*) повтором не исправить
+
+    Остальные 4xx (ключ API отозван, таблица переименована, нет доступа) относятся ко всем
+    записям сразу, поэтому такие записи ждут и повторяются с увеличением паузы.
+    """
+    status = error.response.status_code if isinstance(error, HTTPError) and error.response is not None else None
+    return status == 422
+
+
+def remove_database(path):
+    """Удаляет файл SQLite вместе с журналом WAL"""
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+class WriteBehindQueue:
+    """Локальная очередь записей в Airtable (SQLite) с фоновой пакетной отправкой
+
+    available() — можно ли сейчас обращаться к Airtable; пока нельзя, записи копятся в очереди.
+    on_failed(bot, записи, ошибка) — корутина, которой сообщается об отклоненных Airtable записях.
+    """
+
+    def __init__(self, path, tables, key_field=None, min_interval=0.2,
+                 poll_interval=5, base_backoff=2, max_backoff=300, available=None, on_failed=None):
+        self.path = path
+        self.tables = tables
+        self.key_field = key_field
+        self.available = available
+        self.on_failed = on_failed
+        self.min_interval = min_interval
+        self.poll_interval = poll_interval
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS pending_writes ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " key TEXT UNIQUE NOT NULL,"
+            " table_name TEXT NOT NULL,"
+            " fields TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_attempt REAL NOT NULL DEFAULT 0,"
+            " failed INTEGER NOT NULL DEFAULT 0,"
+            " last_error TEXT)"
+        )
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._bot = None
+
+    def _row(self, table_name, fields, key):
+        if self.key_field:
+            fields = dict(fields, **{self.key_field: key})
+        return key, table_name, json.dumps(fields, ensure_ascii=False)
+
+    def enqueue(self, table_name, fields, key=None):
+        """Сохраняет запись в очередь и возвращает ее ключ идемпотентности"""
+        key = key or uuid.uuid4().hex
+        self._db.execute(
+            "INSERT OR IGNORE INTO pending_writes (key, table_name, fields) VALUES (?, ?, ?)",
+            self._row(table_name, fields, key)
+        )
+        self._wakeup.set()
+        return key
+
+    def enqueue_many(self, table_name, records):
+        """Сохраняет несколько записей одной транзакцией (все или ни одной) и возвращает их ключи"""
+        rows = [self._row(table_name, fields, uuid.uuid4().hex) for fields in records]
+        self._db.execute("BEGIN")
+        try:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO pending_writes (key, table_name, fields) VALUES (?, ?, ?)", rows
+            )
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+        self._wakeup.set()
+        return [row[0] for row in rows]
+
+    def absorb(self, path):
+        """Переносит записи из файла другой очереди (например, обработчика, которого больше нет)"""
+        source = sqlite3.connect(path)
+        try:
+            rows = source.execute(
+                "SELECT key, table_name, fields, attempts, failed, last_error FROM pending_writes ORDER BY id"
+            ).fetchall()
+        except sqlite3.OperationalError:
+            rows = []
+        finally:
+            source.close()
+        self._db.execute("BEGIN")
+        try:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO pending_writes (key, table_name, fields, attempts, failed, last_error)"
+                " VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+        self._wakeup.set()
+        return len(rows)
+
+    def pending(self, table_name):
+        """Неотправленные записи таблицы {ключ: поля}; можно вызывать из любого потока"""
+        db = sqlite3.connect(self.path)
+        try:
+            rows = db.execute(
+                "SELECT key, fields FROM pending_writes WHERE table_name = ? AND failed = 0", (table_name,)
+            ).fetchall()
+        finally:
+            db.close()
+        return {key: json.loads(fields) for key, fields in rows}
+
+    def depth(self):
+        """Количество записей, ожидающих отправки"""
+        return self._db.execute("SELECT COUNT(*) FROM pending_writes WHERE failed = 0").fetchone()[0]
+
+    def failed(self):
+        """Количество записей, отклоненных Airtable (остаются в очереди для разбора)"""
+        return self._db.execute("SELECT COUNT(*) FROM pending_writes WHERE failed = 1").fetchone()[0]
+
+    def _due(self, table_name):
+        return self._db.execute(
+            "SELECT id, key, fields, attempts FROM pending_writes"
+            " WHERE table_name = ? AND failed = 0 AND next_attempt <= ?"
+            " ORDER BY id LIMIT ?",
+            (table_name, time.time(), BATCH_SIZE)
+        ).fetchall()
+
+    async def flush(self):
+        """Отправляет все готовые к отправке записи пачками по BATCH_SIZE"""
+        sent = 0
+        for table_name, table in self.tables.items():
+            while self.available is None or self.available():
+                rows = self._due(table_name)
+                if not rows:
+                    break
+                sent += await self._send(table, rows)
+                await asyncio.sleep(self.min_interval)
+        return sent
+
+    async def _send(self, table, rows, check_existing=True):
+        try:
+            # Повторная попытка: пропускаем записи, которые уже дошли до Airtable
+            if check_existing and self.key_field and any(row[3] for row in rows):
+                existing = await self._existing_keys(table, [row[1] for row in rows])
+                if existing:
+                    self._delete([row[0] for row in rows if row[1] in existing])
+                    rows = [row for row in rows if row[1] not in existing]
+                    if not rows:
+                        return 0
+
+            await table.batch_create([json.loads(row[2]) for row in rows])
+            self._delete([row[0] for row in rows])
+            logger.info(f"Flushed {len(rows)} queued records to {table.name}")
+            return len(rows)
+        except Exception as e:
+            if len(rows) > 1 and is_permanent(e):
+                # Одна неверная запись отклоняет всю пачку: отправляем половины, пока не останется только она
+                logger.warning(f"Batch of {len(rows)} queued records rejected, splitting: {str(e)}")
+                middle = len(rows) // 2
+                sent = await self._send(table, rows[:middle], check_existing=False)
+                await asyncio.sleep(self.min_interval)
+                return sent + await self._send(table, rows[middle:], check_existing=False)
+            await self._retry_later(rows, e)
+            return 0
+
+    async def _existing_keys(self, table, keys):
+        formula = "OR(" + ",".join(f"{{{self.key_field}}}='{key}'" for key in keys) + ")"
+        records = await table.all(priority=WRITE, formula=formula, fields=[self.key_field])
+        return {record['fields'].get(self.key_field) for record in records}
+
+    def _delete(self, ids):
+        self._db.executemany("DELETE FROM pending_writes WHERE id = ?", [(row_id,) for row_id in ids])
+
+    async def _retry_later(self, rows, error):
+        ids = [row[0] for row in rows]
+        permanent = is_permanent(error)
+        if permanent:
+            logger.error(f"Queued records {ids} rejected by Airtable: {str(error)}")
+        else:
+            logger.warning(f"Error flushing queued records {ids}, will retry: {str(error)}")
+
+        for row_id in ids:
+            attempts = self._db.execute(
+                "SELECT attempts FROM pending_writes WHERE id = ?", (row_id,)
+            ).fetchone()[0] + 1
+            delay = min(self.base_backoff * 2 ** (attempts - 1), self.max_backoff)
+            self._db.execute(
+                "UPDATE pending_writes SET attempts = ?, next_attempt = ?, failed = ?, last_error = ?"
+                " WHERE id = ?",
+                (attempts, time.time() + delay, int(permanent), str(error), row_id)
+            )
+        if permanent and self.on_failed:
+            try:
+                await self.on_failed(self._bot, [json.loads(row[2]) for row in rows], error)
+            except Exception as e:
+                logger.error(f"Error reporting rejected records {ids}: {str(e)}")
+
+    def start(self, application):
+        """Запускает фоновую отправку очереди в цикле событий приложения"""
+        self._bot = application.bot
+        # Не через application.create_task: Application.stop() ждет такие задачи, а цикл бесконечный
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        self._db.close()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error in write queue worker: {str(e)}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+class UpdateCoalescer:
+    """Собирает изменения полей записей за короткое окно и отправляет их одним PATCH
+
+    Пока Airtable недоступен (available() ложно), изменения ждут и не расходуют попытки.
+    С path неотправленные изменения хранятся в SQLite (таблица pending_updates) и
+    отправляются после перезапуска. on_failed(bot, [(ID записи, поля)], ошибка) — корутина,
+    которой сообщается об изменениях, отброшенных после max_attempts попыток.
+    """
+
+    def __init__(self, table, path=None, window=2.0, retry_delay=5, max_attempts=5, available=None,
+                 on_failed=None):
+        self.table = table
+        self.available = available
+        self.on_failed = on_failed
+        self.window = window
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self._pending = {}
+        self._attempts = {}
+        self._timer = None
+        self._bot = None
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS pending_updates ("
+                " table_name TEXT NOT NULL, record_id TEXT NOT NULL, fields TEXT NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " PRIMARY KEY (table_name, record_id))"
+            )
+            for record_id, fields, attempts in self._db.execute(
+                "SELECT record_id, fields, attempts FROM pending_updates WHERE table_name = ?", (table.name,)
+            ):
+                self._pending[record_id] = json.loads(fields)
+                if attempts:
+                    self._attempts[record_id] = attempts
+
+    def pending(self):
+        return len(self._pending)
+
+    def _stored(self, record_id):
+        row = self._db.execute(
+            "SELECT fields, attempts FROM pending_updates WHERE table_name = ? AND record_id = ?",
+            (self.table.name, record_id)
+        ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else ({}, 0)
+
+    def _store(self, record_id, fields, attempts=None, older=False):
+        """Дописывает неотправленные поля записи; older — поля старше сохраненных и их не перетирают"""
+        if self._db is None:
+            return
+        stored, stored_attempts = self._stored(record_id)
+        merged = dict(fields, **stored) if older else dict(stored, **fields)
+        self._db.execute(
+            "INSERT OR REPLACE INTO pending_updates (table_name, record_id, fields, attempts) VALUES (?, ?, ?, ?)",
+            (self.table.name, record_id, json.dumps(merged, ensure_ascii=False),
+             stored_attempts if attempts is None else attempts)
+        )
+
+    def _forget(self, record_id, fields):
+        """Убирает отправленные (или отброшенные) поля; более новые значения тех же полей остаются"""
+        if self._db is None:
+            return
+        stored, attempts = self._stored(record_id)
+        left = {name: value for name, value in stored.items() if name not in fields or fields[name] != value}
+        if left:
+            self._db.execute(
+                "UPDATE pending_updates SET fields = ?, attempts = 0 WHERE table_name = ? AND record_id = ?",
+                (json.dumps(left, ensure_ascii=False), self.table.name, record_id)
+            )
+        else:
+            self._db.execute(
+                "DELETE FROM pending_updates WHERE table_name = ? AND record_id = ?", (self.table.name, record_id)
+            )
+
+    def absorb(self, path):
+        """Переносит неотправленные изменения из файла другой очереди (например, обработчика, которого больше нет)"""
+        source = sqlite3.connect(path)
+        try:
+            rows = source.execute(
+                "SELECT record_id, fields FROM pending_updates WHERE table_name = ?", (self.table.name,)
+            ).fetchall()
+        except sqlite3.OperationalError:
+            rows = []
+        finally:
+            source.close()
+        for record_id, fields in rows:
+            fields = json.loads(fields)
+            # Изменения этого процесса новее
+            self._pending[record_id] = dict(fields, **self._pending.get(record_id, {}))
+            self._store(record_id, fields, older=True)
+        return len(rows)
+
+    def add(self, record_id, fields):
+        """Добавляет изменения записи; отправка произойдет по истечении окна"""
+        self._pending.setdefault(record_id, {}).update(fields)
+        self._store(record_id, fields)
+        self._schedule(self.window)
+
+    def start(self, application):
+        """Отправляет изменения, сохраненные до перезапуска"""
+        self._bot = application.bot
+        if self._pending:
+            logger.info(f"Resuming {len(self._pending)} pending updates to {self.table.name}")
+            self._schedule(0)
+
+    def stop(self):
+        if self._timer:
+            self._timer.cancel()
+        if self._db is not None:
+            self._db.close()
+
+    def _schedule(self, delay):
+        if self._timer is None or self._timer.done():
+            self._timer = asyncio.ensure_future(self._flush_later(delay))
+
+    async def _flush_later(self, delay):
+        await asyncio.sleep(delay)
+        # Изменения, пришедшие во время отправки, должны запустить новый таймер
+        self._timer = None
+        await self.flush()
+
+    async def flush(self):
+        """Отправляет накопленные изменения пачками по BATCH_SIZE записей"""
+        if self.available and not self.available():
+            if self._pending:
+                self._schedule(self.retry_delay)
+            return
+        pending, self._pending = self._pending, {}
+        items = list(pending.items())
+        for i in range(0, len(items), BATCH_SIZE):
+            chunk = items[i:i + BATCH_SIZE]
+            try:
+                await self.table.batch_update([{'id': record_id, 'fields': fields} for record_id, fields in chunk])
+                for record_id, fields in chunk:
+                    self._attempts.pop(record_id, None)
+                    self._forget(record_id, fields)
+                logger.info(f"Flushed updates for {len(chunk)} records to {self.table.name}")
+            except Exception as e:
+                await self._requeue(chunk, e)
+
+    async def _requeue(self, chunk, error):
+        dropped = []
+        for record_id, fields in chunk:
+            # Отказ автомата — не ошибка записи, попытку не считаем
+            attempts = self._attempts.get(record_id, 0) + (not isinstance(error, CircuitOpenError))
+            if attempts >= self.max_attempts:
+                logger.error(f"Dropping updates for record {record_id} {fields}: {str(error)}")
+                self._attempts.pop(record_id, None)
+                self._forget(record_id, fields)
+                dropped.append((record_id, fields))
+                continue
+            logger.warning(f"Error updating record {record_id}, will retry: {str(error)}")
+            self._attempts[record_id] = attempts
+            self._store(record_id, {}, attempts=attempts)
+            # Более свежие изменения, пришедшие во время отправки, не перетираем
+            self._pending[record_id] = dict(fields, **self._pending.get(record_id, {}))
+        if self._pending:
+            self._schedule(self.retry_delay)
+        if dropped and self.on_failed:
+            try:
+                await self.on_failed(self._bot, dropped, error)
+            except Exception as e:
+                logger.error(f"Error reporting dropped updates to {self.table.name}: {str(e)}")